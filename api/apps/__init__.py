@@ -32,6 +32,7 @@ from flask_login import LoginManager
 from api.settings import SECRET_KEY, stat_logger
 from api.settings import API_VERSION, access_logger
 from api.utils.api_utils import server_error_response
+from api.utils.auth_cache import AUTH_CACHE
 from itsdangerous.url_safe import URLSafeTimedSerializer as Serializer
 
 __all__ = ['app']
@@ -108,9 +109,13 @@ def load_user(web_request):
     if authorization:
         try:
             access_token = str(jwt.loads(authorization))
-            user = UserService.query(access_token=access_token, status=StatusEnum.VALID.value)
+            user = AUTH_CACHE.get("user", access_token,
+                                  lambda: UserService.query(access_token=access_token, status=StatusEnum.VALID.value))
             if user:
-                return user[0]
+                # a copy of the cached row per request, handlers may modify and save it
+                user = type(user[0])(**user[0].__data__)
+                user._dirty.clear()
+                return user
             else:
                 return None
         except Exception as e:
@@ -24,6 +24,7 @@ from api.db import FileType, ParserType, FileSource
 from api.db.db_models import APIToken, API4Conversation, Task, File
 from api.db.services import duplicate_name
 from api.db.services.api_service import APITokenService, API4ConversationService
+from api.utils.auth_cache import AUTH_CACHE
 from api.db.services.dialog_service import DialogService, chat
 from api.db.services.document_service import DocumentService
 from api.db.services.file2document_service import File2DocumentService
@@ -33,7 +34,8 @@ from api.db.services.task_service import queue_tasks, TaskService
 from api.db.services.user_service import UserTenantService
 from api.settings import RetCode, retrievaler
 from api.utils import get_uuid, current_timestamp, datetime_format
-from api.utils.api_utils import server_error_response, get_data_error_result, get_json_result, validate_request
+from api.utils.api_utils import server_error_response, get_data_error_result, get_json_result, validate_request, \
+    answer_delta, bounded_prepare, stream_response
 from itsdangerous import URLSafeTimedSerializer
 
 from api.utils.file_utils import filename_type, thumbnail
@@ -94,6 +96,7 @@ def rm():
         for token in req["tokens"]:
             APITokenService.filter_delete(
                 [APIToken.tenant_id == req["tenant_id"], APIToken.token == token])
+            AUTH_CACHE.invalidate("api_token", token)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -132,7 +135,7 @@ def stats():
 @manager.route('/new_conversation', methods=['GET'])
 def set_conversation():
     token = request.headers.get('Authorization').split()[1]
-    objs = APIToken.query(token=token)
+    objs = APITokenService.get_by_token(token)
     if not objs:
         return get_json_result(
             data=False, retmsg='Token is not valid!"', retcode=RetCode.AUTHENTICATION_ERROR)
@@ -161,7 +164,7 @@ def set_conversation():
 @validate_request("conversation_id", "messages")
 def completion():
     token = request.headers.get('Authorization').split()[1]
-    if not APIToken.query(token=token):
+    if not APITokenService.get_by_token(token):
         return get_json_result(
             data=False, retmsg='Token is not valid!"', retcode=RetCode.AUTHENTICATION_ERROR)
     req = request.json
@@ -185,6 +188,7 @@ def completion():
             return get_data_error_result(retmsg="Dialog not found!")
         del req["conversation_id"]
         del req["messages"]
+        delta = req.pop("delta", False)
 
         if not conv.reference:
             conv.reference = []
@@ -206,9 +210,12 @@ def completion():
         def stream():
             nonlocal dia, msg, req, conv
             try:
-                for ans in chat(dia, msg, True, **req):
+                sent = ""
+                for ans in bounded_prepare(chat(dia, msg, True, **req)):
                     fillin_conv(ans)
                     rename_field(ans)
+                    if delta:
+                        ans, sent = answer_delta(ans, sent)
                     yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": ans}, ensure_ascii=False) + "\n\n"
                 API4ConversationService.append_message(conv.id, conv.to_dict())
             except Exception as e:
@@ -218,12 +225,7 @@ def completion():
             yield "data:"+json.dumps({"retcode": 0, "retmsg": "", "data": True}, ensure_ascii=False) + "\n\n"
 
         if req.get("stream", True):
-            resp = Response(stream(), mimetype="text/event-stream")
-            resp.headers.add_header("Cache-control", "no-cache")
-            resp.headers.add_header("Connection", "keep-alive")
-            resp.headers.add_header("X-Accel-Buffering", "no")
-            resp.headers.add_header("Content-Type", "text/event-stream; charset=utf-8")
-            return resp
+            return stream_response(stream())
         else:
             answer = None
             for ans in chat(dia, msg, **req):
@@ -265,7 +267,7 @@ def get(conversation_id):
 @validate_request("kb_name")
 def upload():
     token = request.headers.get('Authorization').split()[1]
-    objs = APIToken.query(token=token)
+    objs = APITokenService.get_by_token(token)
     if not objs:
         return get_json_result(
             data=False, retmsg='Token is not valid!"', retcode=RetCode.AUTHENTICATION_ERROR)
@@ -375,7 +377,7 @@ def upload():
 # @login_required
 def list_chunks():
     token = request.headers.get('Authorization').split()[1]
-    objs = APIToken.query(token=token)
+    objs = APITokenService.get_by_token(token)
     if not objs:
         return get_json_result(
             data=False, retmsg='Token is not valid!"', retcode=RetCode.AUTHENTICATION_ERROR)
@@ -414,7 +416,7 @@ def list_chunks():
 # @login_required
 def list_kb_docs():
     token = request.headers.get('Authorization').split()[1]
-    objs = APIToken.query(token=token)
+    objs = APITokenService.get_by_token(token)
     if not objs:
         return get_json_result(
             data=False, retmsg='Token is not valid!"', retcode=RetCode.AUTHENTICATION_ERROR)
@@ -454,7 +456,7 @@ def list_kb_docs():
 # @login_required
 def document_rm():
     token = request.headers.get('Authorization').split()[1]
-    objs = APIToken.query(token=token)
+    objs = APITokenService.get_by_token(token)
     if not objs:
         return get_json_result(
             data=False, retmsg='Token is not valid!"', retcode=RetCode.AUTHENTICATION_ERROR)
@@ -517,7 +519,7 @@ def completion_faq():
     req = request.json
 
     token = req["Authorization"]
-    objs = APIToken.query(token=token)
+    objs = APITokenService.get_by_token(token)
     if not objs:
         return get_json_result(
             data=False, retmsg='Token is not valid!"', retcode=RetCode.AUTHENTICATION_ERROR)
@@ -22,7 +22,8 @@ from flask_login import login_required, current_user
 from api.db.db_models import UserCanvas
 from api.db.services.canvas_service import CanvasTemplateService, UserCanvasService
 from api.utils import get_uuid
-from api.utils.api_utils import get_json_result, server_error_response, validate_request
+from api.utils.api_utils import get_json_result, server_error_response, validate_request, answer_delta, \
+    stream_response
 from graph.canvas import Canvas
 
 
@@ -85,6 +86,7 @@ def get(canvas_id):
 def run():
     req = request.json
     stream = req.get("stream", True)
+    delta = req.get("delta", False)
     e, cvs = UserCanvasService.get_by_id(req["id"])
     if not e:
         return server_error_response("canvas not found.")
@@ -111,10 +113,13 @@ def run():
         def sse():
             nonlocal answer, cvs
             try:
+                sent = ""
                 for ans in answer():
                     for k in ans.keys():
                         final_ans[k] = ans[k]
                     ans = {"answer": ans["content"], "reference": ans.get("reference", [])}
+                    if delta:
+                        ans, sent = answer_delta(ans, sent)
                     yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": ans}, ensure_ascii=False) + "\n\n"
 
                 canvas.messages.append({"role": "assistant", "content": final_ans["content"]})
@@ -128,12 +133,7 @@ def run():
                                            ensure_ascii=False) + "\n\n"
             yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": True}, ensure_ascii=False) + "\n\n"
 
-        resp = Response(sse(), mimetype="text/event-stream")
-        resp.headers.add_header("Cache-control", "no-cache")
-        resp.headers.add_header("Connection", "keep-alive")
-        resp.headers.add_header("X-Accel-Buffering", "no")
-        resp.headers.add_header("Content-Type", "text/event-stream; charset=utf-8")
-        return resp
+        return stream_response(sse())
 
     final_ans["content"] = "\n".join(answer["content"]) if "content" in answer else ""
     canvas.messages.append({"role": "assistant", "content": final_ans["content"]})
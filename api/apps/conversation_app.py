@@ -17,7 +17,8 @@ from copy import deepcopy
 from flask import request, Response
 from flask_login import login_required
 from api.db.services.dialog_service import DialogService, ConversationService, chat
-from api.utils.api_utils import server_error_response, get_data_error_result, validate_request
+from api.utils.api_utils import server_error_response, get_data_error_result, validate_request, answer_delta, \
+    bounded_prepare, stream_response
 from api.utils import get_uuid
 from api.utils.api_utils import get_json_result
 import json
@@ -128,6 +129,7 @@ def completion():
             return get_data_error_result(retmsg="Dialog not found!")
         del req["conversation_id"]
         del req["messages"]
+        delta = req.pop("delta", False)
 
         if not conv.reference:
             conv.reference = []
@@ -144,8 +146,11 @@ def completion():
         def stream():
             nonlocal dia, msg, req, conv
             try:
-                for ans in chat(dia, msg, True, **req):
+                sent = ""
+                for ans in bounded_prepare(chat(dia, msg, True, **req)):
                     fillin_conv(ans)
+                    if delta:
+                        ans, sent = answer_delta(ans, sent)
                     yield "data:"+json.dumps({"retcode": 0, "retmsg": "", "data": ans}, ensure_ascii=False) + "\n\n"
                 ConversationService.update_by_id(conv.id, conv.to_dict())
             except Exception as e:
@@ -155,12 +160,7 @@ def completion():
             yield "data:"+json.dumps({"retcode": 0, "retmsg": "", "data": True}, ensure_ascii=False) + "\n\n"
 
         if req.get("stream", True):
-            resp = Response(stream(), mimetype="text/event-stream")
-            resp.headers.add_header("Cache-control", "no-cache")
-            resp.headers.add_header("Connection", "keep-alive")
-            resp.headers.add_header("X-Accel-Buffering", "no")
-            resp.headers.add_header("Content-Type", "text/event-stream; charset=utf-8")
-            return resp
+            return stream_response(stream())
 
         else:
             answer = None
@@ -40,8 +40,6 @@ from api.utils.api_utils import construct_json_result, construct_error_response
 from api.utils.api_utils import construct_result, validate_request
 from api.utils.file_utils import filename_type, thumbnail
 from rag.app import book, laws, manual, naive, one, paper, presentation, qa, resume, table, picture, audio
-from rag.nlp import search
-from rag.utils.es_conn import ELASTICSEARCH
 from rag.utils.minio_conn import MINIO
 
 MAXIMUM_OF_UPLOADING_FILES = 256
@@ -727,7 +725,7 @@ def parsing_document_internal(id):
 
         DocumentService.update_by_id(id, info)
 
-        ELASTICSEARCH.deleteByQuery(Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+        DocumentService.delete_chunks(Q("match", doc_id=id), tenant_id)
 
         _, doc_attributes = DocumentService.get_by_id(id)
         doc_attributes = doc_attributes.to_dict()
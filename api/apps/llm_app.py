@@ -99,6 +99,7 @@ def set_api_key():
                 api_key=req["api_key"],
                 api_base=req.get("base_url", "")
             )
+    TenantLLMService.invalidate(current_user.id)
 
     return get_json_result(data=True)
 
@@ -208,6 +209,7 @@ def add_llm():
     if not TenantLLMService.filter_update(
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == factory, TenantLLM.llm_name == llm["llm_name"]], llm):
         TenantLLMService.save(**llm)
+    TenantLLMService.invalidate(current_user.id)
 
     return get_json_result(data=True)
 
@@ -219,6 +221,7 @@ def delete_llm():
     req = request.json
     TenantLLMService.filter_delete(
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"], TenantLLM.llm_name == req["llm_name"]])
+    TenantLLMService.invalidate(current_user.id)
     return get_json_result(data=True)
 
 
@@ -24,6 +24,7 @@ from rag.utils.minio_conn import MINIO
 from timeit import default_timer as timer
 
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.response_cache import RESPONSE_CACHE
 
 
 @manager.route('/version', methods=['GET'])
@@ -65,4 +66,5 @@ def status():
     except Exception as e:
         res["redis"] = {"status": "red", "elapsed": "{:.1f}".format((timer() - st)*1000.), "error": str(e)}
 
+    res["llm_response_cache"] = RESPONSE_CACHE.stats()
     return get_json_result(data=res)
@@ -33,6 +33,7 @@ from api.db.services.user_service import UserService, TenantService, UserTenantS
 from api.db.services.file_service import FileService
 from api.settings import stat_logger
 from api.utils.api_utils import get_json_result, cors_reponse
+from api.utils.auth_cache import AUTH_CACHE
 
 
 @manager.route('/login', methods=['POST', 'GET'])
@@ -58,11 +59,14 @@ def login():
     user = UserService.query_user(email, password)
     if user:
         response_data = user.to_json()
+        old_token = user.access_token
         user.access_token = get_uuid()
         login_user(user)
         user.update_time = current_timestamp(),
         user.update_date = datetime_format(datetime.now()),
         user.save()
+        # the token of the previous session is no longer valid, on any server
+        AUTH_CACHE.invalidate("user", old_token)
         msg = "Welcome back!"
         return cors_reponse(data=response_data, auth=user.get_id(), retmsg=msg)
     else:
@@ -118,9 +122,11 @@ def github_callback():
             stat_logger.exception(e)
             return redirect("/?error=%s" % str(e))
     user = users[0]
+    old_token = user.access_token
     user.access_token = get_uuid()
     login_user(user)
     user.save()
+    AUTH_CACHE.invalidate("user", old_token)
     return redirect("/?auth=%s" % user.get_id())
 
 
@@ -179,9 +185,11 @@ def feishu_callback():
             stat_logger.exception(e)
             return redirect("/?error=%s" % str(e))
     user = users[0]
+    old_token = user.access_token
     user.access_token = get_uuid()
     login_user(user)
     user.save()
+    AUTH_CACHE.invalidate("user", old_token)
     return redirect("/?auth=%s" % user.get_id())
 
 
@@ -217,8 +225,11 @@ def user_info_from_github(access_token):
 @manager.route("/logout", methods=['GET'])
 @login_required
 def log_out():
+    old_token = current_user.access_token
     current_user.access_token = ""
     current_user.save()
+    # after the save, so that no server caches the old token again meanwhile
+    AUTH_CACHE.invalidate("user", old_token)
     logout_user()
     return get_json_result(data=True)
 
@@ -246,6 +257,7 @@ def setting_user():
 
     try:
         UserService.update_by_id(current_user.id, update_dict)
+        AUTH_CACHE.invalidate("user", current_user.access_token)
         return get_json_result(data=True)
     except Exception as e:
         stat_logger.exception(e)
@@ -262,6 +274,7 @@ def user_info():
 def rollback_user_registration(user_id):
     try:
         UserService.delete_by_id(user_id)
+        AUTH_CACHE.invalidate("user")
     except Exception as e:
         pass
     try:
@@ -386,6 +399,7 @@ def set_tenant_info():
         tid = req["tenant_id"]
         del req["tenant_id"]
         TenantService.update_by_id(tid, req)
+        TenantLLMService.invalidate(tid)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
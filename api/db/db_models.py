@@ -337,6 +337,15 @@ def close_connection():
         LOGGER.exception(e)
 
 
+def release_connection():
+    """Gives the connection of this thread back to the pool, e.g. before streaming an answer for a while."""
+    try:
+        if DB and not DB.is_closed() and not DB.in_transaction():
+            DB.close()
+    except Exception as e:
+        LOGGER.exception(e)
+
+
 class DataBaseModel(BaseModel):
     class Meta:
         database = DB
@@ -18,11 +18,16 @@ import peewee
 from api.db.db_models import DB, API4Conversation, APIToken, Dialog
 from api.db.services.common_service import CommonService
 from api.utils import current_timestamp, datetime_format
+from api.utils.auth_cache import AUTH_CACHE
 
 
 class APITokenService(CommonService):
     model = APIToken
 
+    @classmethod
+    def get_by_token(cls, token):
+        return AUTH_CACHE.get("api_token", token, lambda: cls.query(token=token))
+
     @classmethod
     @DB.connection_context()
     def used(cls, token):
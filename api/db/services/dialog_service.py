@@ -16,18 +16,24 @@
 import os
 import json
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from copy import deepcopy
 
 from api.db import LLMType
-from api.db.db_models import Dialog, Conversation
+from api.db.db_models import Dialog, Conversation, release_connection
 from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.services.llm_service import LLMService, TenantLLMService, LLMBundle
+from api.utils.api_utils import prepared
 from api.settings import chat_logger, retrievaler, debug_logger, access_logger
 from rag.app.resume import forbidden_select_fields4resume
 from rag.nlp import keyword_extraction
 from rag.nlp.search import index_name
 from rag.utils import rmSpace, num_tokens_from_string, encoder
+from rag.utils.deadline import Deadline
+from rag.utils.tenant_limiter import TENANT_LIMITER
+from rag.utils.prompt_packer import message_fit_in, pack_knowledge, count_tokens, PROMPT_FIT_POLICY
 from api.utils.file_utils import get_project_base_directory
 
 
@@ -39,41 +45,13 @@ class ConversationService(CommonService):
     model = Conversation
 
 
-def message_fit_in(msg, max_length=4000):
-    def count():
-        nonlocal msg
-        tks_cnts = []
-        for m in msg:
-            tks_cnts.append(
-                {"role": m["role"], "count": num_tokens_from_string(m["content"])})
-        total = 0
-        for m in tks_cnts:
-            total += m["count"]
-        return total
-
-    c = count()
-    if c < max_length:
-        return c, msg
-
-    msg_ = [m for m in msg[:-1] if m["role"] == "system"]
-    msg_.append(msg[-1])
-    msg = msg_
-    c = count()
-    if c < max_length:
-        return c, msg
-
-    ll = num_tokens_from_string(msg_[0]["content"])
-    l = num_tokens_from_string(msg_[-1]["content"])
-    if ll / (ll + l) > 0.8:
-        m = msg_[0]["content"]
-        m = encoder.decode(encoder.encode(m)[:max_length - l])
-        msg[0]["content"] = m
-        return max_length, msg
-
-    m = msg_[1]["content"]
-    m = encoder.decode(encoder.encode(m)[:max_length - l])
-    msg[1]["content"] = m
-    return max_length, msg
+# Seconds self-RAG may take from the start of the retrieval. Once spent, the answer uses the chunks retrieved so far.
+SELF_RAG_TIMEOUT = float(os.environ.get("SELF_RAG_TIMEOUT", 30))
+# Time budget of everything before the generation, optional stages are skipped or cut short to meet it. 0 disables it.
+CHAT_DEADLINE = float(os.environ.get("CHAT_DEADLINE", 20))
+# Time kept for the retrieval when keyword extraction runs ahead of it.
+KEYWORD_RESERVE_SECONDS = float(os.environ.get("KEYWORD_RESERVE_SECONDS", 5))
+chat_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("CHAT_WORKERS", 16)))
 
 
 def llm_id2llm_type(llm_id):
@@ -86,6 +64,21 @@ def llm_id2llm_type(llm_id):
                 
 
 def chat(dialog, messages, stream=True, **kwargs):
+    """
+    Queues for one of the chat slots of the tenant before anything else, and keeps it until the answer is done.
+    The slot is taken on the first iteration, an answer generator dropped before it never holds one.
+    """
+    def answers():
+        holder = TENANT_LIMITER.acquire("chat", dialog.tenant_id)
+        try:
+            return (yield from _chat(dialog, messages, stream, **kwargs))
+        finally:
+            TENANT_LIMITER.release("chat", dialog.tenant_id, holder)
+
+    return answers()
+
+
+def _chat(dialog, messages, stream=True, **kwargs):
     assert messages[-1]["role"] == "user", "The last content of this conversation is not from user."
     llm = LLMService.query(llm_name=dialog.llm_id)
     if not llm:
@@ -135,26 +128,54 @@ def chat(dialog, messages, stream=True, **kwargs):
 
     for _ in range(len(questions) // 2):
         questions.append(questions[-1])
+    rewritten = None
+    deadline = Deadline(CHAT_DEADLINE)
     if "knowledge" not in [p["key"] for p in prompt_config["parameters"]]:
         kbinfos = {"total": 0, "chunks": [], "doc_aggs": []}
     else:
         if prompt_config.get("keyword", False):
-            questions[-1] += keyword_extraction(chat_mdl, questions[-1])
+            if not deadline.allows(2 * KEYWORD_RESERVE_SECONDS):
+                deadline.degrade("keyword extraction skipped")
+            else:
+                try:
+                    questions[-1] += deadline.call(keyword_extraction, chat_mdl, questions[-1],
+                                                   reserve=KEYWORD_RESERVE_SECONDS)
+                except TimeoutError:
+                    deadline.degrade("keyword extraction timed out")
+        if prompt_config.get("self_rag"):
+            # the rewrite only depends on the question, so it runs speculatively along the retrieval
+            self_rag_until = min(time.time() + SELF_RAG_TIMEOUT, deadline.at or float("inf"))
+            rewritten = chat_executor.submit(rewrite, dialog.tenant_id, dialog.llm_id, questions[-1])
         kbinfos = retrievaler.retrieval(" ".join(questions), embd_mdl, dialog.tenant_id, dialog.kb_ids, 1, dialog.top_n,
                                         dialog.similarity_threshold,
                                         dialog.vector_similarity_weight,
                                         doc_ids=kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else None,
-                                        top=dialog.top_k, aggs=False, rerank_mdl=rerank_mdl)
+                                        top=dialog.top_k, aggs=False, rerank_mdl=rerank_mdl, deadline=deadline)
     knowledges = [ck["content_with_weight"] for ck in kbinfos["chunks"]]
     #self-rag
-    if dialog.prompt_config.get("self_rag") and not relevant(dialog.tenant_id, dialog.llm_id, questions[-1], knowledges):
-        questions[-1] = rewrite(dialog.tenant_id, dialog.llm_id, questions[-1])
-        kbinfos = retrievaler.retrieval(" ".join(questions), embd_mdl, dialog.tenant_id, dialog.kb_ids, 1, dialog.top_n,
-                                        dialog.similarity_threshold,
-                                        dialog.vector_similarity_weight,
-                                        doc_ids=kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else None,
-                                        top=dialog.top_k, aggs=False, rerank_mdl=rerank_mdl)
-        knowledges = [ck["content_with_weight"] for ck in kbinfos["chunks"]]
+    if prompt_config.get("self_rag"):
+        if not rewritten:
+            self_rag_until = min(time.time() + SELF_RAG_TIMEOUT, deadline.at or float("inf"))
+            rewritten = chat_executor.submit(rewrite, dialog.tenant_id, dialog.llm_id, questions[-1])
+        judged = chat_executor.submit(relevant, dialog.tenant_id, dialog.llm_id, questions[-1], knowledges)
+        try:
+            if not judged.result(timeout=max(0., self_rag_until - time.time())):
+                original = " ".join(questions)
+                questions[-1] = rewritten.result(timeout=max(0., self_rag_until - time.time()))
+                question = " ".join(questions)
+                if prompt_config.get("fuse_rewrite"):
+                    # opt-in: the question is searched along with its rewrite, and their rankings fused
+                    question = [original, question]
+                kbinfos = retrievaler.retrieval(question, embd_mdl, dialog.tenant_id,
+                                                dialog.kb_ids, 1, dialog.top_n,
+                                                dialog.similarity_threshold,
+                                                dialog.vector_similarity_weight,
+                                                doc_ids=kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else None,
+                                                top=dialog.top_k, aggs=False, rerank_mdl=rerank_mdl,
+                                                deadline=deadline)
+                knowledges = [ck["content_with_weight"] for ck in kbinfos["chunks"]]
+        except FutureTimeout:
+            deadline.degrade("self-RAG timed out")
 
     chat_logger.info(
         "{}->{}".format(" ".join(questions), "\n->".join(knowledges)))
@@ -163,13 +184,19 @@ def chat(dialog, messages, stream=True, **kwargs):
         yield {"answer": prompt_config["empty_response"], "reference": kbinfos}
         return {"answer": prompt_config["empty_response"], "reference": kbinfos}
 
+    if knowledges and prompt_config.get("fit_policy", PROMPT_FIT_POLICY) == "pack":
+        kwargs["knowledge"] = ""
+        budget = int(max_tokens * 0.97) - count_tokens(prompt_config["system"].format(**kwargs), cache=False) - \
+                 count_tokens(messages[-1]["content"])
+        knowledges = pack_knowledge(knowledges, budget)
+        kbinfos["chunks"] = kbinfos["chunks"][:len(knowledges)]
     kwargs["knowledge"] = "\n".join(knowledges)
     gen_conf = dialog.llm_setting
 
     msg = [{"role": "system", "content": prompt_config["system"].format(**kwargs)}]
     msg.extend([{"role": m["role"], "content": m["content"]}
                 for m in messages if m["role"] != "system"])
-    used_token_count, msg = message_fit_in(msg, int(max_tokens * 0.97))
+    used_token_count, msg = message_fit_in(msg, int(max_tokens * 0.97), prompt_config.get("fit_policy"))
     assert len(msg) >= 2, f"message_fit_in has bug: {msg}"
 
     if "max_tokens" in gen_conf:
@@ -177,10 +204,22 @@ def chat(dialog, messages, stream=True, **kwargs):
             gen_conf["max_tokens"],
             max_tokens - used_token_count)
 
+    quote = knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True))
+    # similarities of the answer sentences to the chunks, filled in while the answer streams
+    sim_cache = {}
+
+    def score_sentences(answer):
+        pieces = [p for p in retrievaler.answer_pieces(answer)[:-1] if len(p) >= 5]
+        return chat_executor.submit(retrievaler.citation_similarity, pieces,
+                                    [ck["content_ltks"] for ck in kbinfos["chunks"]],
+                                    [ck["vector"] for ck in kbinfos["chunks"]],
+                                    embd_mdl, 1 - dialog.vector_similarity_weight,
+                                    dialog.vector_similarity_weight, sim_cache)
+
     def decorate_answer(answer):
         nonlocal prompt_config, knowledges, kwargs, kbinfos
         refs = []
-        if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
+        if quote:
             answer, idx = retrievaler.insert_citations(answer,
                                                        [ck["content_ltks"]
                                                         for ck in kbinfos["chunks"]],
@@ -188,7 +227,8 @@ def chat(dialog, messages, stream=True, **kwargs):
                                                         for ck in kbinfos["chunks"]],
                                                        embd_mdl,
                                                        tkweight=1 - dialog.vector_similarity_weight,
-                                                       vtweight=dialog.vector_similarity_weight)
+                                                       vtweight=dialog.vector_similarity_weight,
+                                                       sim_cache=sim_cache)
             idx = set([kbinfos["chunks"][int(i)]["doc_id"] for i in idx])
             recall_docs = [
                 d for d in kbinfos["doc_aggs"] if d["doc_id"] in idx]
@@ -202,12 +242,21 @@ def chat(dialog, messages, stream=True, **kwargs):
 
         if answer.lower().find("invalid key") >= 0 or answer.lower().find("invalid api") >= 0:
             answer += " Please set LLM API-Key in 'User Setting -> Model Providers -> API-Key'"
-        return {"answer": answer, "reference": refs}
-
+        res = {"answer": answer, "reference": refs}
+        if deadline.degraded:
+            res["degraded"] = deadline.degraded
+        return res
+
+    # nothing below needs the database, do not hold a pooled connection while the answer is generated
+    release_connection()
+    prepared()
     if stream:
         answer = ""
+        scoring, scored = None, 0
         for ans in chat_mdl.chat_streamly(msg[0]["content"], msg[1:], gen_conf):
             answer = ans
+            if quote and len(answer) - scored >= 128 and (scoring is None or scoring.done()):
+                scoring, scored = score_sentences(answer), len(answer)
             yield {"answer": answer, "reference": {}}
         yield decorate_answer(answer)
     else:
@@ -237,7 +286,7 @@ def use_sql(question, field_map, tenant_id, chat_mdl, quota=True):
 
     def get_table():
         nonlocal sys_prompt, user_promt, question, tried_times
-        sql = chat_mdl.chat(sys_prompt, [{"role": "user", "content": user_promt}], {
+        sql = chat_mdl.cached_chat("use_sql", 1, sys_prompt, [{"role": "user", "content": user_promt}], {
             "temperature": 0.06})
         print(user_promt, sql)
         chat_logger.info(f"“{question}”==>{user_promt} get SQL: {sql}")
@@ -361,7 +410,7 @@ def relevant(tenant_id, llm_id, question, contents: list):
     contents = f"Question: {question}\n" + contents
     if num_tokens_from_string(contents) >= chat_mdl.max_length - 4:
         contents = encoder.decode(encoder.encode(contents)[:chat_mdl.max_length - 4])
-    ans = chat_mdl.chat(prompt, [{"role": "user", "content": contents}], {"temperature": 0.01})
+    ans = chat_mdl.cached_chat("relevant", 1, prompt, [{"role": "user", "content": contents}], {"temperature": 0.01})
     if ans.lower().find("yes") >= 0: return True
     return False
 
@@ -380,5 +429,5 @@ def rewrite(tenant_id, llm_id, question):
         And return 5 versions of question and one is from translation.
         Just list the question. No other words are needed.
     """
-    ans = chat_mdl.chat(prompt, [{"role": "user", "content": question}], {"temperature": 0.8})
+    ans = chat_mdl.cached_chat("rewrite", 1, prompt, [{"role": "user", "content": question}], {"temperature": 0.8})
     return ans
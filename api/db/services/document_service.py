@@ -15,7 +15,7 @@
 #
 import random
 from datetime import datetime
-from elasticsearch_dsl import Q
+from elasticsearch_dsl import Q, Search
 from peewee import fn
 
 from api.db.db_utils import bulk_insert_into_db
@@ -105,11 +105,52 @@ class DocumentService(CommonService):
     @classmethod
     @DB.connection_context()
     def remove_document(cls, doc, tenant_id):
-        ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+        cls.delete_chunks(Q("match", doc_id=doc.id), tenant_id)
         cls.clear_chunk_num(doc.id)
         return cls.delete_by_id(doc.id)
 
+    @classmethod
+    def get_chunk_img_ids(cls, query, tenant_id):
+        """Returns the images referred to by the chunks matching `query`, or None if the index can not tell."""
+        s = Search().query(query)[0:0]
+        s.aggs.bucket("img_ids", "terms", field="img_id", size=10000)
+        try:
+            res = ELASTICSEARCH.search(s.to_dict(), idxnm=search.index_name(tenant_id))
+            return [b["key"] for b in res["aggregations"]["img_ids"]["buckets"] if b["key"]]
+        except Exception as e:
+            stat_logger.error("get chunk images: " + str(e))
+
+    @classmethod
+    def delete_chunks(cls, query, tenant_id):
+        """Deletes the chunks matching `query` from the index, and the images no other chunk refers to."""
+        img_ids = cls.get_chunk_img_ids(query, tenant_id)
+        res = ELASTICSEARCH.deleteByQuery(query, idxnm=search.index_name(tenant_id))
+        cls.release_chunk_images(img_ids, tenant_id)
+        return res
+
+    @classmethod
+    def release_chunk_images(cls, img_ids, tenant_id, grace=3600):
+        """
+        Chunk images are stored once per content hash and shared by chunks,
+        an image is removed only when no chunk in the index refers to it anymore.
+        Images written within `grace` seconds may belong to a task still being indexed and are kept.
+        """
+        if not img_ids:
+            return
+        referred = cls.get_chunk_img_ids(Q("terms", img_id=img_ids), tenant_id)
+        if referred is None:
+            stat_logger.warning("Keep {} chunk images, their references are unknown.".format(len(img_ids)))
+            return
+        referred = set(referred)
+        for img_id in img_ids:
+            if img_id in referred:
+                continue
+            bkt, nm = img_id.split("-")
+            tm = MINIO.last_modified(bkt, nm)
+            if tm is None or datetime.now().timestamp() - tm < grace:
+                continue
+            MINIO.rm(bkt, nm)
+
     @classmethod
     @DB.connection_context()
     def get_newly_uploaded(cls):
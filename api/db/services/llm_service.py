@@ -13,9 +13,23 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
 from api.db.services.user_service import TenantService
 from api.settings import database_logger
 from rag.llm import EmbeddingModel, CvModel, ChatModel, RerankModel, Seq2txtModel
+from rag.utils.lru_cache import LRUCache
+from rag.utils.response_cache import RESPONSE_CACHE
+from rag.utils.singleflight import SingleFlight
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.tenant_limiter import TENANT_LIMITER
 from api.db import LLMType
 from api.db.db_models import DB, UserTenant
 from api.db.db_models import LLMFactories, LLM, TenantLLM
@@ -26,12 +40,46 @@ class LLMFactoriesService(CommonService):
     model = LLMFactories
 
 
+# Seconds a resolved model config is trusted without checking the tenant's settings version, i.e. how long
+# a change made through another process goes unnoticed when Redis is unavailable.
+MODEL_CONFIG_TTL = int(os.environ.get("MODEL_CONFIG_TTL", 60))
+TOKEN_USAGE_FLUSH_INTERVAL = int(os.environ.get("TOKEN_USAGE_FLUSH_INTERVAL", 10))
+
+
 class LLMService(CommonService):
     model = LLM
+    max_tokens = LRUCache(1024, ttl=600)
+
+    @classmethod
+    def get_max_tokens(cls, llm_name, default=512):
+        n = cls.max_tokens.get(llm_name)
+        if n is not None:
+            return n
+        n = default
+        for lm in cls.query(llm_name=llm_name):
+            n = lm.max_tokens
+            break
+        cls.max_tokens.put(llm_name, n)
+        return n
 
 
 class TenantLLMService(CommonService):
     model = TenantLLM
+    # (tenant_id, llm_type, llm_name) -> (settings version, model config)
+    configs = LRUCache(4096, ttl=MODEL_CONFIG_TTL)
+    # Provider clients, with their HTTP pools, shared by every bundle built on the same config.
+    instances = LRUCache(1024, ttl=0)
+
+    @classmethod
+    def settings_version(cls, tenant_id):
+        v = REDIS_CONN.get("tenant_llm_version:" + tenant_id)
+        return v.decode("utf-8") if isinstance(v, bytes) else (v or "0")
+
+    @classmethod
+    def invalidate(cls, tenant_id):
+        """To be called whenever the models, api keys or default models of a tenant change."""
+        REDIS_CONN.incr("tenant_llm_version:" + tenant_id)
+        cls.configs.clear(lambda k: k[0] == tenant_id)
 
     @classmethod
     @DB.connection_context()
@@ -59,8 +107,7 @@ class TenantLLMService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def model_instance(cls, tenant_id, llm_type,
-                       llm_name=None, lang="Chinese"):
+    def get_model_config(cls, tenant_id, llm_type, llm_name=None):
         e, tenant = TenantService.get_by_id(tenant_id)
         if not e:
             raise LookupError("Tenant not found")
@@ -93,7 +140,33 @@ class TenantLLMService(CommonService):
                     if not mdlnm:
                         raise LookupError(f"Type of {llm_type} model is not set.")
                     raise LookupError("Model({}) not authorized".format(mdlnm))
+        return model_config
 
+    @classmethod
+    def model_instance(cls, tenant_id, llm_type,
+                       llm_name=None, lang="Chinese"):
+        key = (tenant_id, str(llm_type), llm_name)
+        version = cls.settings_version(tenant_id)
+        cached = cls.configs.get(key)
+        if cached and cached[0] == version:
+            model_config = cached[1]
+        else:
+            model_config = cls.get_model_config(tenant_id, llm_type, llm_name)
+            cls.configs.put(key, (version, model_config))
+
+        key = (str(llm_type), model_config["llm_factory"], model_config["llm_name"],
+               hashlib.md5(str(model_config["api_key"]).encode("utf-8")).hexdigest(),
+               model_config["api_base"], lang)
+        mdl = cls.instances.get(key)
+        if mdl is None:
+            mdl = cls.create_instance(model_config, llm_type, lang)
+            # clients which set their key on the SDK module, e.g. dashscope.api_key, are not shared
+            if mdl is not None and not getattr(mdl, "_global_key", False):
+                cls.instances.put(key, mdl)
+        return mdl
+
+    @classmethod
+    def create_instance(cls, model_config, llm_type, lang="Chinese"):
         if llm_type == LLMType.EMBEDDING.value:
             if model_config["llm_factory"] not in EmbeddingModel:
                 return
@@ -129,8 +202,12 @@ class TenantLLMService(CommonService):
             )
 
     @classmethod
-    @DB.connection_context()
     def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
+        return TOKEN_USAGE.add(tenant_id, llm_type, used_tokens, llm_name)
+
+    @classmethod
+    @DB.connection_context()
+    def apply_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
         e, tenant = TenantService.get_by_id(tenant_id)
         if not e:
             raise LookupError("Tenant not found")
@@ -148,15 +225,9 @@ class TenantLLMService(CommonService):
         else:
             assert False, "LLM type error"
 
-        num = 0
-        try:
-            for u in cls.query(tenant_id = tenant_id, llm_name=mdlnm):
-                num += cls.model.update(used_tokens = u.used_tokens + used_tokens)\
-                    .where(cls.model.tenant_id == tenant_id, cls.model.llm_name == mdlnm)\
-                    .execute()
-        except Exception as e:
-            pass
-        return num
+        return cls.model.update(used_tokens=cls.model.used_tokens + used_tokens)\
+            .where(cls.model.tenant_id == tenant_id, cls.model.llm_name == mdlnm)\
+            .execute()
 
     @classmethod
     @DB.connection_context()
@@ -169,7 +240,132 @@ class TenantLLMService(CommonService):
         return list(objs)
 
 
+class TokenUsageBuffer(object):
+    """
+    Adds up token usage in Redis, or in process while Redis is unreachable, and writes the totals to
+    tenant_llm every TOKEN_USAGE_FLUSH_INTERVAL seconds, one flushing process at a time.
+    Usage counted in Redis survives the crash of the process which made the calls. A flusher claims each
+    field, removing it from Redis, right before it updates the row, so a flusher which stalled past its lock
+    can not apply what the next one takes. Only a flusher crashing between the two loses that field.
+    """
+    PENDING = "llm_usage:pending"
+    FLUSHING = "llm_usage:flushing"
+    LOCK = "llm_usage:lock"
+
+    # Moves the pending totals aside unless a previous flush left some behind, which are retried first.
+    TAKE = """
+    if redis.call('exists', KEYS[2]) == 0 and redis.call('exists', KEYS[1]) == 1 then
+        redis.call('rename', KEYS[1], KEYS[2])
+    end
+    return redis.call('hgetall', KEYS[2])
+    """
+    ACQUIRE = "return redis.call('set', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2])"
+    RELEASE = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+    # Takes a field out of the flushing totals while the lock is still held, -1 if it is not anymore.
+    CLAIM = """
+    if redis.call('get', KEYS[1]) ~= ARGV[1] then
+        return -1
+    end
+    redis.call('expire', KEYS[1], ARGV[2])
+    local n = redis.call('hget', KEYS[2], ARGV[3])
+    redis.call('hdel', KEYS[2], ARGV[3])
+    return tonumber(n) or 0
+    """
+    LOCK_TTL = max(60, 6 * TOKEN_USAGE_FLUSH_INTERVAL)
+
+    def __init__(self):
+        self.local = defaultdict(int)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, tenant_id, llm_type, used_tokens, llm_name=None):
+        if not used_tokens:
+            return True
+        field = json.dumps([tenant_id, str(llm_type), llm_name])
+        if REDIS_CONN.hincrby(self.PENDING, field, int(used_tokens)) is None:
+            with self.lock:
+                self.local[field] += int(used_tokens)
+        if not self.thread:
+            self.start()
+        return True
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(TOKEN_USAGE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                database_logger.exception(e)
+
+    def apply(self, field, used_tokens):
+        tenant_id, llm_type, llm_name = json.loads(field)
+        try:
+            num = TenantLLMService.apply_usage(tenant_id, llm_type, used_tokens, llm_name)
+        except (LookupError, AssertionError) as e:
+            # the tenant is gone, retrying would only hold up the others
+            database_logger.error(str(e))
+            return
+        if not num:
+            database_logger.error(
+                "Can't update token usage for {}/{}/{}".format(tenant_id, llm_type, llm_name))
+
+    def flush(self):
+        with self.lock:
+            local, self.local = self.local, defaultdict(int)
+        for field, n in local.items():
+            try:
+                self.apply(field, n)
+            except Exception as e:
+                database_logger.exception(e)
+                with self.lock:
+                    self.local[field] += n
+
+        token = uuid.uuid1().hex
+        if not REDIS_CONN.eval(self.ACQUIRE, [self.LOCK], [token, self.LOCK_TTL]):
+            return
+        try:
+            res = REDIS_CONN.eval(self.TAKE, [self.PENDING, self.FLUSHING]) or []
+            for field in res[::2]:
+                n = REDIS_CONN.eval(self.CLAIM, [self.LOCK, self.FLUSHING], [token, self.LOCK_TTL, field])
+                if n is None or n < 0:
+                    database_logger.warning("Lost the token usage flush lock, leave the rest to the next flush.")
+                    return
+                if not n:
+                    continue
+                field = field.decode("utf-8") if isinstance(field, bytes) else field
+                try:
+                    self.apply(field, n)
+                except Exception as e:
+                    database_logger.exception(e)
+                    if REDIS_CONN.hincrby(self.PENDING, field, n) is None:
+                        with self.lock:
+                            self.local[field] += n
+                    return
+        finally:
+            REDIS_CONN.eval(self.RELEASE, [self.LOCK], [token])
+
+
+TOKEN_USAGE = TokenUsageBuffer()
+
+
 class LLMBundle(object):
+    # Identical concurrent deterministic calls of a tenant share one request to the model.
+    flights = SingleFlight()
+
     def __init__(self, tenant_id, llm_type, llm_name=None, lang="Chinese"):
         self.tenant_id = tenant_id
         self.llm_type = llm_type
@@ -178,30 +374,52 @@ class LLMBundle(object):
             tenant_id, llm_type, llm_name, lang=lang)
         assert self.mdl, "Can't find mole for {}/{}/{}".format(
             tenant_id, llm_type, llm_name)
-        self.max_length = 512
-        for lm in LLMService.query(llm_name=llm_name):
-            self.max_length = lm.max_tokens
-            break
+        self.max_length = LLMService.get_max_tokens(llm_name)
+
+    def _shared(self, op, args, fn):
+        """Runs `fn`, or waits for the identical call in flight. The tokens are only counted once."""
+        digest = hashlib.md5(json.dumps(args, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+        (res, used_tokens), shared = self.flights.do((self.tenant_id, id(self.mdl), op, digest.hexdigest()), fn)
+        return res, used_tokens, shared
 
     def encode(self, texts: list, batch_size=32):
-        emd, used_tokens = self.mdl.encode(texts, batch_size)
-        if not TenantLLMService.increase_usage(
+        TENANT_LIMITER.throttle("embedding", self.tenant_id, 0)
+        emd, used_tokens, shared = self._shared("encode", texts, lambda: self.mdl.encode(texts, batch_size))
+        if not shared:
+            TENANT_LIMITER.charge("embedding", self.tenant_id, used_tokens)
+        if not shared and not TenantLLMService.increase_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             database_logger.error(
                 "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
         return emd, used_tokens
 
     def encode_queries(self, query: str):
-        emd, used_tokens = self.mdl.encode_queries(query)
-        if not TenantLLMService.increase_usage(
+        TENANT_LIMITER.throttle("embedding", self.tenant_id, 0)
+        emd, used_tokens, shared = self._shared("encode_queries", query, lambda: self.mdl.encode_queries(query))
+        if not shared:
+            TENANT_LIMITER.charge("embedding", self.tenant_id, used_tokens)
+        if not shared and not TenantLLMService.increase_usage(
+                self.tenant_id, self.llm_type, used_tokens):
+            database_logger.error(
+                "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
+        return emd, used_tokens
+
+    def encode_queries_batch(self, queries: list):
+        TENANT_LIMITER.throttle("embedding", self.tenant_id, 0)
+        emd, used_tokens, shared = self._shared("encode_queries_batch", queries,
+                                                lambda: self.mdl.encode_queries_batch(queries))
+        if not shared:
+            TENANT_LIMITER.charge("embedding", self.tenant_id, used_tokens)
+        if not shared and not TenantLLMService.increase_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             database_logger.error(
                 "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
         return emd, used_tokens
 
     def similarity(self, query: str, texts: list):
-        sim, used_tokens = self.mdl.similarity(query, texts)
-        if not TenantLLMService.increase_usage(
+        sim, used_tokens, shared = self._shared("similarity", [query, texts],
+                                                lambda: self.mdl.similarity(query, texts))
+        if not shared and not TenantLLMService.increase_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             database_logger.error(
                 "Can't update token usage for {}/RERANK".format(self.tenant_id))
@@ -231,6 +449,15 @@ class LLMBundle(object):
                 "Can't update token usage for {}/CHAT".format(self.tenant_id))
         return txt
 
+    def cached_chat(self, name, version, system, history, gen_conf, ttl=None):
+        """
+        chat() for prompts whose answer only depends on their input. Bump `version` when the template changes.
+        Identical calls in flight at the same time share one request, see RESPONSE_CACHE.
+        """
+        model = "{}/{}".format(type(self.mdl).__name__, getattr(self.mdl, "model_name", self.llm_name))
+        return RESPONSE_CACHE.cached(self.tenant_id, model, name, version, [system, history, gen_conf],
+                                     lambda: self.chat(system, history, gen_conf), ttl)
+
     def chat_streamly(self, system, history, gen_conf):
         for txt in self.mdl.chat_streamly(system, history, gen_conf):
             if isinstance(txt, int):
@@ -27,7 +27,7 @@ from api.db.services.document_service import DocumentService
 from api.utils import current_timestamp, get_uuid
 from deepdoc.parser.excel_parser import RAGFlowExcelParser
 from rag.settings import SVR_QUEUE_NAME
-from rag.utils.minio_conn import MINIO
+from rag.utils.local_cache import LOCAL_CACHE
 from rag.utils.redis_conn import REDIS_CONN
 
 
@@ -71,7 +71,8 @@ class TaskService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def get_ongoing_doc_name(cls):
+    def get_ongoing_doc_name(cls, queued=False):
+        """The (bucket, location) of the documents being parsed, or with `queued` of those still waiting for an executor."""
         with DB.lock("get_task", -1):
             docs = cls.model.select(*[Document.id, Document.kb_id, Document.location, File.parent_id]) \
                 .join(Document, on=(cls.model.doc_id == Document.id)) \
@@ -81,7 +82,7 @@ class TaskService(CommonService):
                     Document.status == StatusEnum.VALID.value,
                     Document.run == TaskStatus.RUNNING.value,
                     ~(Document.type == FileType.VIRTUAL.value),
-                    cls.model.progress < 1,
+                    cls.model.progress == 0 if queued else cls.model.progress < 1,
                     cls.model.create_time >= current_timestamp() - 1000 * 600
                 )
             docs = list(docs.dicts())
@@ -121,6 +122,33 @@ class TaskService(CommonService):
                     cls.model.id == id).execute()
 
 
+def plan_page_ranges(costs, s, e, page_size):
+    """
+    Cut pages [s, e) into task ranges of similar estimated cost.
+    The cost budget of a task is what `page_size` average pages of this document cost,
+    so cheap pages are packed up to twice as many per task and expensive ones get smaller tasks.
+    Falls back to fixed `page_size` ranges if no costs are available.
+    """
+    if len(costs) < e or e - s <= page_size:
+        return [(p, min(p + page_size, e)) for p in range(s, e, page_size)]
+
+    budget = sum(costs[s:e]) / (e - s) * page_size
+    ranges = []
+    p, acc = s, 0
+    for i in range(s, e):
+        acc += costs[i]
+        if i + 1 - p >= 2 * page_size or (acc >= budget and i + 1 > p):
+            ranges.append((p, i + 1))
+            p, acc = i + 1, 0
+    if p < e:
+        # avoid a tiny straggler at the end
+        if ranges and acc < budget / 3 and e - ranges[-1][0] <= 2 * page_size:
+            ranges[-1] = (ranges[-1][0], e)
+        else:
+            ranges.append((p, e))
+    return ranges
+
+
 def queue_tasks(doc, bucket, name):
     def new_task():
         nonlocal doc
@@ -131,7 +159,7 @@ def queue_tasks(doc, bucket, name):
     tsks = []
 
     if doc["type"] == FileType.PDF.value:
-        file_bin = MINIO.get(bucket, name)
+        file_bin = LOCAL_CACHE.get(bucket, name)
         do_layout = doc["parser_config"].get("layout_recognize", True)
         pages = PdfParser.total_page_number(doc["name"], file_bin)
         page_size = doc["parser_config"].get("task_page_size", 12)
@@ -144,18 +172,19 @@ def queue_tasks(doc, bucket, name):
         page_ranges = doc["parser_config"].get("pages")
         if not page_ranges:
             page_ranges = [(1, 100000)]
+        costs = PdfParser.page_costs(doc["name"], file_bin) if page_size < pages else []
         for s, e in page_ranges:
             s -= 1
             s = max(0, s)
             e = min(e - 1, pages)
-            for p in range(s, e, page_size):
+            for p, q in plan_page_ranges(costs, s, e, page_size):
                 task = new_task()
                 task["from_page"] = p
-                task["to_page"] = min(p + page_size, e)
+                task["to_page"] = q
                 tsks.append(task)
 
     elif doc["parser_id"] == "table":
-        file_bin = MINIO.get(bucket, name)
+        file_bin = LOCAL_CACHE.get(bucket, name)
         rn = RAGFlowExcelParser.row_number(
             doc["name"], file_bin)
         for i in range(0, rn, 3000):
@@ -0,0 +1,28 @@
+import threading
+
+import pytest
+
+flask = pytest.importorskip("flask")
+from api.utils.api_utils import stream_response
+
+
+def test_streams_over_the_cap_are_turned_down():
+    app = flask.Flask(__name__)
+    slots = threading.BoundedSemaphore(2)
+
+    def events():
+        yield "data:1\n\n"
+        yield "data:2\n\n"
+
+    with app.test_request_context():
+        streams = [stream_response(events(), slots) for _ in range(2)]
+        assert [r.status_code for r in streams] == [200, 200]
+        assert stream_response(events(), slots).status_code == 503
+
+        # a slot is given back once its response is closed, whether it was sent or not
+        assert b"".join(streams[0].response) == b"data:1\n\ndata:2\n\n"
+        streams[0].close()
+        streams[1].close()
+        resp = stream_response(events(), slots)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/event-stream"
@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import defaultdict
+
+import pytest
+
+llm_service = pytest.importorskip("api.db.services.llm_service")
+TokenUsageBuffer, TenantLLMService = llm_service.TokenUsageBuffer, llm_service.TenantLLMService
+
+
+class FakeRedis(object):
+    """The part of REDIS_CONN the buffer uses, with its Lua scripts run atomically in process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hashes = defaultdict(dict)
+        self.strings = {}
+        self.down = False
+
+    def hincrby(self, key, field, amount):
+        if self.down:
+            return None
+        with self.lock:
+            h = self.hashes[key]
+            h[field] = h.get(field, 0) + amount
+            return h[field]
+
+    def eval(self, script, keys=[], args=[]):
+        if self.down:
+            return None
+        with self.lock:
+            if script == TokenUsageBuffer.ACQUIRE:
+                if keys[0] in self.strings:
+                    return None
+                self.strings[keys[0]] = args[0]
+                return True
+            if script == TokenUsageBuffer.RELEASE:
+                if self.strings.get(keys[0]) != args[0]:
+                    return 0
+                del self.strings[keys[0]]
+                return 1
+            if script == TokenUsageBuffer.CLAIM:
+                if self.strings.get(keys[0]) != args[0]:
+                    return -1
+                field = args[2].decode("utf-8") if isinstance(args[2], bytes) else args[2]
+                return int(self.hashes[keys[1]].pop(field, 0))
+            if script == TokenUsageBuffer.TAKE:
+                if not self.hashes.get(keys[1]) and self.hashes.get(keys[0]):
+                    self.hashes[keys[1]] = self.hashes.pop(keys[0])
+                res = []
+                for k, v in self.hashes.get(keys[1], {}).items():
+                    res.extend([k.encode("utf-8"), str(v).encode("utf-8")])
+                return res
+        raise AssertionError("unexpected script")
+
+
+@pytest.fixture
+def usage(monkeypatch):
+    redis = FakeRedis()
+    applied = defaultdict(int)
+    lock = threading.Lock()
+
+    def apply_usage(tenant_id, llm_type, used_tokens, llm_name=None):
+        time.sleep(0.001)
+        with lock:
+            applied[(tenant_id, llm_type, llm_name)] += used_tokens
+        return 1
+
+    monkeypatch.setattr(llm_service, "REDIS_CONN", redis)
+    monkeypatch.setattr(TenantLLMService, "apply_usage", apply_usage)
+    monkeypatch.setattr(TokenUsageBuffer, "start", lambda self: None)
+    return redis, applied
+
+
+def run_writers(buffers, writers=16, calls=200):
+    expected = defaultdict(int)
+    lock = threading.Lock()
+
+    def write(i):
+        buf = buffers[i % len(buffers)]
+        for j in range(calls):
+            key = ("tenant%d" % (j % 3), "chat", "model%d" % (i % 2))
+            buf.add(key[0], key[1], j + 1, key[2])
+            with lock:
+                expected[key] += j + 1
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+    stop = threading.Event()
+
+    def flush(buf):
+        while not stop.is_set():
+            buf.flush()
+
+    flushers = [threading.Thread(target=flush, args=(b,)) for b in buffers]
+    for t in threads + flushers:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+    for t in flushers:
+        t.join()
+    for b in buffers:
+        b.flush()
+    return expected
+
+
+def test_concurrent_writers_and_flushers(usage):
+    redis, applied = usage
+    # two processes, each with its writers and its flusher
+    expected = run_writers([TokenUsageBuffer(), TokenUsageBuffer()])
+    assert dict(applied) == dict(expected)
+    assert not redis.hashes[TokenUsageBuffer.PENDING]
+    assert not redis.hashes[TokenUsageBuffer.FLUSHING]
+
+
+def test_redis_down_falls_back_to_process(usage):
+    redis, applied = usage
+    redis.down = True
+    buf = TokenUsageBuffer()
+    expected = run_writers([buf])
+    assert dict(applied) == dict(expected)
+
+
+def test_usage_of_a_crashed_process_is_flushed_by_another(usage):
+    redis, applied = usage
+    crashed, survivor = TokenUsageBuffer(), TokenUsageBuffer()
+    crashed.add("tenant", "embedding", 100, None)
+    crashed.add("tenant", "embedding", 23, None)
+    survivor.flush()
+    assert applied[("tenant", "embedding", None)] == 123
+
+
+def test_flusher_losing_its_lock_does_not_count_twice(usage, monkeypatch):
+    redis, applied = usage
+    first, second = TokenUsageBuffer(), TokenUsageBuffer()
+    for i in range(5):
+        first.add("tenant%d" % i, "chat", 10, None)
+
+    apply_usage = TenantLLMService.apply_usage
+    stalled = []
+
+    def stall(tenant_id, llm_type, used_tokens, llm_name=None):
+        n = apply_usage(tenant_id, llm_type, used_tokens, llm_name)
+        if not stalled:
+            # the lock expires during the first update, and another process flushes meanwhile
+            stalled.append(True)
+            with redis.lock:
+                redis.strings.pop(TokenUsageBuffer.LOCK)
+            second.flush()
+        return n
+
+    monkeypatch.setattr(TenantLLMService, "apply_usage", stall)
+    first.flush()
+    assert {k[0]: v for k, v in applied.items()} == {"tenant%d" % i: 10 for i in range(5)}
@@ -14,7 +14,9 @@
 #  limitations under the License.
 #
 import json
+import os
 import random
+import threading
 import time
 from functools import wraps
 from io import BytesIO
@@ -194,6 +196,76 @@ def validate_request(*args, **kwargs):
     return wrapper
 
 
+# Chat streams which may be retrieving and querying the database at the same time.
+CHAT_PREPARE_SLOTS = threading.BoundedSemaphore(int(os.environ.get("CHAT_PREPARE_CONCURRENCY", 32)))
+PREPARING = threading.local()
+
+
+def prepared():
+    """
+    Called by an answer generator once it is done with retrieval and the database and is about to generate.
+    Gives back the slot `bounded_prepare` holds for it on this thread, if any.
+    """
+    release = getattr(PREPARING, "release", None)
+    PREPARING.release = None
+    if release:
+        release()
+
+
+def bounded_prepare(answers, slots=CHAT_PREPARE_SLOTS):
+    """
+    Runs the answer generator holding one of `slots` until it calls `prepared()`, or else until its first event.
+    Retrieval is bounded this way while the generation, which holds no database connection, is not.
+    """
+    slots.acquire()
+    PREPARING.release = slots.release
+    try:
+        first = next(answers)
+    except StopIteration:
+        return
+    finally:
+        prepared()
+    yield first
+    yield from answers
+
+
+# Event streams served at once, each holds a server thread for as long as its answer takes.
+# Over it a stream is turned down with 503 rather than queued, the other endpoints are not held up.
+STREAM_SLOTS = threading.BoundedSemaphore(int(os.environ.get("MAX_STREAMS", 128)))
+
+
+def stream_response(events, slots=STREAM_SLOTS):
+    """The text/event-stream response of the `events` generator, or a 503 when all the stream slots are taken."""
+    if not slots.acquire(blocking=False):
+        resp = get_json_result(retcode=RetCode.SERVER_ERROR, retmsg="Too many concurrent streams, please retry later.")
+        resp.status_code = 503
+        return resp
+    resp = Response(events, mimetype="text/event-stream")
+    # the server closes a response once sent or on disconnect, also when it was never iterated
+    resp.call_on_close(slots.release)
+    resp.headers.add_header("Cache-control", "no-cache")
+    resp.headers.add_header("Connection", "keep-alive")
+    resp.headers.add_header("X-Accel-Buffering", "no")
+    resp.headers.add_header("Content-Type", "text/event-stream; charset=utf-8")
+    return resp
+
+
+def answer_delta(ans, sent):
+    """
+    Payload of a streamed event in delta mode, where `sent` is the answer text the client has so far.
+    While the answer only grows, just the new text goes as "delta" along the other keys of the event;
+    otherwise, e.g. once citations are inserted, the whole "answer" is sent again and replaces it.
+    Returns the payload and the new `sent`.
+    """
+    txt = ans["answer"]
+    if not txt.startswith(sent):
+        return ans, txt
+    res = {k: v for k, v in ans.items() if k != "answer"}
+    res["delta"] = txt[len(sent):]
+    res.setdefault("reference", {})
+    return res, txt
+
+
 def is_localhost(ip):
     return ip in {'127.0.0.1', '::1', '[::1]', 'localhost'}
 
@@ -0,0 +1,64 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+
+from rag.utils import singleton
+from rag.utils.lru_cache import LRUCache
+from rag.utils.redis_conn import REDIS_CONN
+
+
+@singleton
+class AuthCache(object):
+    """
+    What session and API tokens resolve to, for AUTH_CACHE_TTL seconds. Only found entries are cached.
+    An invalidation in one process reaches the others through an epoch in Redis, unless AUTH_CACHE_SHARED=0
+    or Redis is not configured, in which case the other processes serve the old entry for up to the TTL.
+    """
+    EPOCH = "auth_cache_epoch"
+
+    def __init__(self):
+        self.ttl = int(os.environ.get("AUTH_CACHE_TTL", 30))
+        self.shared = os.environ.get("AUTH_CACHE_SHARED", "1" if REDIS_CONN.is_alive() else "0").lower() in ["1", "true"]
+        self.cache = LRUCache(int(os.environ.get("AUTH_CACHE_SIZE", 10000)), self.ttl)
+
+    def epoch(self):
+        if not self.shared:
+            return None
+        return REDIS_CONN.get(self.EPOCH)
+
+    def get(self, kind, key, loader):
+        if not self.ttl or not key:
+            return loader()
+        epoch = self.epoch()
+        hit = self.cache.get((kind, key))
+        if hit is not None and hit[0] == epoch:
+            return hit[1]
+        value = loader()
+        if value:
+            self.cache.put((kind, key), (epoch, value))
+        return value
+
+    def invalidate(self, kind=None, key=None):
+        """Drops the entry of `key`, or everything when no key is given."""
+        if self.shared:
+            REDIS_CONN.incr(self.EPOCH)
+        if key is None:
+            self.cache.clear(None if kind is None else lambda k: k[0] == kind)
+        else:
+            self.cache.pop((kind, key))
+
+
+AUTH_CACHE = AuthCache()
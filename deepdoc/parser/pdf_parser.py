@@ -935,6 +935,51 @@ class RAGFlowPdfParser:
         except Exception as e:
             logging.error(str(e))
 
+    @staticmethod
+    def page_costs(fnm, binary=None):
+        """
+        Cheap per-page cost estimate used to size parsing tasks.
+        Only the raw content streams and image XObjects are inspected, nothing is rendered.
+        A page of plain text costs about 1, scanned pages and table-heavy pages cost more
+        since they go through full OCR recognition and table structure recognition.
+        """
+        costs = []
+        try:
+            pdf = pdf2_read(fnm if not binary else BytesIO(binary))
+            for page in pdf.pages:
+                try:
+                    contents = page.get_contents()
+                    data = contents.get_data() if contents else b""
+                except Exception as e:
+                    data = b""
+                txt_ops = len(re.findall(rb"T[Jj]\b", data))
+                line_ops = len(re.findall(rb"\s(re|l)\s", data))
+                img_px = 0
+                try:
+                    xobjs = page["/Resources"].get("/XObject") or {}
+                    for o in xobjs.values():
+                        o = o.get_object()
+                        if o.get("/Subtype") == "/Image":
+                            img_px += int(o.get("/Width", 0)) * int(o.get("/Height", 0))
+                except Exception as e:
+                    pass
+
+                cost = 1.
+                if txt_ops < 5 and img_px > 250000:
+                    # scanned page: every text box needs recognition
+                    cost += 2.
+                elif img_px > 250000:
+                    cost += .5
+                cost += min(txt_ops / 400., 1.)
+                if line_ops >= 20:
+                    # ruled lines usually mean tables
+                    cost += min(line_ops / 100., 1.5)
+                costs.append(cost)
+        except Exception as e:
+            logging.error(str(e))
+            return []
+        return costs
+
     def __images__(self, fnm, zoomin=3, page_from=0,
                    page_to=299, callback=None):
         self.lefted_chars = []
@@ -78,8 +78,8 @@ class Categorize(Generate, ABC):
         input = self.get_input()
         input = "Question: " + ("; ".join(input["content"]) if "content" in input else "") + "Category: "
         chat_mdl = LLMBundle(self._canvas.get_tenant_id(), LLMType.CHAT, self._param.llm_id)
-        ans = chat_mdl.chat(self._param.get_prompt(), [{"role": "user", "content": input}],
-                            self._param.gen_conf())
+        ans = chat_mdl.cached_chat("categorize", 1, self._param.get_prompt(), [{"role": "user", "content": input}],
+                                   self._param.gen_conf())
         if DEBUG: print(ans, ":::::::::::::::::::::::::::::::::", input)
         for c in self._param.category_description.keys():
             if ans.lower().find(c.lower()) >= 0:
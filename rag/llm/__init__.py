@@ -13,6 +13,7 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import os
 from .embedding_model import *
 from .chat_model import *
 from .cv_model import *
@@ -91,6 +92,12 @@ RerankModel = {
 }
 
 
+if os.environ.get("LOCAL_INFERENCE_ADDRESS"):
+    # one shared copy of the local models, see rag/llm/inference_server.py
+    EmbeddingModel["BAAI"] = LocalServerEmbedding
+    RerankModel["BAAI"] = LocalServerRerank
+
+
 Seq2txtModel = {
     "OpenAI": GPTSeq2txt,
     "Tongyi-Qianwen": QWenSeq2txt,
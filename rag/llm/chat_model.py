@@ -190,6 +190,8 @@ class BaiChuanChat(Base):
 
 
 class QWenChat(Base):
+    _global_key = True
+
     def __init__(self, key, model_name=Generation.Models.qwen_turbo, **kwargs):
         import dashscope
         dashscope.api_key = key
@@ -442,44 +444,54 @@ class LocalAIChat(Base):
 
 
 class LocalLLM(Base):
-    class RPCProxy:
-        def __init__(self, host, port):
-            self.host = host
-            self.port = int(port)
-            self.__conn()
-
-        def __conn(self):
-            from multiprocessing.connection import Client
-            self._connection = Client(
-                (self.host, self.port), authkey=b'infiniflow-token4kevinhu')
-
-        def __getattr__(self, name):
-            import pickle
-
-            def do_rpc(*args, **kwargs):
-                for _ in range(3):
-                    try:
-                        self._connection.send(
-                            pickle.dumps((name, args, kwargs)))
-                        return pickle.loads(self._connection.recv())
-                    except Exception as e:
-                        self.__conn()
-                raise Exception("RPC connection lost!")
-
-            return do_rpc
-
-    def __init__(self, key, model_name="glm-3-turbo"):
-        self.client = LocalLLM.RPCProxy("127.0.0.1", 7860)
+    """Client of rag/llm/rpc_server.py, keeping one connection per thread."""
+
+    def __init__(self, key, model_name="glm-3-turbo", base_url=None):
+        import os
+        import threading
+        from rag.llm.inference_server import address
+        self.address = address(base_url or os.environ.get("LOCAL_LLM_ADDRESS", "127.0.0.1:7860"))
+        self.local = threading.local()
+
+    def _call(self, header):
+        """Yields the replies to `header` up to the final one."""
+        from multiprocessing.connection import Client
+        from rag.llm.inference_server import AUTHKEY, send_message, recv_message
+        for i in range(2):
+            conn = self.local.__dict__.pop("conn", None)
+            reused = conn is not None
+            if not reused:
+                conn = Client(self.address, authkey=AUTHKEY)
+            try:
+                send_message(conn, header)
+                res, _ = recv_message(conn)
+                break
+            except (EOFError, OSError) as e:
+                # stale connection, e.g. the server restarted
+                conn.close()
+                if not reused:
+                    raise e
+        try:
+            while True:
+                if res.get("error"):
+                    raise Exception(res["error"])
+                yield res
+                if res.get("done"):
+                    break
+                res, _ = recv_message(conn)
+        except BaseException as e:
+            # the server is still sending, or stops generating once it notices the closed connection
+            conn.close()
+            raise e
+        self.local.conn = conn
 
     def chat(self, system, history, gen_conf):
         if system:
             history.insert(0, {"role": "system", "content": system})
         try:
-            ans = self.client.chat(
-                history,
-                gen_conf
-            )
-            return ans, num_tokens_from_string(ans)
+            for res in self._call({"op": "chat", "messages": history, "gen_conf": gen_conf}):
+                pass
+            return res["text"], res["tokens"]
         except Exception as e:
             return "**ERROR**: " + str(e), 0
 
@@ -489,9 +501,11 @@ class LocalLLM(Base):
         token_count = 0
         answer = ""
         try:
-            for ans in self.client.chat_streamly(history, gen_conf):
-                answer += ans
-                token_count += 1
+            for res in self._call({"op": "chat_streamly", "messages": history, "gen_conf": gen_conf}):
+                if res.get("done"):
+                    token_count = res["tokens"]
+                    continue
+                answer += res["delta"]
                 yield answer
         except Exception as e:
             yield answer + "\n**ERROR**: " + str(e)
@@ -260,6 +260,8 @@ class AzureGptV4(Base):
 
 
 class QWenCV(Base):
+    _global_key = True
+
     def __init__(self, key, model_name="qwen-vl-chat-v1", lang="Chinese", **kwargs):
         import dashscope
         dashscope.api_key = key
@@ -13,7 +13,11 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
+import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 import  threading
 import requests
@@ -33,16 +37,175 @@ from api.utils.file_utils import get_home_cache_dir
 from rag.utils import num_tokens_from_string, truncate
 import google.generativeai as genai 
 
+def is_rate_limited(e):
+    for o in [e, getattr(e, "response", None)]:
+        if getattr(o, "status_code", None) == 429 or getattr(o, "status", None) == 429:
+            return True
+    return re.search(r"(429|rate.?limit|too many requests|throttl)", str(e), flags=re.IGNORECASE) is not None
+
+
+class Backoff(object):
+    """
+    Shared by the concurrent requests of one model: a rate limit error pauses all of them,
+    the pause doubles on every further error and halves again on success.
+    """
+
+    def __init__(self, base=1., cap=60.):
+        self.base = base
+        self.cap = cap
+        self.delay = 0
+        self.resume_at = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            d = self.resume_at - time.time()
+            if d <= 0:
+                return
+            time.sleep(d)
+
+    def throttled(self):
+        with self.lock:
+            self.delay = min(self.cap, max(self.base, self.delay * 2))
+            self.resume_at = max(self.resume_at, time.time() + self.delay * (1 + random.random() / 5))
+
+    def succeeded(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.base else 0
+
+
 class Base(ABC):
+    # Request limits of the provider, see _batch_encode().
+    _max_batch = 32
+    _max_batch_tokens = None
+    _max_concurrency = 4
+    _max_retries = 6
+    _init_lock = threading.Lock()
+
     def __init__(self, key, model_name):
         pass
 
+    def _lazy(self, name, factory):
+        """The `name` attribute of the model, made by `factory` once. Subclasses do not call Base.__init__."""
+        obj = self.__dict__.get(name)
+        if obj is None:
+            with Base._init_lock:
+                obj = self.__dict__.get(name)
+                if obj is None:
+                    obj = self.__dict__[name] = factory()
+        return obj
+
     def encode(self, texts: list, batch_size=32):
         raise NotImplementedError("Please implement encode method!")
 
     def encode_queries(self, text: str):
         raise NotImplementedError("Please implement encode method!")
 
+    def encode_queries_batch(self, texts: list):
+        """Embeds several queries, in one request where the model allows it. Returns the vectors and the tokens."""
+        res, token_count = [], 0
+        for t in texts:
+            embd, cnt = self.encode_queries(t)
+            res.append(embd)
+            token_count += cnt
+        return np.array(res), token_count
+
+    def _request(self, request, batch):
+        backoff = self._lazy("_backoff", Backoff)
+        for i in range(self._max_retries + 1):
+            backoff.wait()
+            try:
+                r = request(batch)
+                backoff.succeeded()
+                return r
+            except Exception as e:
+                if not is_rate_limited(e) or i == self._max_retries:
+                    raise e
+                backoff.throttled()
+
+    def _batch_encode(self, texts: list, request):
+        """
+        Sends `texts` to the provider in requests that respect its batch size and token limits,
+        up to `_max_concurrency` requests at once, backing off on rate limit errors.
+        `request(batch)` returns (vectors, used_tokens), used_tokens is None if the provider does not report it.
+        """
+        batches, tks, b = [], 0, []
+        for t in texts:
+            n = num_tokens_from_string(t) if self._max_batch_tokens else 0
+            full = len(b) >= self._max_batch or \
+                (self._max_batch_tokens and tks + n > self._max_batch_tokens)
+            if b and full:
+                batches.append(b)
+                b, tks = [], 0
+            b.append(t)
+            tks += n
+        if b:
+            batches.append(b)
+
+        if len(batches) > 1 and self._max_concurrency > 1:
+            with ThreadPoolExecutor(max_workers=min(self._max_concurrency, len(batches))) as executor:
+                results = list(executor.map(lambda b: self._request(request, b), batches))
+        else:
+            results = [self._request(request, b) for b in batches]
+
+        res, token_count = [], 0
+        for b, (vts, c) in zip(batches, results):
+            res.extend(vts)
+            token_count += c if c is not None else sum([num_tokens_from_string(t) for t in b])
+        return np.array(res), token_count
+
+    def _post(self, url, headers, payload):
+        session = self._lazy("_session", requests.Session)
+        res = session.post(url, headers=headers, json=payload)
+        res.raise_for_status()
+        return res.json()
+
+
+class OnnxEmbedding(object):
+    """
+    ONNX Runtime version of the bge FlagModel: same tokenizer, CLS pooling and normalization,
+    without PyTorch on the inference path.
+    """
+
+    def __init__(self, model_dir, query_instruction_for_retrieval="", threads=0):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        path = os.path.join(model_dir, "onnx", "model.onnx")
+        if not os.path.exists(path):
+            path = os.path.join(model_dir, "model.onnx")
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        # exports differ in which outputs they have and in their order, the pooling needs the token states
+        outputs = [o.name for o in self.session.get_outputs()]
+        names = [n for n in ["last_hidden_state", "token_embeddings"] if n in outputs]
+        if not names:
+            raise Exception("{} has no last_hidden_state output, only: {}".format(path, ", ".join(outputs)))
+        self.output_name = names[0]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.query_instruction_for_retrieval = query_instruction_for_retrieval
+
+    @staticmethod
+    def exists(model_dir):
+        return os.path.exists(os.path.join(model_dir, "onnx", "model.onnx")) or \
+            os.path.exists(os.path.join(model_dir, "model.onnx"))
+
+    def encode(self, texts: list, batch_size=256, max_length=512):
+        res = []
+        for i in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(texts[i:i + batch_size], padding=True, truncation=True,
+                                    max_length=max_length, return_tensors="np")
+            outputs = self.session.run([self.output_name],
+                                       {k: inputs[k].astype(np.int64) for k in self.input_names if k in inputs})
+            embds = outputs[0][:, 0]
+            res.append(embds / np.linalg.norm(embds, axis=-1, keepdims=True))
+        return np.concatenate(res, axis=0)
+
+    def encode_queries(self, queries: list, batch_size=256, max_length=512):
+        return self.encode([self.query_instruction_for_retrieval + q for q in queries], batch_size, max_length)
+
 
 class DefaultEmbedding(Base):
     _model = None
@@ -62,35 +225,81 @@ class DefaultEmbedding(Base):
         if not DefaultEmbedding._model:
             with DefaultEmbedding._model_lock:
                 if not DefaultEmbedding._model:
-                    try:
-                        DefaultEmbedding._model = FlagModel(os.path.join(get_home_cache_dir(), re.sub(r"^[a-zA-Z]+/", "", model_name)),
-                                                            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-                                                            use_fp16=torch.cuda.is_available())
-                    except Exception as e:
-                        model_dir = snapshot_download(repo_id="BAAI/bge-large-zh-v1.5",
-                                                      local_dir=os.path.join(get_home_cache_dir(), re.sub(r"^[a-zA-Z]+/", "", model_name)),
-                                                      local_dir_use_symlinks=False)
-                        DefaultEmbedding._model = FlagModel(model_dir,
-                                                            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-                                                            use_fp16=torch.cuda.is_available())
+                    threads = int(os.environ.get("EMBEDDING_THREADS", 0))
+                    if threads:
+                        torch.set_num_threads(threads)
+                    model_dir = os.path.join(get_home_cache_dir(), re.sub(r"^[a-zA-Z]+/", "", model_name))
+                    if os.environ.get("EMBEDDING_BACKEND", "").lower() == "onnx" and OnnxEmbedding.exists(model_dir):
+                        DefaultEmbedding._model = OnnxEmbedding(model_dir,
+                                                                query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
+                                                                threads=threads)
+                    else:
+                        try:
+                            DefaultEmbedding._model = FlagModel(model_dir,
+                                                                query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
+                                                                use_fp16=torch.cuda.is_available())
+                        except Exception as e:
+                            model_dir = snapshot_download(repo_id="BAAI/bge-large-zh-v1.5",
+                                                          local_dir=model_dir,
+                                                          local_dir_use_symlinks=False)
+                            DefaultEmbedding._model = FlagModel(model_dir,
+                                                                query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
+                                                                use_fp16=torch.cuda.is_available())
         self._model = DefaultEmbedding._model
 
     def encode(self, texts: list, batch_size=32):
         texts = [truncate(t, 2048) for t in texts]
-        token_count = 0
-        for t in texts:
-            token_count += num_tokens_from_string(t)
-        res = []
-        for i in range(0, len(texts), batch_size):
-            res.extend(self._model.encode(texts[i:i + batch_size]).tolist())
+        tks = [num_tokens_from_string(t) for t in texts]
+        token_count = sum(tks)
+        # Batch texts of similar length together so that short ones are not padded to the longest one.
+        order = sorted(range(len(texts)), key=lambda i: tks[i])
+        res = [None] * len(texts)
+        for i in range(0, len(order), batch_size):
+            idx = order[i:i + batch_size]
+            for j, v in zip(idx, self._model.encode([texts[j] for j in idx]).tolist()):
+                res[j] = v
         return np.array(res), token_count
 
     def encode_queries(self, text: str):
         token_count = num_tokens_from_string(text)
         return self._model.encode_queries([text]).tolist()[0], token_count
 
+    def encode_queries_batch(self, texts: list):
+        token_count = sum([num_tokens_from_string(t) for t in texts])
+        return np.array(self._model.encode_queries(texts).tolist()), token_count
+
+
+class LocalServerEmbedding(Base):
+    """Drop-in for DefaultEmbedding that embeds through the shared local inference server."""
+    _client = None
+
+    def __init__(self, key, model_name, **kwargs):
+        from rag.llm.inference_server import InferenceClient
+        if not LocalServerEmbedding._client:
+            LocalServerEmbedding._client = InferenceClient()
+        self.model_name = model_name
+
+    def encode(self, texts: list, batch_size=32):
+        texts = [truncate(t, 2048) for t in texts]
+        token_count = sum([num_tokens_from_string(t) for t in texts])
+        _, embds = LocalServerEmbedding._client.call({"op": "encode", "model": self.model_name, "texts": texts})
+        return embds, token_count
+
+    def encode_queries(self, text: str):
+        _, embds = LocalServerEmbedding._client.call(
+            {"op": "encode_queries", "model": self.model_name, "texts": [text]})
+        return embds[0].tolist(), num_tokens_from_string(text)
+
+    def encode_queries_batch(self, texts: list):
+        _, embds = LocalServerEmbedding._client.call(
+            {"op": "encode_queries", "model": self.model_name, "texts": texts})
+        return embds, sum([num_tokens_from_string(t) for t in texts])
+
 
 class OpenAIEmbed(Base):
+    _max_batch = 2048
+    _max_batch_tokens = 300000
+
     def __init__(self, key, model_name="text-embedding-ada-002",
                  base_url="https://api.openai.com/v1"):
         if not base_url:
@@ -98,17 +307,21 @@ class OpenAIEmbed(Base):
         self.client = OpenAI(api_key=key, base_url=base_url)
         self.model_name = model_name
 
-    def encode(self, texts: list, batch_size=32):
-        texts = [truncate(t, 8196) for t in texts]
+    def _embed(self, texts):
         res = self.client.embeddings.create(input=texts,
                                             model=self.model_name)
-        return np.array([d.embedding for d in res.data]
-                        ), res.usage.total_tokens
+        return [d.embedding for d in res.data], res.usage.total_tokens
+
+    def encode(self, texts: list, batch_size=32):
+        texts = [truncate(t, 8196) for t in texts]
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
-        res = self.client.embeddings.create(input=[truncate(text, 8196)],
-                                            model=self.model_name)
-        return np.array(res.data[0].embedding), res.usage.total_tokens
+        embds, cnt = self._batch_encode([truncate(text, 8196)], self._embed)
+        return np.array(embds[0]), cnt
+
+    def encode_queries_batch(self, texts: list):
+        return self.encode(texts)
 
 
 class LocalAIEmbed(Base):
@@ -119,16 +332,21 @@ class LocalAIEmbed(Base):
         }
         self.model_name = model_name.split("___")[0]
 
-    def encode(self, texts: list, batch_size=None):
+    def _embed(self, texts):
         data = {"model": self.model_name, "input": texts, "encoding_type": "float"}
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = self._post(self.base_url, self.headers, data)
+        return [d["embedding"] for d in res["data"]], res.get("usage", {}).get("total_tokens")
 
-        return np.array([d["embedding"] for d in res["data"]]), 1024
+    def encode(self, texts: list, batch_size=None):
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
         embds, cnt = self.encode([text])
         return np.array(embds[0]), cnt
 
+    def encode_queries_batch(self, texts: list):
+        return self.encode(texts)
+
 class AzureEmbed(OpenAIEmbed):
     def __init__(self, key, model_name, **kwargs):
         self.client = AzureOpenAI(api_key=key, azure_endpoint=kwargs["base_url"], api_version="2024-02-01")
@@ -145,28 +363,30 @@ class BaiChuanEmbed(OpenAIEmbed):
 
 
 class QWenEmbed(Base):
+    _max_batch = 10
+    _global_key = True
+
     def __init__(self, key, model_name="text_embedding_v2", **kwargs):
         dashscope.api_key = key
         self.model_name = model_name
 
+    def _embed(self, texts):
+        resp = dashscope.TextEmbedding.call(
+            model=self.model_name,
+            input=texts,
+            text_type="document"
+        )
+        if resp.get("status_code") == 429:
+            raise Exception("429 " + str(resp.get("message", "")))
+        embds = [[] for _ in range(len(resp["output"]["embeddings"]))]
+        for e in resp["output"]["embeddings"]:
+            embds[e["text_index"]] = e["embedding"]
+        return embds, resp["usage"]["total_tokens"]
+
     def encode(self, texts: list, batch_size=10):
-        import dashscope
         try:
-            res = []
-            token_count = 0
             texts = [truncate(t, 2048) for t in texts]
-            for i in range(0, len(texts), batch_size):
-                resp = dashscope.TextEmbedding.call(
-                    model=self.model_name,
-                    input=texts[i:i + batch_size],
-                    text_type="document"
-                )
-                embds = [[] for _ in range(len(resp["output"]["embeddings"]))]
-                for e in resp["output"]["embeddings"]:
-                    embds[e["text_index"]] = e["embedding"]
-                res.extend(embds)
-                token_count += resp["usage"]["total_tokens"]
-            return np.array(res), token_count
+            return self._batch_encode(texts, self._embed)
         except Exception as e:
             raise Exception("Account abnormal. Please ensure it's on good standing to use QWen's "+self.model_name)
         return np.array([]), 0
@@ -186,45 +406,43 @@ class QWenEmbed(Base):
 
 
 class ZhipuEmbed(Base):
+    _max_batch = 1
+
     def __init__(self, key, model_name="embedding-2", **kwargs):
         self.client = ZhipuAI(api_key=key)
         self.model_name = model_name
 
+    def _embed(self, texts):
+        res = self.client.embeddings.create(input=texts[0],
+                                            model=self.model_name)
+        return [res.data[0].embedding], res.usage.total_tokens
+
     def encode(self, texts: list, batch_size=32):
-        arr = []
-        tks_num = 0
-        for txt in texts:
-            res = self.client.embeddings.create(input=txt,
-                                                model=self.model_name)
-            arr.append(res.data[0].embedding)
-            tks_num += res.usage.total_tokens
-        return np.array(arr), tks_num
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
-        res = self.client.embeddings.create(input=text,
-                                            model=self.model_name)
-        return np.array(res.data[0].embedding), res.usage.total_tokens
+        embds, cnt = self._batch_encode([text], self._embed)
+        return np.array(embds[0]), cnt
 
 
 class OllamaEmbed(Base):
+    _max_batch = 1
+
     def __init__(self, key, model_name, **kwargs):
         self.client = Client(host=kwargs["base_url"])
         self.model_name = model_name
 
+    def _embed(self, texts):
+        res = self.client.embeddings(prompt=texts[0],
+                                     model=self.model_name)
+        return [res["embedding"]], None
+
     def encode(self, texts: list, batch_size=32):
-        arr = []
-        tks_num = 0
-        for txt in texts:
-            res = self.client.embeddings(prompt=txt,
-                                         model=self.model_name)
-            arr.append(res["embedding"])
-            tks_num += 128
-        return np.array(arr), tks_num
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
-        res = self.client.embeddings(prompt=text,
-                                     model=self.model_name)
-        return np.array(res["embedding"]), 128
+        embds, cnt = self._batch_encode([text], self._embed)
+        return np.array(embds[0]), cnt
 
 
 class FastEmbed(Base):
@@ -262,20 +480,23 @@ class FastEmbed(Base):
 
 
 class XinferenceEmbed(Base):
+    _max_batch = 64
+
     def __init__(self, key, model_name="", base_url=""):
         self.client = OpenAI(api_key="xxx", base_url=base_url)
         self.model_name = model_name
 
-    def encode(self, texts: list, batch_size=32):
+    def _embed(self, texts):
         res = self.client.embeddings.create(input=texts,
                                             model=self.model_name)
-        return np.array([d.embedding for d in res.data]
-                        ), res.usage.total_tokens
+        return [d.embedding for d in res.data], res.usage.total_tokens
+
+    def encode(self, texts: list, batch_size=32):
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
-        res = self.client.embeddings.create(input=[text],
-                                            model=self.model_name)
-        return np.array(res.data[0].embedding), res.usage.total_tokens
+        embds, cnt = self._batch_encode([text], self._embed)
+        return np.array(embds[0]), cnt
 
 
 class YoudaoEmbed(Base):
@@ -310,6 +531,9 @@ class YoudaoEmbed(Base):
 
 
 class JinaEmbed(Base):
+    _max_batch = 128
+    _max_batch_tokens = 100000
+
     def __init__(self, key, model_name="jina-embeddings-v2-base-zh",
                  base_url="https://api.jina.ai/v1/embeddings"):
 
@@ -320,15 +544,18 @@ class JinaEmbed(Base):
         }
         self.model_name = model_name
 
-    def encode(self, texts: list, batch_size=None):
-        texts = [truncate(t, 8196) for t in texts]
+    def _embed(self, texts):
         data = {
             "model": self.model_name,
             "input": texts,
             'encoding_type': 'float'
         }
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
-        return np.array([d["embedding"] for d in res["data"]]), res["usage"]["total_tokens"]
+        res = self._post(self.base_url, self.headers, data)
+        return [d["embedding"] for d in res["data"]], res["usage"]["total_tokens"]
+
+    def encode(self, texts: list, batch_size=None):
+        texts = [truncate(t, 8196) for t in texts]
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
         embds, cnt = self.encode([text])
@@ -376,26 +603,32 @@ class InfinityEmbed(Base):
 
 
 class MistralEmbed(Base):
+    _max_batch = 64
+    _max_batch_tokens = 16000
+
     def __init__(self, key, model_name="mistral-embed",
                  base_url=None):
         from mistralai.client import MistralClient
         self.client = MistralClient(api_key=key)
         self.model_name = model_name
 
-    def encode(self, texts: list, batch_size=32):
-        texts = [truncate(t, 8196) for t in texts]
+    def _embed(self, texts):
         res = self.client.embeddings(input=texts,
                                             model=self.model_name)
-        return np.array([d.embedding for d in res.data]
-                        ), res.usage.total_tokens
+        return [d.embedding for d in res.data], res.usage.total_tokens
+
+    def encode(self, texts: list, batch_size=32):
+        texts = [truncate(t, 8196) for t in texts]
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
-        res = self.client.embeddings(input=[truncate(text, 8196)],
-                                            model=self.model_name)
-        return np.array(res.data[0].embedding), res.usage.total_tokens
+        embds, cnt = self._batch_encode([truncate(text, 8196)], self._embed)
+        return np.array(embds[0]), cnt
 
 
 class BedrockEmbed(Base):
+    _max_batch = 1
+
     def __init__(self, key, model_name,
                  **kwargs):
         import boto3
@@ -406,22 +639,19 @@ class BedrockEmbed(Base):
         self.client = boto3.client(service_name='bedrock-runtime', region_name=self.bedrock_region,
                                    aws_access_key_id=self.bedrock_ak, aws_secret_access_key=self.bedrock_sk)
 
-    def encode(self, texts: list, batch_size=32):
-        texts = [truncate(t, 8196) for t in texts]
-        embeddings = []
-        token_count = 0
-        for text in texts:
-            if self.model_name.split('.')[0] == 'amazon':
-                body = {"inputText": text}
-            elif self.model_name.split('.')[0] == 'cohere':
-                body = {"texts": [text], "input_type": 'search_document'}
+    def _embed(self, texts):
+        if self.model_name.split('.')[0] == 'amazon':
+            body = {"inputText": texts[0]}
+        elif self.model_name.split('.')[0] == 'cohere':
+            body = {"texts": [texts[0]], "input_type": 'search_document'}
 
-            response = self.client.invoke_model(modelId=self.model_name, body=json.dumps(body))
-            model_response = json.loads(response["body"].read())
-            embeddings.extend([model_response["embedding"]])
-            token_count += num_tokens_from_string(text)
+        response = self.client.invoke_model(modelId=self.model_name, body=json.dumps(body))
+        model_response = json.loads(response["body"].read())
+        return [model_response["embedding"]], None
 
-        return np.array(embeddings), token_count
+    def encode(self, texts: list, batch_size=32):
+        texts = [truncate(t, 8196) for t in texts]
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
 
@@ -439,20 +669,25 @@ class BedrockEmbed(Base):
         return np.array(embeddings), token_count
 
 class GeminiEmbed(Base):
+    _max_batch = 100
+    _global_key = True
+
     def __init__(self, key, model_name='models/text-embedding-004',
                  **kwargs):
         genai.configure(api_key=key)
         self.model_name = 'models/' + model_name
         
-    def encode(self, texts: list, batch_size=32):
-        texts = [truncate(t, 2048) for t in texts]
-        token_count = sum(num_tokens_from_string(text) for text in texts)
+    def _embed(self, texts):
         result = genai.embed_content(
             model=self.model_name,
             content=texts,
             task_type="retrieval_document",
             title="Embedding of list of strings")
-        return np.array(result['embedding']),token_count
+        return result['embedding'], None
+
+    def encode(self, texts: list, batch_size=32):
+        texts = [truncate(t, 2048) for t in texts]
+        return self._batch_encode(texts, self._embed)
     
     def encode_queries(self, text):
         result = genai.embed_content(
@@ -464,6 +699,8 @@ class GeminiEmbed(Base):
         return np.array(result['embedding']),token_count
 
 class NvidiaEmbed(Base):
+    _max_batch = 50
+
     def __init__(
         self, key, model_name, base_url="https://integrate.api.nvidia.com/v1/embeddings"
     ):
@@ -483,7 +720,7 @@ class NvidiaEmbed(Base):
         if model_name == "snowflake/arctic-embed-l":
             self.base_url = "https://ai.api.nvidia.com/v1/retrieval/snowflake/arctic-embed-l/embeddings"
 
-    def encode(self, texts: list, batch_size=None):
+    def _embed(self, texts):
         payload = {
             "input": texts,
             "input_type": "query",
@@ -491,11 +728,11 @@ class NvidiaEmbed(Base):
             "encoding_format": "float",
             "truncate": "END",
         }
-        res = requests.post(self.base_url, headers=self.headers, json=payload).json()
-        return (
-            np.array([d["embedding"] for d in res["data"]]),
-            res["usage"]["total_tokens"],
-        )
+        res = self._post(self.base_url, self.headers, payload)
+        return [d["embedding"] for d in res["data"]], res["usage"]["total_tokens"]
+
+    def encode(self, texts: list, batch_size=None):
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
         embds, cnt = self.encode([text])
@@ -511,13 +748,14 @@ class LmStudioEmbed(Base):
         self.client = OpenAI(api_key="lm-studio", base_url=self.base_url)
         self.model_name = model_name
 
-    def encode(self, texts: list, batch_size=32):
+    def _embed(self, texts):
         res = self.client.embeddings.create(input=texts, model=self.model_name)
-        return (
-            np.array([d.embedding for d in res.data]),
-            1024,
-        )  # local embedding for LmStudio donot count tokens
+        # local embedding for LmStudio donot count tokens
+        return [d.embedding for d in res.data], None
+
+    def encode(self, texts: list, batch_size=32):
+        return self._batch_encode(texts, self._embed)
 
     def encode_queries(self, text):
-        res = self.client.embeddings.create(text, model=self.model_name)
-        return np.array(res.data[0].embedding), 1024
+        embds, cnt = self._batch_encode([text], self._embed)
+        return np.array(embds[0]), cnt
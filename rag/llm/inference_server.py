@@ -0,0 +1,210 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Local inference server holding the only copy of the BAAI embedding and rerank models of a host.
+Concurrent requests from API servers and task executors are merged into micro-batches.
+
+    python rag/llm/inference_server.py --embedding_model BAAI/bge-large-zh-v1.5 --rerank_model BAAI/bge-reranker-v2-m3
+
+Clients are used instead of DefaultEmbedding/DefaultRerank when LOCAL_INFERENCE_ADDRESS is set.
+Messages are a JSON header optionally followed by raw float32 bytes, nothing is unpickled.
+"""
+import argparse
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+from threading import Thread
+
+import numpy as np
+
+AUTHKEY = os.environ.get("LOCAL_INFERENCE_AUTHKEY", "infiniflow-local-inference").encode("utf-8")
+
+
+def address(addr=None):
+    addr = addr or os.environ.get("LOCAL_INFERENCE_ADDRESS", "/tmp/ragflow_inference.sock")
+    if addr.find(":") > 0 and not addr.startswith("/"):
+        host, port = addr.rsplit(":", 1)
+        return host, int(port)
+    return addr
+
+
+def send_message(conn, header, array=None):
+    if array is not None:
+        array = np.asarray(array, dtype=np.float32)
+        header["shape"] = list(array.shape)
+    conn.send_bytes(json.dumps(header, ensure_ascii=False).encode("utf-8"))
+    if array is not None:
+        conn.send_bytes(array.tobytes())
+
+
+def recv_message(conn):
+    header = json.loads(conn.recv_bytes().decode("utf-8"))
+    array = None
+    if "shape" in header:
+        array = np.frombuffer(conn.recv_bytes(), dtype=np.float32).reshape(header["shape"])
+    return header, array
+
+
+class InferenceClient(object):
+    """One connection per thread, reused across calls."""
+
+    def __init__(self, addr=None):
+        self.address = address(addr)
+        self.local = threading.local()
+
+    def call(self, header):
+        for i in range(2):
+            conn = getattr(self.local, "conn", None)
+            try:
+                if conn is None:
+                    conn = self.local.conn = Client(self.address, authkey=AUTHKEY)
+                send_message(conn, header)
+                res, array = recv_message(conn)
+                if res.get("error"):
+                    raise Exception(res["error"])
+                return res, array
+            except (EOFError, OSError) as e:
+                # stale connection, e.g. the server restarted
+                self.local.conn = None
+                if i:
+                    raise e
+
+
+class MicroBatcher(object):
+    """
+    Collects the items of concurrent requests for up to `max_wait` seconds, or until `max_batch` items,
+    runs `fn` once on all of them and hands every request its slice of the results.
+    """
+
+    def __init__(self, fn, max_batch=64, max_wait=0.01):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        t = Thread(target=self._loop)
+        t.daemon = True
+        t.start()
+
+    def submit(self, items):
+        fut = Future()
+        self.queue.put((items, fut))
+        return fut
+
+    def _loop(self):
+        while True:
+            reqs = [self.queue.get()]
+            n = len(reqs[0][0])
+            deadline = time.time() + self.max_wait
+            while n < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    r = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                reqs.append(r)
+                n += len(r[0])
+
+            try:
+                res = self.fn([it for items, _ in reqs for it in items])
+                i = 0
+                for items, fut in reqs:
+                    fut.set_result(res[i: i + len(items)])
+                    i += len(items)
+            except Exception as e:
+                for _, fut in reqs:
+                    fut.set_exception(e)
+
+
+def model_key(model_name):
+    """The name of a model without its provider, as the model directory is named."""
+    return re.sub(r"^[a-zA-Z]+/", "", model_name or "")
+
+
+class InferenceHandler(object):
+    def __init__(self, embedding_model=None, rerank_model=None, max_batch=64, max_wait=0.01):
+        self.batchers = {}
+        # the model served for each operation, a client configured for another one is turned down
+        self.models = {}
+        if embedding_model:
+            self.models["encode"] = self.models["encode_queries"] = embedding_model
+            from rag.llm.embedding_model import DefaultEmbedding
+            embd = DefaultEmbedding("", embedding_model)
+            self.batchers["encode"] = MicroBatcher(
+                lambda texts: embd.encode(texts, batch_size=max_batch)[0], max_batch, max_wait)
+            self.batchers["encode_queries"] = MicroBatcher(
+                lambda texts: np.array(embd._model.encode_queries(texts)), max_batch, max_wait)
+        if rerank_model:
+            self.models["similarity"] = rerank_model
+            from rag.llm.rerank_model import DefaultRerank
+            rerank = DefaultRerank("", rerank_model)
+            self.batchers["similarity"] = MicroBatcher(rerank.compute_score, max_batch, max_wait)
+
+    def handle(self, header):
+        op = header.get("op")
+        if op not in self.batchers:
+            raise Exception("Operation '{}' is not served.".format(op))
+        if model_key(header.get("model")) != model_key(self.models[op]):
+            raise Exception("Model '{}' is not served, '{}' is.".format(header.get("model"), self.models[op]))
+        if op == "similarity":
+            items = [(header["query"], t) for t in header["texts"]]
+        else:
+            items = header["texts"]
+        return np.array(self.batchers[op].submit(items).result())
+
+    def handle_connection(self, connection):
+        try:
+            while True:
+                header, _ = recv_message(connection)
+                try:
+                    send_message(connection, {}, self.handle(header))
+                except Exception as e:
+                    send_message(connection, {"error": str(e)})
+        except (EOFError, OSError):
+            pass
+
+
+def serve(handler, addr):
+    if isinstance(addr, str) and os.path.exists(addr):
+        os.remove(addr)
+    sock = Listener(addr, authkey=AUTHKEY)
+    while True:
+        try:
+            client = sock.accept()
+            t = Thread(target=handler.handle_connection, args=(client,))
+            t.daemon = True
+            t.start()
+        except Exception as e:
+            print("【EXCEPTION】:", str(e))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embedding_model", type=str, default="BAAI/bge-large-zh-v1.5", help="Embedding model name")
+    parser.add_argument("--rerank_model", type=str, default="", help="Rerank model name")
+    parser.add_argument("--address", type=str, default="", help="Unix socket path or host:port")
+    parser.add_argument("--max_batch", type=int, default=64, help="Max items of a micro-batch")
+    parser.add_argument("--max_wait_ms", type=int, default=10, help="Max time to wait for a micro-batch to fill")
+    args = parser.parse_args()
+
+    serve(InferenceHandler(args.embedding_model, args.rerank_model, args.max_batch, args.max_wait_ms / 1000.),
+          address(args.address))
@@ -64,19 +64,52 @@ class DefaultRerank(Base):
                         DefaultRerank._model = FlagReranker(model_dir, use_fp16=torch.cuda.is_available())
         self._model = DefaultRerank._model
 
+    def compute_score(self, pairs: list, max_batch_tokens=16384):
+        """
+        Scores pairs sorted by length, so each batch is padded only to its own longest pair,
+        with as many pairs per batch as fit in `max_batch_tokens` padded tokens.
+        """
+        lens = [num_tokens_from_string(q) + num_tokens_from_string(t) for q, t in pairs]
+        order = sorted(range(len(pairs)), key=lambda i: lens[i])
+        res = [0.] * len(pairs)
+        i = 0
+        while i < len(order):
+            j = i + 1
+            while j < len(order) and (j + 1 - i) * min(2048, lens[order[j]]) <= max_batch_tokens:
+                j += 1
+            idx = order[i:j]
+            scores = self._model.compute_score([pairs[k] for k in idx], max_length=2048)
+            scores = sigmoid(np.array(scores)).tolist()
+            if isinstance(scores, float): scores = [scores]
+            for k, s in zip(idx, scores):
+                res[k] = s
+            i = j
+        return res
+
     def similarity(self, query: str, texts: list):
         pairs = [(query,truncate(t, 2048)) for t in texts]
         token_count = 0
         for _, t in pairs:
             token_count += num_tokens_from_string(t)
-        batch_size = 4096
-        res = []
-        for i in range(0, len(pairs), batch_size):
-            scores = self._model.compute_score(pairs[i:i + batch_size], max_length=2048)
-            scores = sigmoid(np.array(scores)).tolist()
-            if isinstance(scores, float): res.append(scores)
-            else:  res.extend(scores)
-        return np.array(res), token_count
+        return np.array(self.compute_score(pairs)), token_count
+
+
+class LocalServerRerank(Base):
+    """Drop-in for DefaultRerank that scores through the shared local inference server."""
+    _client = None
+
+    def __init__(self, key, model_name, **kwargs):
+        from rag.llm.inference_server import InferenceClient
+        if not LocalServerRerank._client:
+            LocalServerRerank._client = InferenceClient()
+        self.model_name = model_name
+
+    def similarity(self, query: str, texts: list):
+        texts = [truncate(t, 2048) for t in texts]
+        token_count = sum([num_tokens_from_string(t) for t in texts])
+        _, scores = LocalServerRerank._client.call(
+            {"op": "similarity", "model": self.model_name, "query": query, "texts": texts})
+        return np.array(scores), token_count
 
 
 class JinaRerank(Base):
@@ -13,15 +13,25 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+"""
+Local generation server behind LocalLLM.
 
+    python rag/llm/rpc_server.py --model_name Qwen/Qwen2-1.5B-Instruct --port 7860
+
+Concurrent requests are batched at the token level: a sequence joins the running batch right after its
+prefill and leaves it as soon as it finishes, so nobody waits for the longest answer of the batch.
+Tokens are streamed back as they are generated. Once `max_queue` requests are waiting, new ones are
+refused after `queue_timeout` seconds. Messages use the JSON framing of rag/llm/inference_server.py.
+"""
 import argparse
-import pickle
-import random
-import time
-from copy import deepcopy
-from multiprocessing.connection import Listener
+import queue
 from threading import Thread
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextStreamer
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from rag.llm.inference_server import address, send_message, recv_message, serve
 
 
 def torch_gc():
@@ -41,107 +51,201 @@ def torch_gc():
         pass
 
 
-class RPCHandler:
-    def __init__(self):
-        self._functions = {}
+def left_pad(t, n):
+    return F.pad(t, (0, 0, n, 0)) if n > 0 else t
 
-    def register_function(self, func):
-        self._functions[func.__name__] = func
 
-    def handle_connection(self, connection):
+def legacy_cache(past):
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+def model_cache(past):
+    try:
+        from transformers import DynamicCache
+        return DynamicCache.from_legacy_cache(tuple(past))
+    except ImportError:
+        return tuple(past)
+
+
+class Sequence(object):
+    def __init__(self, prompt_ids, gen_conf):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = int(gen_conf.get("max_tokens", 256))
+        self.temperature = float(gen_conf.get("temperature", 0.1))
+        self.top_p = float(gen_conf.get("top_p", 1.))
+        self.tokens = []
+        # tokens in the cache
+        self.length = len(prompt_ids)
+        self.text = ""
+        self.out = queue.Queue()
+        self.finished = False
+        self.cancelled = False
+
+
+class GenerationEngine(object):
+    def __init__(self, model, tokenizer, max_batch=8, max_queue=64, queue_timeout=30):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.queue_timeout = queue_timeout
+        self.waiting = queue.Queue(maxsize=max_queue)
+        # the running sequences, in the order of the rows of `past`
+        self.running = []
+        # per layer (key, value) of the running sequences, [batch, heads, length, dim], left padded
+        self.past = None
+        self.length = 0
+        eos = model.generation_config.eos_token_id
+        self.eos = set(eos if isinstance(eos, list) else [eos]) | {tokenizer.eos_token_id}
+        t = Thread(target=self._loop)
+        t.daemon = True
+        t.start()
+
+    def submit(self, messages, gen_conf):
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        seq = Sequence(self.tokenizer(text)["input_ids"], gen_conf)
         try:
-            while True:
-                # Receive a message
-                func_name, args, kwargs = pickle.loads(connection.recv())
-                # Run the RPC and send a response
-                try:
-                    r = self._functions[func_name](*args, **kwargs)
-                    connection.send(pickle.dumps(r))
-                except Exception as e:
-                    connection.send(pickle.dumps(e))
-        except EOFError:
-            pass
+            self.waiting.put(seq, timeout=self.queue_timeout)
+        except queue.Full:
+            raise Exception("Server busy: {} requests are waiting.".format(self.waiting.qsize()))
+        return seq
 
+    def _loop(self):
+        while True:
+            if not self.running:
+                torch_gc()
+                self._admit(self.waiting.get())
+            while len(self.running) < self.max_batch:
+                try:
+                    self._admit(self.waiting.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._step()
+            except Exception as e:
+                for seq in self.running:
+                    seq.out.put({"error": str(e)})
+                self.running, self.past, self.length = [], None, 0
 
-def rpc_server(hdlr, address, authkey):
-    sock = Listener(address, authkey=authkey)
-    while True:
+    @torch.no_grad()
+    def _admit(self, seq):
+        if seq.cancelled:
+            return
         try:
-            client = sock.accept()
-            t = Thread(target=hdlr.handle_connection, args=(client,))
-            t.daemon = True
-            t.start()
+            out = self.model(input_ids=torch.tensor([seq.prompt_ids], device=self.model.device), use_cache=True)
+            past = legacy_cache(out.past_key_values)
+            self._emit(seq, out.logits[0, -1])
         except Exception as e:
-            print("【EXCEPTION】:", str(e))
+            seq.out.put({"error": str(e)})
+            return
+        if not seq.finished:
+            self._join(seq, past)
 
+    def _join(self, seq, past):
+        """Adds the cache of a prefilled sequence to the batch, left padding the shorter of the two."""
+        if not self.running:
+            self.past, self.length = tuple(past), seq.length
+        else:
+            L = max(self.length, seq.length)
+            self.past = tuple([(torch.cat([left_pad(bk, L - self.length), left_pad(k, L - seq.length)]),
+                                torch.cat([left_pad(bv, L - self.length), left_pad(v, L - seq.length)]))
+                               for (bk, bv), (k, v) in zip(self.past, past)])
+            self.length = L
+        self.running.append(seq)
 
-models = []
-tokenizer = None
+    def _leave(self):
+        """Drops the rows of the finished and cancelled sequences, and the padding nobody needs anymore."""
+        keep = [i for i, s in enumerate(self.running) if not s.finished and not s.cancelled]
+        if len(keep) == len(self.running):
+            return
+        self.running = [self.running[i] for i in keep]
+        if not self.running:
+            self.past, self.length = None, 0
+            return
+        idx = torch.tensor(keep, device=self.past[0][0].device)
+        L = max([s.length for s in self.running])
+        cut = self.length - L
+        self.past = tuple([(k.index_select(0, idx)[:, :, cut:], v.index_select(0, idx)[:, :, cut:])
+                           for k, v in self.past])
+        self.length = L
 
+    @torch.no_grad()
+    def _step(self):
+        """
+        One decoding step for all the running sequences on the batched cache. The cache is only re-padded
+        when a sequence joins or leaves, not at every step.
+        """
+        self._leave()
+        seqs = self.running
+        if not seqs:
+            return
+        device = self.model.device
+        mask = torch.zeros((len(seqs), self.length + 1), dtype=torch.long, device=device)
+        for i, s in enumerate(seqs):
+            mask[i, self.length - s.length:] = 1
 
-def chat(messages, gen_conf):
-    global tokenizer
-    model = Model()
-    try:
-        torch_gc()
-        conf = {
-            "max_new_tokens": int(
-                gen_conf.get(
-                    "max_tokens", 256)), "temperature": float(
-                gen_conf.get(
-                    "temperature", 0.1))}
-        print(messages, conf)
-        text = tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
-
-        generated_ids = model.generate(
-            model_inputs.input_ids,
-            **conf
-        )
-        generated_ids = [
-            output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-
-        return tokenizer.batch_decode(
-            generated_ids, skip_special_tokens=True)[0]
-    except Exception as e:
-        return str(e)
-
-
-def chat_streamly(messages, gen_conf):
-    global tokenizer
-    model = Model()
-    try:
-        torch_gc()
-        conf = deepcopy(gen_conf)
-        print(messages, conf)
-        text = tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
-        streamer = TextStreamer(tokenizer)
-        conf["inputs"] = model_inputs.input_ids
-        conf["streamer"] = streamer
-        conf["max_new_tokens"] = conf["max_tokens"]
-        del conf["max_tokens"]
-        thread = Thread(target=model.generate, kwargs=conf)
-        thread.start()
-        for _, new_text in enumerate(streamer):
-            yield new_text
-    except Exception as e:
-        yield "**ERROR**: " + str(e)
-
-
-def Model():
-    global models
-    random.seed(time.time())
-    return random.choice(models)
+        out = self.model(input_ids=torch.tensor([[s.tokens[-1]] for s in seqs], device=device),
+                         position_ids=torch.tensor([[s.length] for s in seqs], device=device),
+                         attention_mask=mask, past_key_values=model_cache(self.past), use_cache=True)
+        self.past = tuple(legacy_cache(out.past_key_values))
+        self.length += 1
+        for i, s in enumerate(seqs):
+            s.length += 1
+            self._emit(s, out.logits[i, -1])
+
+    def _sample(self, seq, logits):
+        if seq.temperature <= 0:
+            return int(torch.argmax(logits))
+        probs = torch.softmax(logits.float() / seq.temperature, dim=-1)
+        if seq.top_p < 1:
+            p, idx = torch.sort(probs, descending=True)
+            p[torch.cumsum(p, dim=-1) - p > seq.top_p] = 0
+            probs = torch.zeros_like(probs).scatter_(0, idx, p)
+        return int(torch.multinomial(probs, 1))
+
+    def _emit(self, seq, logits):
+        token = self._sample(seq, logits)
+        seq.tokens.append(token)
+        seq.finished = token in self.eos or len(seq.tokens) >= seq.max_new_tokens
+        text = self.tokenizer.decode(seq.tokens, skip_special_tokens=True)
+        # hold back incomplete multi-byte characters
+        if len(text) > len(seq.text) and (seq.finished or not text.endswith("�")):
+            seq.out.put({"delta": text[len(seq.text):]})
+            seq.text = text
+        if seq.finished:
+            seq.out.put({"done": True, "tokens": len(seq.tokens)})
+
+
+class GenerationHandler(object):
+    def __init__(self, engine):
+        self.engine = engine
+
+    def handle_connection(self, connection):
+        try:
+            while True:
+                header, _ = recv_message(connection)
+                try:
+                    seq = self.engine.submit(header["messages"], header.get("gen_conf", {}))
+                except Exception as e:
+                    send_message(connection, {"error": str(e)})
+                    continue
+                streamly = header.get("op") == "chat_streamly"
+                try:
+                    answer = ""
+                    while True:
+                        msg = seq.out.get()
+                        if "delta" in msg and not streamly:
+                            answer += msg["delta"]
+                            continue
+                        if msg.get("done") and not streamly:
+                            msg["text"] = answer
+                        send_message(connection, msg)
+                        if "delta" not in msg:
+                            break
+                finally:
+                    # stops the generation if the client went away
+                    seq.cancelled = True
+        except (EOFError, OSError):
+            pass
 
 
 if __name__ == "__main__":
@@ -152,20 +256,17 @@ if __name__ == "__main__":
         default=7860,
         type=int,
         help="RPC serving port")
+    parser.add_argument("--max_batch", type=int, default=8, help="Max sequences decoded together")
+    parser.add_argument("--max_queue", type=int, default=64, help="Max requests waiting for a slot")
+    parser.add_argument("--queue_timeout", type=int, default=30, help="Seconds a request waits to be queued")
     args = parser.parse_args()
 
-    handler = RPCHandler()
-    handler.register_function(chat)
-    handler.register_function(chat_streamly)
-
-    models = []
-    for _ in range(1):
-        m = AutoModelForCausalLM.from_pretrained(args.model_name,
+    model = AutoModelForCausalLM.from_pretrained(args.model_name,
                                                  device_map="auto",
                                                  torch_dtype='auto')
-        models.append(m)
+    model.eval()
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
 
     # Run the server
-    rpc_server(handler, ('0.0.0.0', args.port),
-               authkey=b'infiniflow-token4kevinhu')
+    serve(GenerationHandler(GenerationEngine(model, tokenizer, args.max_batch, args.max_queue, args.queue_timeout)),
+          address("0.0.0.0:{}".format(args.port)))
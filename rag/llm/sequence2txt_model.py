@@ -45,6 +45,8 @@ class GPTSeq2txt(Base):
 
 
 class QWenSeq2txt(Base):
+    _global_key = True
+
     def __init__(self, key, model_name="paraformer-realtime-8k-v1", **kwargs):
         import dashscope
         dashscope.api_key = key
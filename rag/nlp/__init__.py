@@ -587,6 +587,10 @@ You're a question analyzer.
 Answer format: (in language of user's question)
  - keyword: 
 """
-    kwd = chat_mdl.chat(prompt, [{"role": "user",  "content": content}], {"temperature": 0.2})
+    if hasattr(chat_mdl, "cached_chat"):
+        kwd = chat_mdl.cached_chat("keyword_extraction", 1, prompt, [{"role": "user", "content": content}],
+                                   {"temperature": 0.2})
+    else:
+        kwd = chat_mdl.chat(prompt, [{"role": "user",  "content": content}], {"temperature": 0.2})
     if isinstance(kwd, tuple): return kwd[0]
     return kwd
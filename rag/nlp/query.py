@@ -159,19 +159,19 @@ class EsQueryer:
         return np.array(sims[0]) * vtweight + \
             np.array(tksim) * tkweight, tksim, sims[0]
 
+    def term_weights(self, tks):
+        d = {}
+        if isinstance(tks, str):
+            tks = tks.split(" ")
+        for t, c in self.tw.weights(tks):
+            if t not in d:
+                d[t] = 0
+            d[t] += c
+        return d
+
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
-            d = {}
-            if isinstance(tks, str):
-                tks = tks.split(" ")
-            for t, c in self.tw.weights(tks):
-                if t not in d:
-                    d[t] = 0
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
+        atks = self.term_weights(atks)
+        btkss = [self.term_weights(tks) for tks in btkss]
         return [self.similarity(atks, btks) for btks in btkss]
 
     def similarity(self, qtwt, dtwt):
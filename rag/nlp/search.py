@@ -15,7 +15,9 @@
 #
 
 import json
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from elasticsearch_dsl import Q, Search
@@ -24,6 +26,8 @@ from dataclasses import dataclass
 
 from rag.settings import es_logger
 from rag.utils import rmSpace
+from rag.utils.lru_cache import LRUCache
+from rag.utils.tenant_limiter import TENANT_LIMITER, QUEUE_TIMEOUT
 from rag.nlp import rag_tokenizer, query
 import numpy as np
 
@@ -31,6 +35,16 @@ import numpy as np
 def index_name(uid): return f"ragflow_{uid}"
 
 
+# Only this many candidates, best by hybrid similarity, are sent to the rerank model.
+RERANK_TOP_M = int(os.environ.get("RERANK_TOP_M", 64))
+# With a deadline, rerank is skipped when less than this is left, and top-k is reduced below that.
+RERANK_MIN_SECONDS = float(os.environ.get("DEADLINE_RERANK_MIN_SECONDS", 2))
+REDUCE_TOPK_SECONDS = float(os.environ.get("DEADLINE_REDUCE_TOPK_SECONDS", 5))
+REDUCED_TOPK = int(os.environ.get("DEADLINE_REDUCED_TOPK", 256))
+# Runs the searches of the variants of a question concurrently.
+FANOUT_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("RETRIEVAL_FANOUT_WORKERS", 16)))
+
+
 class Dealer:
     def __init__(self, es):
         self.qryr = query.EsQueryer(es)
@@ -42,6 +56,9 @@ class Dealer:
             "content_ltks^2",
             "content_sm_ltks"]
         self.es = es
+        self.rerank_cache = LRUCache(int(os.environ.get("RERANK_CACHE_SIZE", 100000)), ttl=600)
+        # term weights of the chunks cited from, the same chunks are retrieved over and over
+        self.citation_weights = LRUCache(4096, ttl=600)
 
     @dataclass
     class SearchResult:
@@ -54,8 +71,9 @@ class Dealer:
         keywords: Optional[List[str]] = None
         group_docs: List[List] = None
 
-    def _vector(self, txt, emb_mdl, sim=0.8, topk=10):
-        qv, c = emb_mdl.encode_queries(txt)
+    def _vector(self, txt, emb_mdl, sim=0.8, topk=10, qv=None):
+        if qv is None:
+            qv, c = emb_mdl.encode_queries(txt)
         return {
             "field": "q_%d_vec" % len(qv),
             "k": topk,
@@ -127,13 +145,13 @@ class Dealer:
             assert emb_mdl, "No embedding model selected"
             s["knn"] = self._vector(
                 qst, emb_mdl, req.get(
-                    "similarity", 0.1), topk)
+                    "similarity", 0.1), topk, req.get("query_vector"))
             s["knn"]["filter"] = bqry.to_dict()
             if "highlight" in s:
                 del s["highlight"]
             q_vec = s["knn"]["query_vector"]
         es_logger.info("【Q】: {}".format(json.dumps(s)))
-        res = self.es.search(deepcopy(s), idxnm=idxnm, timeout="600s", src=src)
+        res = self.es.search(deepcopy(s), idxnm=idxnm, timeout=req.get("timeout", "600s"), src=src)
         es_logger.info("TOTAL: {}".format(self.es.getTotal(res)))
         if self.es.getTotal(res) == 0 and "knn" in s:
             bqry, _ = self.qryr.question(qst, min_match="10%")
@@ -141,7 +159,7 @@ class Dealer:
             s["query"] = bqry.to_dict()
             s["knn"]["filter"] = bqry.to_dict()
             s["knn"]["similarity"] = 0.17
-            res = self.es.search(s, idxnm=idxnm, timeout="600s", src=src)
+            res = self.es.search(s, idxnm=idxnm, timeout=req.get("timeout", "600s"), src=src)
             es_logger.info("【Q】: {}".format(json.dumps(s)))
 
         kwds = set([])
@@ -218,9 +236,35 @@ class Dealer:
     def trans2floats(txt):
         return [float(t) for t in txt.split("\t")]
 
-    def insert_citations(self, answer, chunks, chunk_v,
-                         embd_mdl, tkweight=0.1, vtweight=0.9):
-        assert len(chunks) == len(chunk_v)
+    def chunk_weights(self, ck):
+        tw = self.citation_weights.get(ck)
+        if tw is None:
+            tw = self.qryr.term_weights(rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split(" "))
+            self.citation_weights.put(ck, tw)
+        return tw
+
+    def citation_similarity(self, pieces, chunks, chunk_v, embd_mdl, tkweight=0.1, vtweight=0.9, sim_cache=None):
+        """
+        Rows of the piece by chunk hybrid similarity matrix. Rows already in `sim_cache`, which belongs to
+        one set of chunks, are reused, so that the pieces of a streamed answer can be scored as they come.
+        """
+        from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
+        sim_cache = {} if sim_cache is None else sim_cache
+        todo = [p for p in dict.fromkeys(pieces) if p not in sim_cache]
+        if todo:
+            ans_v, _ = embd_mdl.encode(todo)
+            assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(
+                len(ans_v[0]), len(chunk_v[0]))
+            chunks_tw = [self.chunk_weights(ck) for ck in chunks]
+            vtsim = CosineSimilarity(ans_v, chunk_v)
+            for p, vs in zip(todo, vtsim):
+                tw = self.qryr.term_weights(rag_tokenizer.tokenize(self.qryr.rmWWW(p)).split(" "))
+                tksim = [self.qryr.similarity(tw, ctw) for ctw in chunks_tw]
+                sim_cache[p] = np.array(vs) * vtweight + np.array(tksim) * tkweight
+        return np.array([sim_cache[p] for p in pieces])
+
+    @staticmethod
+    def answer_pieces(answer):
         pieces = re.split(r"(```)", answer)
         if len(pieces) >= 3:
             i = 0
@@ -247,6 +291,12 @@ class Dealer:
             if re.match(r"([^\|][；。？!！\n]|[a-z][.?;!][ \n])", pieces[i]):
                 pieces[i - 1] += pieces[i][0]
                 pieces[i] = pieces[i][1:]
+        return pieces
+
+    def insert_citations(self, answer, chunks, chunk_v,
+                         embd_mdl, tkweight=0.1, vtweight=0.9, sim_cache=None):
+        assert len(chunks) == len(chunk_v)
+        pieces = self.answer_pieces(answer)
         idx = []
         pieces_ = []
         for i, t in enumerate(pieces):
@@ -255,31 +305,20 @@ class Dealer:
             idx.append(i)
             pieces_.append(t)
         es_logger.info("{} => {}".format(answer, pieces_))
-        if not pieces_:
+        if not pieces_ or not chunks:
             return answer, set([])
 
-        ans_v, _ = embd_mdl.encode(pieces_)
-        assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(
-            len(ans_v[0]), len(chunk_v[0]))
-
-        chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split(" ")
-                      for ck in chunks]
+        # the similarities do not depend on the threshold, only the sweep does
+        sims = self.citation_similarity(pieces_, chunks, chunk_v, embd_mdl, tkweight, vtweight, sim_cache)
+        mxs = np.max(sims, axis=1) * 0.99
         cites = {}
         thr = 0.63
-        while thr>0.3 and len(cites.keys()) == 0 and pieces_ and chunks_tks:
-            for i, a in enumerate(pieces_):
-                sim, tksim, vtsim = self.qryr.hybrid_similarity(ans_v[i],
-                                                                chunk_v,
-                                                                rag_tokenizer.tokenize(
-                                                                    self.qryr.rmWWW(pieces_[i])).split(" "),
-                                                                chunks_tks,
-                                                                tkweight, vtweight)
-                mx = np.max(sim) * 0.99
-                es_logger.info("{} SIM: {}".format(pieces_[i], mx))
+        while thr>0.3 and len(cites.keys()) == 0:
+            for i, mx in enumerate(mxs):
                 if mx < thr:
                     continue
                 cites[idx[i]] = list(
-                    set([str(ii) for ii in range(len(chunk_v)) if sim[ii] > mx]))[:4]
+                    set([str(ii) for ii in range(len(chunk_v)) if sims[i][ii] > mx]))[:4]
             thr *= 0.8
 
         res = ""
@@ -327,7 +366,7 @@ class Dealer:
         return sim, tksim, vtsim
 
     def rerank_by_model(self, rerank_mdl, sres, query, tkweight=0.3,
-               vtweight=0.7, cfield="content_ltks"):
+               vtweight=0.7, cfield="content_ltks", deadline=None):
         _, keywords = self.qryr.question(query)
 
         for i in sres.ids:
@@ -342,7 +381,38 @@ class Dealer:
             ins_tw.append(tks)
 
         tksim = self.qryr.token_similarity(keywords, ins_tw)
-        vtsim,_ = rerank_mdl.similarity(" ".join(keywords), [rmSpace(" ".join(tks)) for tks in ins_tw])
+        qst = " ".join(keywords)
+
+        # Cascade: the cheap hybrid similarity picks the candidates worth a cross-encoder pass,
+        # the others keep a model score of 0 and therefore rank behind them.
+        cands = list(range(len(sres.ids)))
+        if len(cands) > RERANK_TOP_M and sres.query_vector:
+            sim, _, _ = self.rerank(sres, query, tkweight, vtweight, cfield)
+            cands = list(np.argsort(np.array(sim) * -1)[:RERANK_TOP_M])
+
+        vtsim = np.zeros(len(sres.ids))
+        mdl = getattr(rerank_mdl, "mdl", rerank_mdl)
+        mdl_nm = "{}/{}".format(type(mdl).__name__, getattr(mdl, "model_name", ""))
+        todo = []
+        for i in cands:
+            s = self.rerank_cache.get((mdl_nm, qst, sres.ids[i]))
+            if s is None:
+                todo.append(i)
+            else:
+                vtsim[i] = s
+        if todo:
+            texts = [rmSpace(" ".join(ins_tw[i])) for i in todo]
+            try:
+                scores, _ = deadline.call(rerank_mdl.similarity, qst, texts) if deadline else \
+                    rerank_mdl.similarity(qst, texts)
+            except TimeoutError:
+                if not deadline:
+                    raise
+                deadline.degrade("rerank timed out, ranked by hybrid similarity")
+                return self.rerank(sres, query, tkweight, vtweight, cfield)
+            for i, s in zip(todo, scores):
+                vtsim[i] = s
+                self.rerank_cache.put((mdl_nm, qst, sres.ids[i]), float(s))
 
         return tkweight*np.array(tksim) + vtweight*vtsim, tksim, vtsim
 
@@ -352,29 +422,81 @@ class Dealer:
                                            rag_tokenizer.tokenize(ans).split(" "),
                                            rag_tokenizer.tokenize(inst).split(" "))
 
+    def fuse(self, results, k=60):
+        """
+        Reciprocal rank fusion of the (sres, sim, tsim, vsim) of several searches.
+        A chunk keeps the similarities of the search it matches best.
+        """
+        field, score, best = {}, {}, {}
+        for sres, sim, tsim, vsim in results:
+            field.update(sres.field)
+            for r, i in enumerate(np.argsort(np.array(sim) * -1)):
+                id = sres.ids[i]
+                score[id] = score.get(id, 0) + 1. / (k + r + 1)
+                if id not in best or sim[i] > best[id][0]:
+                    best[id] = (sim[i], tsim[i], vsim[i])
+        ids = list(score.keys())
+        sres = self.SearchResult(total=len(ids), ids=ids, query_vector=results[0][0].query_vector, field=field)
+        sim, tsim, vsim = [np.array([best[id][j] for id in ids]) for j in range(3)]
+        return sres, sim, tsim, vsim, np.argsort(np.array([score[id] for id in ids]) * -1)
+
     def retrieval(self, question, embd_mdl, tenant_id, kb_ids, page, page_size, similarity_threshold=0.2,
-                  vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True, rerank_mdl=None):
+                  vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True, rerank_mdl=None, rrf_k=60,
+                  deadline=None):
+        """
+        `question` may also be a list of variants of a question, e.g. rewrites or sub-questions.
+        They are searched concurrently and their rankings fused before thresholding and paging.
+        With a `deadline`, fewer candidates are fetched and the rerank model is skipped when time runs short.
+        """
         ranks = {"total": 0, "chunks": [], "doc_aggs": {}}
-        if not question:
+        questions = [q for q in (question if isinstance(question, list) else [question]) if q]
+        if not questions:
             return ranks
-        req = {"kb_ids": kb_ids, "doc_ids": doc_ids, "size": page_size,
-               "question": question, "vector": True, "topk": top,
-               "similarity": similarity_threshold,
-               "available_int": 1}
-        sres = self.search(req, index_name(tenant_id), embd_mdl)
-
-        if rerank_mdl:
-            sim, tsim, vsim = self.rerank_by_model(rerank_mdl,
-                sres, question, 1 - vector_similarity_weight, vector_similarity_weight)
+        TENANT_LIMITER.throttle("retrieval", tenant_id, len(questions),
+                                timeout=min(deadline.remaining(), QUEUE_TIMEOUT) if deadline else None)
+        if deadline and not deadline.allows(REDUCE_TOPK_SECONDS) and top > REDUCED_TOPK:
+            top = REDUCED_TOPK
+            deadline.degrade("top_k reduced to {}".format(top))
+        if rerank_mdl and deadline and not deadline.allows(RERANK_MIN_SECONDS):
+            rerank_mdl = None
+            deadline.degrade("rerank skipped, ranked by hybrid similarity")
+
+        # the variants are embedded in one batch rather than by each of their searches
+        vectors = [None] * len(questions)
+        if len(questions) > 1 and hasattr(embd_mdl, "encode_queries_batch"):
+            vectors, _ = embd_mdl.encode_queries_batch(questions)
+
+        def search(question, vector=None):
+            req = {"kb_ids": kb_ids, "doc_ids": doc_ids, "size": page_size,
+                   "question": question, "vector": True, "topk": top,
+                   "similarity": similarity_threshold,
+                   "available_int": 1}
+            if vector is not None:
+                req["query_vector"] = vector
+            if deadline and deadline.at:
+                req["timeout"] = "{}s".format(max(1, int(deadline.remaining())))
+            sres = self.search(req, index_name(tenant_id), embd_mdl)
+
+            if rerank_mdl:
+                sim, tsim, vsim = self.rerank_by_model(rerank_mdl,
+                    sres, question, 1 - vector_similarity_weight, vector_similarity_weight, deadline=deadline)
+            else:
+                sim, tsim, vsim = self.rerank(
+                    sres, question, 1 - vector_similarity_weight, vector_similarity_weight)
+            return sres, sim, tsim, vsim
+
+        if len(questions) == 1:
+            sres, sim, tsim, vsim = search(questions[0])
+            idx = np.argsort(sim * -1)
         else:
-            sim, tsim, vsim = self.rerank(
-                sres, question, 1 - vector_similarity_weight, vector_similarity_weight)
-        idx = np.argsort(sim * -1)
+            sres, sim, tsim, vsim, idx = self.fuse(list(FANOUT_POOL.map(search, questions, vectors)), rrf_k)
 
         dim = len(sres.query_vector)
         start_idx = (page - 1) * page_size
         for i in idx:
             if sim[i] < similarity_threshold:
+                if len(questions) > 1:
+                    continue
                 break
             ranks["total"] += 1
             start_idx -= 1
@@ -13,16 +13,20 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import os
 import re
 import traceback
 from concurrent.futures import ThreadPoolExecutor, ALL_COMPLETED, wait
-from threading import Lock
 from typing import Tuple
 import umap
 import numpy as np
 from sklearn.mixture import GaussianMixture
 
-from rag.utils import num_tokens_from_string, truncate
+from rag.utils import num_tokens_from_string, truncate, encode_unique
+
+
+UMAP_MAX_NEIGHBORS = 100
+UMAP_MAX_SAMPLES = 4096
 
 
 class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
@@ -34,24 +38,70 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         self._prompt = prompt
         self._max_token = max_token
 
-    def _get_optimal_clusters(self, embeddings: np.ndarray, random_state:int):
+    @staticmethod
+    def _fit_gmm(embeddings: np.ndarray, n: int, random_state: int):
+        gm = GaussianMixture(n_components=n, random_state=random_state)
+        gm.fit(embeddings)
+        return gm.bic(embeddings), gm
+
+    def _get_optimal_clusters(self, embeddings: np.ndarray, random_state:int, guess=None):
+        """
+        Returns the cluster number with the lowest BIC together with its fitted model.
+        Instead of fitting every candidate, a coarse grid is fitted in parallel first, or only a window
+        around `guess` when the previous layer gives one, then the search moves a step at a time while a
+        neighbour is better, and every candidate around the best one is fitted last.
+        """
         max_clusters = min(self._max_cluster, len(embeddings))
-        n_clusters = np.arange(1, max_clusters)
-        bics = []
-        for n in n_clusters:
-            gm = GaussianMixture(n_components=n, random_state=random_state)
-            gm.fit(embeddings)
-            bics.append(gm.bic(embeddings))
-        optimal_clusters = n_clusters[np.argmin(bics)]
-        return optimal_clusters
+        candidates = list(range(1, max_clusters))
+        if not candidates:
+            return 1, None
+        fitted = {}
+
+        def evaluate(ns):
+            ns = [n for n in ns if n not in fitted]
+            if not ns:
+                return
+            with ThreadPoolExecutor(max_workers=min(len(ns), os.cpu_count() or 1)) as executor:
+                for n, r in zip(ns, executor.map(lambda n: self._fit_gmm(embeddings, n, random_state), ns)):
+                    fitted[n] = r
+
+        step = max(1, len(candidates) // 8)
+        if guess is None:
+            evaluate(candidates[::step] + [candidates[-1]])
+        else:
+            guess = min(max(1, guess), max_clusters - 1)
+            evaluate([n for n in range(guess - step, guess + step + 1, max(1, step // 2)) if 1 <= n < max_clusters])
+        best = min(fitted, key=lambda n: fitted[n][0])
+        while True:
+            evaluate([n for n in [best - step, best + step] if 1 <= n < max_clusters])
+            n = min(fitted, key=lambda n: fitted[n][0])
+            if n == best:
+                break
+            best = n
+        evaluate([n for n in range(best - step + 1, best + step) if 1 <= n < max_clusters])
+        best = min(fitted, key=lambda n: fitted[n][0])
+        return best, fitted[best][1]
+
+    @staticmethod
+    def _reduce(embeddings, random_state):
+        n_neighbors = min(UMAP_MAX_NEIGHBORS, int((len(embeddings) - 1) ** 0.8))
+        reducer = umap.UMAP(
+            n_neighbors=max(2, n_neighbors), n_components=min(12, len(embeddings)-2), metric="cosine"
+        )
+        if len(embeddings) <= UMAP_MAX_SAMPLES:
+            return reducer.fit_transform(embeddings)
+        # fit on a sample of a large layer and project the rest into it
+        embeddings = np.array(embeddings)
+        idx = np.random.RandomState(random_state).choice(len(embeddings), UMAP_MAX_SAMPLES, replace=False)
+        reducer.fit(embeddings[idx])
+        return reducer.transform(embeddings)
 
     def __call__(self, chunks: Tuple[str, np.ndarray], random_state, callback=None):
         layers = [(0, len(chunks))]
         start, end = 0, len(chunks)
         if len(chunks) <= 1: return
 
-        def summarize(ck_idx, lock):
-            nonlocal chunks
+        def summarize(ck_idx):
             try:
                 texts = [chunks[i][0] for i in ck_idx]
                 len_per_chunk = int((self._llm_model.max_length - self._max_token)/len(texts))
@@ -62,19 +112,27 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                                              )
                 cnt = re.sub("(······\n由于长度的原因，回答被截断了，要继续吗？|For the content length reason, it stopped, continue?)", "", cnt)
                 print("SUM:", cnt)
-                embds, _ = self._embd_model.encode([cnt])
-                with lock:
-                    chunks.append((cnt, embds[0]))
+                return cnt
             except Exception as e:
                 print(e, flush=True)
                 traceback.print_stack(e)
                 return e
 
+        def add_summaries(cnts):
+            nonlocal chunks
+            cnts = [c for c in cnts if isinstance(c, str)]
+            if not cnts:
+                return
+            embds, _ = encode_unique(self._embd_model, cnts)
+            chunks.extend(zip(cnts, embds))
+
         labels = []
+        # clusters per chunk of the previous layer, where the search of the next layer starts from
+        ratio = None
         while end - start > 1:
             embeddings = [embd for _, embd in chunks[start: end]]
             if len(embeddings) == 2:
-                summarize([start, start+1], Lock())
+                add_summaries([summarize([start, start+1])])
                 if callback:
                     callback(msg="Cluster one layer: {} -> {}".format(end-start, len(chunks)-end))
                 labels.extend([0,0])
@@ -83,27 +141,25 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                 end = len(chunks)
                 continue
 
-            n_neighbors = int((len(embeddings) - 1) ** 0.8)
-            reduced_embeddings = umap.UMAP(
-                n_neighbors=max(2, n_neighbors), n_components=min(12, len(embeddings)-2), metric="cosine"
-            ).fit_transform(embeddings)
-            n_clusters = self._get_optimal_clusters(reduced_embeddings, random_state)
+            reduced_embeddings = self._reduce(embeddings, random_state)
+            n_clusters, gm = self._get_optimal_clusters(reduced_embeddings, random_state,
+                                                        round(ratio * len(embeddings)) if ratio else None)
+            ratio = n_clusters / len(embeddings)
             if n_clusters == 1:
                 lbls = [0 for _ in range(len(reduced_embeddings))]
             else:
-                gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
-                gm.fit(reduced_embeddings)
                 probs = gm.predict_proba(reduced_embeddings)
                 lbls = [np.where(prob > self._threshold)[0] for prob in probs]
                 lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
-            lock = Lock()
             with ThreadPoolExecutor(max_workers=12) as executor:
                 threads = []
                 for c in range(n_clusters):
                     ck_idx = [i+start for i in range(len(lbls)) if lbls[i] == c]
-                    threads.append(executor.submit(summarize, ck_idx, lock))
+                    threads.append(executor.submit(summarize, ck_idx))
                 wait(threads, return_when=ALL_COMPLETED)
                 print([t.result() for t in threads])
+            # all summaries of the layer go to the embedding model in full batches
+            add_summaries([t.result() for t in threads])
 
             assert len(chunks) - end == n_clusters, "{} vs. {}".format(len(chunks) - end, n_clusters)
             labels.extend(lbls)
@@ -20,12 +20,11 @@ import traceback
 from api.db.db_models import close_connection
 from api.db.services.task_service import TaskService
 from rag.settings import cron_logger
-from rag.utils.minio_conn import MINIO
-from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.local_cache import LOCAL_CACHE
 
 
 def collect():
-    doc_locations = TaskService.get_ongoing_doc_name()
+    doc_locations = TaskService.get_ongoing_doc_name(queued=True)
     print(doc_locations)
     if len(doc_locations) == 0:
         time.sleep(1)
@@ -38,15 +37,8 @@ def main():
     print("TASKS:", len(locations))
     for kb_id, loc in locations:
         try:
-            if REDIS_CONN.is_alive():
-                try:
-                    key = "{}/{}".format(kb_id, loc)
-                    if REDIS_CONN.exist(key):continue
-                    file_bin = MINIO.get(kb_id, loc)
-                    REDIS_CONN.transaction(key, file_bin, 12 * 60)
-                    cron_logger.info("CACHE: {}".format(loc))
-                except Exception as e:
-                    traceback.print_stack(e)
+            LOCAL_CACHE.prefetch(kb_id, loc)
+            cron_logger.info("CACHE: {}".format(loc))
         except Exception as e:
             traceback.print_stack(e)
 
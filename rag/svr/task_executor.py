@@ -14,13 +14,16 @@
 #  limitations under the License.
 #
 import datetime
+import gc
 import json
 import logging
 import os
 import hashlib
 import copy
 import re
+import resource
 import sys
+import threading
 import time
 import traceback
 from functools import partial
@@ -29,8 +32,9 @@ from api.db.services.file2document_service import File2DocumentService
 from api.settings import retrievaler
 from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
 from rag.utils.minio_conn import MINIO
+from rag.utils.local_cache import LOCAL_CACHE
 from api.db.db_models import close_connection
-from rag.settings import database_logger, SVR_QUEUE_NAME
+from rag.settings import database_logger, SVR_QUEUE_NAME, SVR_STEALABLE_TASKS
 from rag.settings import cron_logger, DOC_MAXIMUM_SIZE
 from multiprocessing import Pool
 import numpy as np
@@ -39,7 +43,7 @@ from multiprocessing.context import TimeoutError
 from api.db.services.task_service import TaskService
 from rag.utils.es_conn import ELASTICSEARCH
 from timeit import default_timer as timer
-from rag.utils import rmSpace, findMaxTm, num_tokens_from_string
+from rag.utils import rmSpace, findMaxTm, num_tokens_from_string, encode_unique
 
 from rag.nlp import search, rag_tokenizer
 from io import BytesIO
@@ -47,13 +51,21 @@ import pandas as pd
 
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one, audio
 
-from api.db import LLMType, ParserType
+from api.db import LLMType, ParserType, FileType
 from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
+from api.utils import get_uuid
 from api.utils.file_utils import get_project_base_directory
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.tenant_limiter import TENANT_LIMITER
 
 BATCH_SIZE = 64
+STEAL_MIN_PAGES = int(os.environ.get("TASK_STEAL_MIN_PAGES", 3))
+# 0 means no budget. Tasks estimated over what is left of it are split or deferred.
+MEMORY_BUDGET = int(os.environ.get("TASK_MEMORY_BUDGET_MB", 0)) * 1024 * 1024
+MAX_DEFER = 3
+ZOOMIN = 3
+MEMORY_CALIBRATION = {}
 
 FACTORY = {
     "general": naive,
@@ -119,11 +131,250 @@ def collect():
     tasks = pd.DataFrame(tasks)
     if msg.get("type", "") == "raptor":
         tasks["task_type"] = "raptor"
+    tasks["defer"] = msg.get("defer", 0)
     return tasks
 
 
 def get_minio_binary(bucket, name):
-    return MINIO.get(bucket, name)
+    return LOCAL_CACHE.get(bucket, name)
+
+
+def prefetch():
+    """Downloads the files of queued tasks into the local object cache before an executor takes them."""
+    if not LOCAL_CACHE.capacity:
+        return
+    while True:
+        try:
+            for bucket, name in TaskService.get_ongoing_doc_name(queued=True):
+                LOCAL_CACHE.prefetch(bucket, name)
+        except Exception as e:
+            cron_logger.error("Prefetch exception: " + str(e))
+        close_connection()
+        time.sleep(3)
+
+
+# Page ranges of running PDF tasks are kept in Redis as {cursor, to_page}:
+# the owner claims pages segment by segment from `cursor`, an idle executor
+# may cut `to_page` down and take over the unclaimed tail as a new task.
+CLAIM_SEGMENT = """
+local to_page = tonumber(redis.call('HGET', KEYS[1], 'to_page'))
+local cursor = tonumber(redis.call('HGET', KEYS[1], 'cursor'))
+if not to_page then return {-1, -1} end
+local e = math.min(cursor + tonumber(ARGV[1]), to_page)
+redis.call('HSET', KEYS[1], 'cursor', e)
+return {cursor, e}
+"""
+
+STEAL_TAIL = """
+local to_page = tonumber(redis.call('HGET', KEYS[1], 'to_page'))
+local cursor = tonumber(redis.call('HGET', KEYS[1], 'cursor'))
+if not to_page or to_page ~= tonumber(ARGV[1]) then return 0 end
+if tonumber(ARGV[2]) - cursor < tonumber(ARGV[3]) then return 0 end
+redis.call('HSET', KEYS[1], 'to_page', ARGV[2])
+return 1
+"""
+
+
+def task_range_key(task_id):
+    return "task_range:" + task_id
+
+
+def stealable(row):
+    return row.get("task_type", "") != "raptor" \
+        and row["type"] == FileType.PDF.value \
+        and row["parser_id"].lower() != ParserType.ONE.value \
+        and row["parser_config"].get("layout_recognize", True) \
+        and row["to_page"] - row["from_page"] >= 3 * STEAL_MIN_PAGES \
+        and REDIS_CONN.is_alive()
+
+
+def page_segments(row):
+    """
+    Yields the page ranges this executor should parse for the task.
+    Long PDF tasks are parsed in two or more segments so that the unclaimed tail can be stolen.
+    """
+    from_page, to_page = int(row["from_page"]), int(row["to_page"])
+    if not stealable(row):
+        yield from_page, to_page
+        return
+
+    key = task_range_key(row["id"])
+    seg = max(STEAL_MIN_PAGES, (to_page - from_page + 1) // 2)
+    REDIS_CONN.eval("redis.call('HSET', KEYS[1], 'cursor', ARGV[1], 'to_page', ARGV[2], 'doc_id', ARGV[3]) "
+                    "redis.call('EXPIRE', KEYS[1], 3600)",
+                    [key], [from_page, to_page, row["doc_id"]])
+    REDIS_CONN.sadd(SVR_STEALABLE_TASKS, row["id"])
+    cursor = from_page
+    try:
+        while True:
+            r = REDIS_CONN.eval(CLAIM_SEGMENT, [key], [seg])
+            if not r or r[0] < 0:
+                # lost the range state, finish what we last knew about
+                if cursor < to_page:
+                    yield cursor, to_page
+                return
+            s, e = r
+            if s >= e:
+                return
+            cursor = e
+            yield s, e
+    finally:
+        REDIS_CONN.srem(SVR_STEALABLE_TASKS, row["id"])
+        REDIS_CONN.eval("redis.call('DEL', KEYS[1])", [key])
+
+
+def steal():
+    """Takes over the unclaimed half of the tail of a running PDF task."""
+    for task_id in REDIS_CONN.smembers(SVR_STEALABLE_TASKS) or []:
+        key = task_range_key(task_id)
+        r = REDIS_CONN.eval("return redis.call('HMGET', KEYS[1], 'cursor', 'to_page', 'doc_id')", [key])
+        if not r or None in r:
+            REDIS_CONN.srem(SVR_STEALABLE_TASKS, task_id)
+            continue
+        cursor, to_page, doc_id = int(r[0]), int(r[1]), r[2]
+        if to_page - cursor < 2 * STEAL_MIN_PAGES:
+            continue
+        mid = cursor + (to_page - cursor) // 2
+        # The new task has to exist before the range is cut, or the document may look finished in between.
+        new_id = get_uuid()
+        TaskService.insert(id=new_id, doc_id=doc_id, from_page=mid, to_page=to_page)
+        if REDIS_CONN.eval(STEAL_TAIL, [key], [to_page, mid, STEAL_MIN_PAGES]) != 1:
+            TaskService.delete_by_id(new_id)
+            continue
+        TaskService.update_by_id(task_id, {"to_page": mid})
+        cron_logger.info("Steal pages {}~{} of task {}".format(mid, to_page, task_id))
+        return pd.DataFrame(TaskService.get_tasks(new_id))
+    return pd.DataFrame()
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception as e:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    try:
+        # Linux only: resets VmHWM to the current RSS
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except Exception as e:
+        pass
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for l in f:
+                if l.startswith("VmHWM:"):
+                    return int(l.split()[1]) * 1024
+    except Exception as e:
+        pass
+    return current_rss()
+
+
+def memory_kind(row):
+    if row.get("task_type", "") == "raptor":
+        return "raptor"
+    return "{}:{}".format(row["type"], row["parser_id"].lower())
+
+
+def memory_calibration(kind):
+    if kind not in MEMORY_CALIBRATION:
+        try:
+            MEMORY_CALIBRATION[kind] = float(REDIS_CONN.get("task_memory_calibration:" + kind) or 1.)
+        except Exception as e:
+            MEMORY_CALIBRATION[kind] = 1.
+    return MEMORY_CALIBRATION[kind]
+
+
+def estimate_task_memory(row):
+    """Rough peak memory of a task in bytes, on top of what the executor already holds."""
+    if row.get("task_type", "") == "raptor":
+        est = 64 * 1024 * 1024
+    elif row["type"] == FileType.PDF.value:
+        pages = max(1, int(row["to_page"]) - int(row["from_page"]))
+        if row["parser_id"].lower() == ParserType.ONE.value or not row["parser_config"].get("layout_recognize", True):
+            pages = 1
+        # A4 page rendered at 72*ZOOMIN dpi, RGB, plus the numpy copies made for OCR and layout
+        page_bytes = int(595 * ZOOMIN) * int(842 * ZOOMIN) * 3 * 2
+        est = row["size"] * 2 + pages * page_bytes
+    elif row["type"] == FileType.VISUAL.value:
+        est = row["size"] * 30
+    else:
+        est = row["size"] * 10
+    return int(est * memory_calibration(memory_kind(row)))
+
+
+def record_task_memory(row, est, rss_before):
+    used = max(0, peak_rss() - rss_before)
+    kind = memory_kind(row)
+    if est > 0 and used > 0:
+        ratio = used / (est / memory_calibration(kind))
+        MEMORY_CALIBRATION[kind] = 0.8 * memory_calibration(kind) + 0.2 * ratio
+        REDIS_CONN.set("task_memory_calibration:" + kind, MEMORY_CALIBRATION[kind], 7 * 24 * 3600)
+    cron_logger.info("Memory({}): estimated {:.1f}Mb, peak {:.1f}Mb".format(
+        row["name"], est / 1024. / 1024., used / 1024. / 1024.))
+
+
+def split_task(row, at):
+    """Moves pages [at, to_page) of the task into a new queued task."""
+    new_id = get_uuid()
+    TaskService.insert(id=new_id, doc_id=row["doc_id"], from_page=at, to_page=int(row["to_page"]))
+    TaskService.update_by_id(row["id"], {"to_page": at})
+    assert REDIS_CONN.queue_product(SVR_QUEUE_NAME, message={"id": new_id, "doc_id": row["doc_id"]}), \
+        "Can't access Redis. Please check the Redis' status."
+    row["to_page"] = at
+    return new_id
+
+
+def requeue(row, defer):
+    """Puts the task back to the end of the queue."""
+    msg = {"id": row["id"], "doc_id": row["doc_id"], "defer": defer}
+    if row.get("task_type", "") == "raptor":
+        msg["type"] = "raptor"
+    return REDIS_CONN.queue_product(SVR_QUEUE_NAME, message=msg)
+
+
+def admit(row, est):
+    """
+    Checks the task against the memory budget of this executor.
+    Returns False if the task has been put back to the queue for later.
+    """
+    if not MEMORY_BUDGET or est <= MEMORY_BUDGET - current_rss():
+        return True
+    gc.collect()
+    avail = MEMORY_BUDGET - current_rss()
+    if est <= avail:
+        return True
+
+    pages = int(row["to_page"]) - int(row["from_page"])
+    if row.get("task_type", "") != "raptor" and row["type"] == FileType.PDF.value and pages > 1 \
+            and row["parser_id"].lower() != ParserType.ONE.value:
+        fit = max(1, int(pages * max(avail, 0) / est))
+        if fit < pages:
+            split_task(row, int(row["from_page"]) + fit)
+            cron_logger.info("Split task {} at page {} to fit memory budget.".format(row["id"], row["to_page"]))
+            return True
+
+    defer = int(row.get("defer", 0))
+    if defer < MAX_DEFER:
+        if requeue(row, defer + 1):
+            cron_logger.info("Defer task {}: needs {:.1f}Mb, {:.1f}Mb available.".format(
+                row["id"], est / 1024. / 1024., avail / 1024. / 1024.))
+            return False
+    cron_logger.warning("Task {} exceeds memory budget, run it anyway.".format(row["id"]))
+    return True
+
+
+def segment_callback(row, s, e):
+    def _callback(prog=None, msg="Processing..."):
+        if prog is not None and prog > 0 and row["to_page"] > row["from_page"]:
+            prog = min(1., ((s - row["from_page"]) + prog * (e - s)) / (row["to_page"] - row["from_page"]))
+        set_progress(row["id"], row["from_page"], row["to_page"], prog=prog, msg=msg)
+    return _callback
 
 
 def build(row):
@@ -144,9 +395,17 @@ def build(row):
         binary = get_minio_binary(bucket, name)
         cron_logger.info(
             "From minio({}) {}/{}".format(timer() - st, row["location"], row["name"]))
-        cks = chunker.chunk(row["name"], binary=binary, from_page=row["from_page"],
-                            to_page=row["to_page"], lang=row["language"], callback=callback,
-                            kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"])
+        cks = []
+        segments = page_segments(row)
+        try:
+            for from_page, to_page in segments:
+                cks.extend(chunker.chunk(row["name"], binary=binary, from_page=from_page,
+                                         to_page=to_page, lang=row["language"],
+                                         callback=segment_callback(row, from_page, to_page),
+                                         kb_id=row["kb_id"], parser_config=row["parser_config"],
+                                         tenant_id=row["tenant_id"]))
+        finally:
+            segments.close()
         cron_logger.info(
             "Chunkking({}) {}/{}".format(timer() - st, row["location"], row["name"]))
     except TimeoutError as e:
@@ -172,7 +431,7 @@ def build(row):
         "doc_id": row["doc_id"],
         "kb_id": [str(row["kb_id"])]
     }
-    el = 0
+    images, encoded = {}, {}
     for ck in cks:
         d = copy.deepcopy(doc)
         d.update(ck)
@@ -186,19 +445,26 @@ def build(row):
             docs.append(d)
             continue
 
-        output_buffer = BytesIO()
-        if isinstance(d["image"], bytes):
-            output_buffer = BytesIO(d["image"])
-        else:
-            d["image"].save(output_buffer, format='JPEG')
+        # Table batches share one crop, encode it once and store it under its content hash.
+        if id(d["image"]) not in encoded:
+            output_buffer = BytesIO()
+            if isinstance(d["image"], bytes):
+                output_buffer = BytesIO(d["image"])
+            else:
+                d["image"].save(output_buffer, format='JPEG')
+            binary = output_buffer.getvalue()
+            encoded[id(d["image"])] = hashlib.sha256(binary).hexdigest()
+            images[encoded[id(d["image"])]] = binary
 
-        st = timer()
-        MINIO.put(row["kb_id"], d["_id"], output_buffer.getvalue())
-        el += timer() - st
-        d["img_id"] = "{}-{}".format(row["kb_id"], d["_id"])
+        d["img_id"] = "{}-{}".format(row["kb_id"], encoded[id(d["image"])])
         del d["image"]
         docs.append(d)
-    cron_logger.info("MINIO PUT({}):{}".format(row["name"], el))
+
+    st = timer()
+    failed = MINIO.put_many(row["kb_id"], list(images.items()))
+    if failed:
+        cron_logger.error("MINIO PUT({}): {} images failed".format(row["name"], len(failed)))
+    cron_logger.info("MINIO PUT({}):{}".format(row["name"], timer() - st))
 
     return docs
 
@@ -212,32 +478,19 @@ def init_kb(row):
 
 
 def embedding(docs, mdl, parser_config={}, callback=None):
-    batch_size = 32
+    # Hand the model as many texts as it sends at once, it splits them into concurrent full-size requests.
+    batch_size = max(32, getattr(mdl.mdl, "_max_batch", 32) * getattr(mdl.mdl, "_max_concurrency", 1))
     tts, cnts = [rmSpace(d["title_tks"]) for d in docs if d.get("title_tks")], [
         re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", d["content_with_weight"]) for d in docs]
     tk_count = 0
+    # Titles are the same for every chunk of a document and boilerplate repeats,
+    # so each distinct text is only embedded once.
     if len(tts) == len(cnts):
-        tts_ = np.array([])
-        for i in range(0, len(tts), batch_size):
-            vts, c = mdl.encode(tts[i: i + batch_size])
-            if len(tts_) == 0:
-                tts_ = vts
-            else:
-                tts_ = np.concatenate((tts_, vts), axis=0)
-            tk_count += c
-            callback(prog=0.6 + 0.1 * (i + 1) / len(tts), msg="")
-        tts = tts_
-
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), batch_size):
-        vts, c = mdl.encode(cnts[i: i + batch_size])
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
+        tts, c = encode_unique(mdl, tts, batch_size, lambda p: callback(prog=0.6 + 0.1 * p, msg=""))
         tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+
+    cnts, c = encode_unique(mdl, cnts, batch_size, lambda p: callback(prog=0.7 + 0.2 * p, msg=""))
+    tk_count += c
 
     title_w = float(parser_config.get("filename_embd_weight", 0.1))
     vects = (title_w * tts + (1 - title_w) *
@@ -291,79 +544,105 @@ def run_raptor(row, chat_mdl, embd_mdl, callback=None):
     return res, tk_count
 
 
-def main():
-    rows = collect()
-    if len(rows) == 0:
+def do_handle_task(r, est):
+    rss_before = current_rss()
+    reset_peak_rss()
+    callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+    try:
+        embd_mdl = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+    except Exception as e:
+        callback(-1, msg=str(e))
+        cron_logger.error(str(e))
         return
 
-    for _, r in rows.iterrows():
-        callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+    if r.get("task_type", "") == "raptor":
         try:
-            embd_mdl = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+            chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
+            cks, tk_count = run_raptor(r, chat_mdl, embd_mdl, callback)
         except Exception as e:
             callback(-1, msg=str(e))
             cron_logger.error(str(e))
-            continue
-
-        if r.get("task_type", "") == "raptor":
-            try:
-                chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
-                cks, tk_count = run_raptor(r, chat_mdl, embd_mdl, callback)
-            except Exception as e:
-                callback(-1, msg=str(e))
-                cron_logger.error(str(e))
-                continue
-        else:
-            st = timer()
-            cks = build(r)
-            cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
-            if cks is None:
-                continue
-            if not cks:
-                callback(1., "No chunk! Done!")
-                continue
-            # TODO: exception handler
-            ## set_progress(r["did"], -1, "ERROR: ")
-            callback(
-                msg="Finished slicing files(%d). Start to embedding the content." %
-                    len(cks))
-            st = timer()
-            try:
-                tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
-            except Exception as e:
-                callback(-1, "Embedding error:{}".format(str(e)))
-                cron_logger.error(str(e))
-                tk_count = 0
-            cron_logger.info("Embedding elapsed({}): {:.2f}".format(r["name"], timer() - st))
-            callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
-
-        init_kb(r)
-        chunk_count = len(set([c["_id"] for c in cks]))
+            return
+    else:
         st = timer()
-        es_r = ""
-        es_bulk_size = 16
-        for b in range(0, len(cks), es_bulk_size):
-            es_r = ELASTICSEARCH.bulk(cks[b:b + es_bulk_size], search.index_name(r["tenant_id"]))
-            if b % 128 == 0:
-                callback(prog=0.8 + 0.1 * (b + 1) / len(cks), msg="")
-
-        cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
-        if es_r:
-            callback(-1, "Index failure!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-            cron_logger.error(str(es_r))
-        else:
-            if TaskService.do_cancel(r["id"]):
-                ELASTICSEARCH.deleteByQuery(
-                    Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+        cks = build(r)
+        cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
+        if cks is None:
+            return
+        if not cks:
+            callback(1., "No chunk! Done!")
+            return
+        # TODO: exception handler
+        ## set_progress(r["did"], -1, "ERROR: ")
+        callback(
+            msg="Finished slicing files(%d). Start to embedding the content." %
+                len(cks))
+        st = timer()
+        try:
+            tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
+        except Exception as e:
+            callback(-1, "Embedding error:{}".format(str(e)))
+            cron_logger.error(str(e))
+            tk_count = 0
+        cron_logger.info("Embedding elapsed({}): {:.2f}".format(r["name"], timer() - st))
+        callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
+
+    record_task_memory(r, est, rss_before)
+    init_kb(r)
+    chunk_count = len(set([c["_id"] for c in cks]))
+    st = timer()
+    es_r = ""
+    es_bulk_size = 16
+    for b in range(0, len(cks), es_bulk_size):
+        es_r = ELASTICSEARCH.bulk(cks[b:b + es_bulk_size], search.index_name(r["tenant_id"]))
+        if b % 128 == 0:
+            callback(prog=0.8 + 0.1 * (b + 1) / len(cks), msg="")
+
+    cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
+    if es_r:
+        callback(-1, "Index failure!")
+        DocumentService.delete_chunks(Q("match", doc_id=r["doc_id"]), r["tenant_id"])
+        cron_logger.error(str(es_r))
+    else:
+        if TaskService.do_cancel(r["id"]):
+            DocumentService.delete_chunks(Q("match", doc_id=r["doc_id"]), r["tenant_id"])
+            return
+        callback(1., "Done!")
+        DocumentService.increment_chunk_num(
+            r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
+        cron_logger.info(
+            "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
+                r["id"], tk_count, len(cks), timer() - st))
+
+
+def main():
+    rows = collect()
+    if len(rows) == 0:
+        rows = steal()
+    if len(rows) == 0:
+        return
+
+    for _, r in rows.iterrows():
+        if not admit(r, estimate_task_memory(r)):
+            continue
+        # admit() may have split the task, its memory is then recorded against the pages it kept
+        est = estimate_task_memory(r)
+        try:
+            holder = TENANT_LIMITER.acquire("parse", r["tenant_id"], timeout=0)
+        except TimeoutError:
+            # the tenant has too many tasks running, let the tasks of other tenants go first
+            defer = int(r.get("defer", 0))
+            if defer < MAX_DEFER and requeue(r, defer + 1):
+                time.sleep(min(1 << defer, 30))
                 continue
-            callback(1., "Done!")
-            DocumentService.increment_chunk_num(
-                r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
-            cron_logger.info(
-                "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
-                    r["id"], tk_count, len(cks), timer() - st))
+            cron_logger.warning("Task {} was deferred {} times for tenant {}, run it anyway.".format(
+                r["id"], defer, r["tenant_id"]))
+            holder = None
+        try:
+            do_handle_task(r, est)
+        finally:
+            if holder:
+                TENANT_LIMITER.release("parse", r["tenant_id"], holder)
 
 
 if __name__ == "__main__":
@@ -372,5 +651,6 @@ if __name__ == "__main__":
     peewee_logger.addHandler(database_logger.handlers[0])
     peewee_logger.setLevel(database_logger.level)
 
+    threading.Thread(target=prefetch, daemon=True).start()
     while True:
         main()
@@ -0,0 +1,157 @@
+import socket
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("elasticsearch_dsl")
+
+from rag.nlp import keyword_extraction
+from rag.nlp import search as search_module
+from rag.nlp.search import Dealer
+from rag.utils.deadline import Deadline
+from rag.utils.lru_cache import LRUCache
+
+SLOW = 1.
+
+
+class FakeQueryer(object):
+    def question(self, txt, min_match=None):
+        return None, txt.split(" ")
+
+    def token_similarity(self, keywords, ins_tw):
+        return [0.] * len(ins_tw)
+
+
+class FakeDealer(Dealer):
+    """Ranks four chunks by a fixed hybrid similarity, without ES."""
+    hybrid = [0.4, 0.9, 0.6, 0.3]
+
+    def __init__(self):
+        self.qryr = FakeQueryer()
+        self.rerank_cache = LRUCache(100, ttl=600)
+        self.reqs = []
+
+    def search(self, req, idxnm, emb_mdl=None):
+        self.reqs.append(req)
+        ids = ["c%d" % i for i in range(len(self.hybrid))]
+        field = {id: {"content_ltks": "chunk %s" % id, "content_with_weight": "chunk %s" % id, "doc_id": "doc",
+                      "docnm_kwd": "doc.pdf", "kb_id": "kb"} for id in ids}
+        return self.SearchResult(total=len(ids), ids=ids, query_vector=[0., 0.], field=field)
+
+    def rerank(self, sres, query, tkweight=0.3, vtweight=0.7, cfield="content_ltks"):
+        sim = np.array(self.hybrid)
+        return sim, np.zeros(len(sim)), sim
+
+
+class SlowReranker(object):
+    """Ranks the chunks the other way around, after `delay` seconds."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+
+    def similarity(self, query, texts):
+        self.calls += 1
+        time.sleep(self.delay)
+        return np.array([1. - 0.1 * i for i in range(len(texts))])[::-1], 0
+
+
+class SlowChat(object):
+    def __init__(self, delay):
+        self.delay = delay
+
+    def chat(self, system, history, gen_conf):
+        time.sleep(self.delay)
+        return "keyword"
+
+
+def retrieve(dealer, rerank_mdl, deadline, top=1024):
+    return dealer.retrieval("what is it", None, "tenant", ["kb"], 1, 4, similarity_threshold=0.,
+                            top=top, aggs=False, rerank_mdl=rerank_mdl, deadline=deadline)
+
+
+def ids(ranks):
+    return [c["chunk_id"] for c in ranks["chunks"]]
+
+
+def test_call_times_out_without_waiting_for_the_call():
+    deadline = Deadline(SLOW / 2)
+    st = time.time()
+    with pytest.raises(TimeoutError):
+        deadline.call(time.sleep, SLOW)
+    assert time.time() - st < SLOW
+    assert Deadline(SLOW).call(lambda x: x + 1, 1) == 2
+    # without a deadline the call is just made
+    assert Deadline().call(lambda: "done") == "done"
+
+
+def test_keyword_extraction_is_given_up_on():
+    deadline = Deadline(3 * SLOW)
+    st = time.time()
+    with pytest.raises(TimeoutError):
+        deadline.call(keyword_extraction, SlowChat(3 * SLOW), "question", reserve=2 * SLOW)
+    assert time.time() - st < 2 * SLOW
+    assert deadline.call(keyword_extraction, SlowChat(0), "question", reserve=SLOW) == "keyword"
+
+
+def test_rerank_timeout_falls_back_to_hybrid_similarity():
+    dealer = FakeDealer()
+    deadline = Deadline(search_module.REDUCE_TOPK_SECONDS + SLOW)
+    reranker = SlowReranker(search_module.REDUCE_TOPK_SECONDS + 2 * SLOW)
+    st = time.time()
+    ranks = retrieve(dealer, reranker, deadline)
+    assert time.time() - st < search_module.REDUCE_TOPK_SECONDS + 2 * SLOW
+    assert reranker.calls == 1
+    assert ids(ranks) == ["c1", "c2", "c0", "c3"]
+    assert deadline.degraded == ["rerank timed out, ranked by hybrid similarity"]
+
+
+def test_rerank_model_is_used_in_time():
+    dealer = FakeDealer()
+    deadline = Deadline(search_module.REDUCE_TOPK_SECONDS + 5 * SLOW)
+    ranks = retrieve(dealer, SlowReranker(0), deadline)
+    assert ids(ranks) == ["c3", "c2", "c1", "c0"]
+    assert not deadline.degraded
+    # the search gets the time left
+    assert dealer.reqs[0]["topk"] == 1024
+    assert int(dealer.reqs[0]["timeout"][:-1]) <= search_module.REDUCE_TOPK_SECONDS + 5 * SLOW
+
+
+def test_short_deadline_reduces_top_k_and_skips_rerank():
+    dealer = FakeDealer()
+    deadline = Deadline(search_module.RERANK_MIN_SECONDS / 2)
+    reranker = SlowReranker(0)
+    ranks = retrieve(dealer, reranker, deadline)
+    assert reranker.calls == 0
+    assert ids(ranks) == ["c1", "c2", "c0", "c3"]
+    assert dealer.reqs[0]["topk"] == search_module.REDUCED_TOPK
+    assert deadline.degraded == ["top_k reduced to {}".format(search_module.REDUCED_TOPK),
+                                 "rerank skipped, ranked by hybrid similarity"]
+
+
+def test_top_k_reduced_but_rerank_kept():
+    dealer = FakeDealer()
+    deadline = Deadline((search_module.RERANK_MIN_SECONDS + search_module.REDUCE_TOPK_SECONDS) / 2)
+    retrieve(dealer, SlowReranker(0), deadline)
+    assert dealer.reqs[0]["topk"] == search_module.REDUCED_TOPK
+    assert deadline.degraded == ["top_k reduced to {}".format(search_module.REDUCED_TOPK)]
+    # a top_k already below the reduced one is left alone
+    dealer, deadline = FakeDealer(), Deadline(search_module.REDUCE_TOPK_SECONDS / 2)
+    retrieve(dealer, None, deadline, top=8)
+    assert dealer.reqs[0]["topk"] == 8
+    assert not deadline.degraded
+
+
+class TimingOutReranker(object):
+    def similarity(self, query, texts):
+        raise socket.timeout("read timed out")
+
+
+def test_provider_timeout_without_deadline_is_raised():
+    with pytest.raises(socket.timeout):
+        retrieve(FakeDealer(), TimingOutReranker(), None)
+    # with a deadline, it is ranked by hybrid similarity as any rerank out of time
+    deadline = Deadline(search_module.REDUCE_TOPK_SECONDS + 5 * SLOW)
+    assert ids(retrieve(FakeDealer(), TimingOutReranker(), deadline)) == ["c1", "c2", "c0", "c3"]
+    assert deadline.degraded == ["rerank timed out, ranked by hybrid similarity"]
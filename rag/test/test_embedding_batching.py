@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+embedding_model = pytest.importorskip("rag.llm.embedding_model")
+from rag.llm.embedding_model import LocalAIEmbed, Backoff
+from rag.utils import num_tokens_from_string
+
+
+class FakeProvider(object):
+    """OpenAI compatible embedding endpoint: the vector of "text<i>" is [i], requests may be rate limited."""
+
+    def __init__(self, delay=0., rate_limited=0):
+        self.delay = delay
+        self.rate_limited = rate_limited
+        self.lock = threading.Lock()
+        self.batches = []
+        self.running = 0
+        self.max_running = 0
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_):
+                pass
+
+            def do_POST(self):
+                req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with provider.lock:
+                    limited = provider.rate_limited > 0
+                    provider.rate_limited -= 1
+                    provider.running += 1
+                    provider.max_running = max(provider.max_running, provider.running)
+                time.sleep(provider.delay)
+                with provider.lock:
+                    provider.running -= 1
+                    if not limited:
+                        provider.batches.append(req["input"])
+                if limited:
+                    body, code = b'{"error": "Too many requests"}', 429
+                else:
+                    body, code = json.dumps({"data": [{"embedding": [float(t[4:])]} for t in req["input"]],
+                                             "usage": {"total_tokens": len(req["input"])}}).encode("utf-8"), 200
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/v1".format(self.server.server_address[1])
+
+
+@pytest.fixture
+def provider(request):
+    provider = FakeProvider(**getattr(request, "param", {}))
+    yield provider
+    provider.server.shutdown()
+
+
+def model(provider, **limits):
+    mdl = LocalAIEmbed("", "fake", provider.url)
+    mdl._backoff = Backoff(base=0.05, cap=0.2)
+    for k, v in limits.items():
+        setattr(mdl, k, v)
+    return mdl
+
+
+def texts(n):
+    return ["text%d" % i for i in range(n)]
+
+
+def test_batches_keep_the_order(provider):
+    embds, tokens = model(provider, _max_batch=3, _max_concurrency=1).encode(texts(10))
+    assert embds[:, 0].tolist() == list(range(10))
+    assert tokens == 10
+    assert [len(b) for b in provider.batches] == [3, 3, 3, 1]
+
+
+def test_token_budget(provider):
+    txts = texts(20)
+    budget = 3 * max([num_tokens_from_string(t) for t in txts])
+    embds, _ = model(provider, _max_batch_tokens=budget, _max_concurrency=1).encode(txts)
+    assert embds[:, 0].tolist() == list(range(20))
+    assert len(provider.batches) > 1
+    assert [t for b in provider.batches for t in b] == txts
+    for b in provider.batches:
+        assert sum([num_tokens_from_string(t) for t in b]) <= budget
+
+
+@pytest.mark.parametrize("provider", [{"delay": 0.2}], indirect=True)
+def test_concurrent_requests(provider):
+    st = time.time()
+    embds, _ = model(provider, _max_batch=2, _max_concurrency=4).encode(texts(16))
+    assert embds[:, 0].tolist() == list(range(16))
+    assert provider.max_running == 4
+    # 8 requests 4 at a time
+    assert time.time() - st < 8 * 0.2
+
+
+@pytest.mark.parametrize("provider", [{"rate_limited": 2}], indirect=True)
+def test_rate_limit_backs_off_and_retries(provider):
+    mdl = model(provider, _max_concurrency=1)
+    st = time.time()
+    embds, _ = mdl.encode(texts(3))
+    assert embds[:, 0].tolist() == [0, 1, 2]
+    assert provider.batches == [texts(3)]
+    # paused 0.05s then 0.1s, within the jitter
+    assert time.time() - st >= 0.15
+    assert mdl._backoff.delay < 0.1
+
+
+@pytest.mark.parametrize("provider", [{"rate_limited": 100}], indirect=True)
+def test_rate_limit_gives_up_after_the_retries(provider):
+    mdl = model(provider, _max_concurrency=1, _max_retries=2)
+    with pytest.raises(Exception, match="429"):
+        mdl.encode(texts(1))
+    assert provider.rate_limited == 100 - 3
+
+
+def test_session_and_backoff_made_once():
+    mdl = LocalAIEmbed("", "fake", "http://127.0.0.1:1/v1")
+    sessions = set()
+
+    def session():
+        sessions.add(id(mdl._lazy("_session", lambda: object())))
+
+    threads = [threading.Thread(target=session) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(sessions) == 1
+    assert mdl._lazy("_backoff", Backoff) is mdl._lazy("_backoff", Backoff)
@@ -0,0 +1,31 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rag.llm.inference_server import InferenceHandler, MicroBatcher
+
+
+@pytest.fixture
+def handler():
+    handler = InferenceHandler()
+    handler.batchers["encode"] = MicroBatcher(lambda texts: [[float(len(t))] for t in texts])
+    handler.models["encode"] = "BAAI/bge-large-zh-v1.5"
+    return handler
+
+
+def test_served_model(handler):
+    res = handler.handle({"op": "encode", "model": "BAAI/bge-large-zh-v1.5", "texts": ["a", "abc"]})
+    np.testing.assert_array_equal(res, [[1.], [3.]])
+    # the provider is not part of the model
+    assert handler.handle({"op": "encode", "model": "bge-large-zh-v1.5", "texts": ["ab"]}).tolist() == [[2.]]
+
+
+@pytest.mark.parametrize("model", ["BAAI/bge-small-en-v1.5", "", None])
+def test_other_model_is_turned_down(handler, model):
+    with pytest.raises(Exception, match="is not served"):
+        handler.handle({"op": "encode", "model": model, "texts": ["a"]})
+
+
+def test_operation_not_served(handler):
+    with pytest.raises(Exception, match="Operation 'similarity' is not served"):
+        handler.handle({"op": "similarity", "model": "BAAI/bge-reranker-v2-m3", "query": "q", "texts": ["a"]})
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("onnxruntime")
+FlagEmbedding = pytest.importorskip("FlagEmbedding")
+OnnxEmbedding = pytest.importorskip("rag.llm.embedding_model").OnnxEmbedding
+
+INSTRUCTION = "为这个句子生成表示以用于检索相关文章："
+TEXTS = ["hello world", "a longer sentence about retrieval augmented generation", "短句", "",
+         "the quick brown fox jumps over the lazy dog " * 20]
+
+
+class PoolerFirst(torch.nn.Module):
+    """Exports the pooler output ahead of the token states, as some exports do."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        out = self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        return out.pooler_output, out.last_hidden_state
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    model_dir = str(tmp_path_factory.mktemp("bge"))
+    chars = sorted(set("".join(TEXTS + [INSTRUCTION])) - {" "})
+    with open(os.path.join(model_dir, "vocab.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + chars))
+    tokenizer = transformers.BertTokenizer(os.path.join(model_dir, "vocab.txt"))
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(0)
+    config = transformers.BertConfig(vocab_size=len(tokenizer), hidden_size=32, num_hidden_layers=2,
+                                     num_attention_heads=4, intermediate_size=64, max_position_embeddings=512)
+    model = transformers.BertModel(config).eval()
+    model.save_pretrained(model_dir)
+
+    inputs = tokenizer(["sample"], return_tensors="pt")
+    axes = {0: "batch", 1: "length"}
+    os.makedirs(os.path.join(model_dir, "onnx"))
+    torch.onnx.export(PoolerFirst(model), (inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"]),
+                      os.path.join(model_dir, "onnx", "model.onnx"),
+                      input_names=["input_ids", "attention_mask", "token_type_ids"],
+                      output_names=["pooler_output", "last_hidden_state"],
+                      dynamic_axes={"input_ids": axes, "attention_mask": axes, "token_type_ids": axes,
+                                    "pooler_output": {0: "batch"}, "last_hidden_state": axes},
+                      opset_version=14)
+    return model_dir
+
+
+def test_onnx_matches_flag_model(model_dir):
+    flag = FlagEmbedding.FlagModel(model_dir, query_instruction_for_retrieval=INSTRUCTION, use_fp16=False)
+    onnx = OnnxEmbedding(model_dir, query_instruction_for_retrieval=INSTRUCTION)
+    assert onnx.output_name == "last_hidden_state"
+    np.testing.assert_allclose(onnx.encode(TEXTS), flag.encode(TEXTS), atol=1e-4)
+    np.testing.assert_allclose(onnx.encode(TEXTS, batch_size=2), flag.encode(TEXTS), atol=1e-4)
+    np.testing.assert_allclose(onnx.encode_queries(TEXTS), flag.encode_queries(TEXTS), atol=1e-4)
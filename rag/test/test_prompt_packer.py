@@ -0,0 +1,117 @@
+from copy import deepcopy
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("tiktoken")
+
+from rag.utils import num_tokens_from_string, encoder
+from rag.utils.prompt_packer import message_fit_in, pack_knowledge, count_tokens, TOKEN_COUNTS
+
+
+def legacy_message_fit_in(msg, max_length=4000):
+    """message_fit_in as it was in dialog_service.py before the prompt packer."""
+    def count():
+        nonlocal msg
+        tks_cnts = []
+        for m in msg:
+            tks_cnts.append(
+                {"role": m["role"], "count": num_tokens_from_string(m["content"])})
+        total = 0
+        for m in tks_cnts:
+            total += m["count"]
+        return total
+
+    c = count()
+    if c < max_length:
+        return c, msg
+
+    msg_ = [m for m in msg[:-1] if m["role"] == "system"]
+    msg_.append(msg[-1])
+    msg = msg_
+    c = count()
+    if c < max_length:
+        return c, msg
+
+    ll = num_tokens_from_string(msg_[0]["content"])
+    l = num_tokens_from_string(msg_[-1]["content"])
+    if ll / (ll + l) > 0.8:
+        m = msg_[0]["content"]
+        m = encoder.decode(encoder.encode(m)[:max_length - l])
+        msg[0]["content"] = m
+        return max_length, msg
+
+    m = msg_[1]["content"]
+    m = encoder.decode(encoder.encode(m)[:max_length - l])
+    msg[1]["content"] = m
+    return max_length, msg
+
+
+def conversation(system_words, turns, turn_words, last_words):
+    msg = [{"role": "system", "content": " ".join(["knowledge%d" % i for i in range(system_words)])}]
+    for i in range(turns):
+        msg.append({"role": "user", "content": " ".join(["question%d" % i] * turn_words)})
+        msg.append({"role": "assistant", "content": " ".join(["answer%d" % i] * turn_words)})
+    msg.append({"role": "user", "content": " ".join(["last"] * last_words)})
+    return msg
+
+
+CASES = [
+    # under budget
+    (conversation(50, 3, 10, 10), 4000),
+    # history dropped
+    (conversation(200, 40, 50, 10), 1000),
+    # system prompt truncated
+    (conversation(3000, 2, 10, 10), 1000),
+    # last message truncated
+    (conversation(100, 2, 10, 2000), 1000),
+]
+
+
+@pytest.mark.parametrize("msg,max_length", CASES)
+def test_legacy_policy_matches_old_message_fit_in(msg, max_length):
+    old_count, old_msg = legacy_message_fit_in(deepcopy(msg), max_length)
+    count, new_msg = message_fit_in(deepcopy(msg), max_length, "legacy")
+    assert new_msg == old_msg
+    exact = sum([num_tokens_from_string(m["content"]) for m in new_msg])
+    assert count == exact
+    if old_count < max_length:
+        assert count == old_count
+
+
+def test_pack_policy_keeps_recent_history():
+    msg = conversation(200, 40, 50, 10)
+    count, packed = message_fit_in(deepcopy(msg), 1000, "pack")
+    assert count == sum([num_tokens_from_string(m["content"]) for m in packed])
+    assert count < 1000
+    assert packed[0] == msg[0] and packed[-1] == msg[-1]
+    # the kept history is a contiguous tail of the conversation
+    history = packed[1:-1]
+    assert history and history == msg[-1 - len(history):-1]
+    # and one more message would not have fitted
+    assert count + num_tokens_from_string(msg[-2 - len(history)]["content"]) >= 1000
+
+
+def test_pack_knowledge():
+    chunks = [" ".join(["chunk%d" % i] * (i + 1) * 20) for i in range(20)]
+    budget = 1500
+    packed = pack_knowledge(chunks, budget)
+    total = sum([num_tokens_from_string(c) + 1 for c in packed])
+    assert packed == chunks[:len(packed)]
+    assert total <= budget
+    assert total + num_tokens_from_string(chunks[len(packed)]) + 1 > budget
+
+
+def test_count_tokens_cache():
+    TOKEN_COUNTS.clear()
+    txt = " ".join(["long knowledge"] * 1000)
+    assert count_tokens(txt) == num_tokens_from_string(txt)
+    assert count_tokens(txt) == num_tokens_from_string(txt)
+    assert all([len(k) == 32 for k in TOKEN_COUNTS.data.keys()])
+    assert len(TOKEN_COUNTS) == 1
+    assert count_tokens(txt + " once", cache=False) == num_tokens_from_string(txt + " once")
+    assert len(TOKEN_COUNTS) == 1
+    # the system message of message_fit_in is not cached
+    TOKEN_COUNTS.clear()
+    message_fit_in(conversation(50, 1, 10, 10), 4000)
+    assert len(TOKEN_COUNTS) == 3
@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("sklearn")
+pytest.importorskip("umap")
+
+from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
+
+
+def blobs(n_clusters, per_cluster, dim, seed):
+    rs = np.random.RandomState(seed)
+    centers = rs.uniform(-10, 10, size=(n_clusters, dim))
+    return np.concatenate([c + rs.normal(scale=0.5, size=(per_cluster, dim)) for c in centers])
+
+
+def exhaustive(embeddings, max_cluster, random_state):
+    """How the number of clusters was chosen before: fit every candidate, keep the lowest BIC."""
+    bics = {n: Raptor._fit_gmm(embeddings, n, random_state)[0]
+            for n in range(1, min(max_cluster, len(embeddings)))}
+    best = min(bics, key=lambda n: bics[n])
+    return best, bics
+
+
+@pytest.mark.parametrize("n_clusters,max_cluster,seed", [(3, 16, 0), (7, 32, 1), (12, 64, 2), (25, 64, 3)])
+def test_coarse_to_fine_search_matches_exhaustive_bic(n_clusters, max_cluster, seed):
+    embeddings = blobs(n_clusters, 20, 8, seed)
+    raptor = Raptor(max_cluster, None, None, "")
+    n, gm = raptor._get_optimal_clusters(embeddings, 224)
+    best, bics = exhaustive(embeddings, max_cluster, 224)
+    assert gm.n_components == n
+    assert abs(n - best) <= 2
+    # the choice is as good as the exhaustive one, within 1% of the BIC
+    assert bics[n] <= bics[best] + 0.01 * abs(bics[best])
+
+
+@pytest.mark.parametrize("guess", [12, 4, 30, 1, 200])
+def test_search_warm_started_from_a_guess(guess):
+    embeddings = blobs(12, 20, 8, 2)
+    raptor = Raptor(64, None, None, "")
+    n, gm = raptor._get_optimal_clusters(embeddings, 224, guess)
+    best, bics = exhaustive(embeddings, 64, 224)
+    assert gm.n_components == n
+    assert abs(n - best) <= 2
+    assert bics[n] <= bics[best] + 0.01 * abs(bics[best])
+
+
+def test_too_few_embeddings():
+    raptor = Raptor(64, None, None, "")
+    assert raptor._get_optimal_clusters(blobs(1, 1, 8, 0), 224) == (1, None)
+    n, gm = raptor._get_optimal_clusters(blobs(1, 3, 8, 0), 224)
+    assert n in (1, 2) and gm.n_components == n
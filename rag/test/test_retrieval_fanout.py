@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("elasticsearch_dsl")
+
+from rag.nlp.search import Dealer
+
+
+class FakeQueryer(object):
+    def question(self, txt, min_match=None):
+        return None, txt.split(" ")
+
+
+class FakeEmbedding(object):
+    def __init__(self):
+        self.batches = []
+
+    def encode_queries(self, text):
+        raise AssertionError("the variants are embedded in one batch")
+
+    def encode_queries_batch(self, texts):
+        self.batches.append(list(texts))
+        return np.array([[float(i), 1.] for i in range(len(texts))]), 0
+
+
+class FakeDealer(Dealer):
+    """Each variant matches its own chunks and a shared one, without ES."""
+
+    def __init__(self):
+        self.qryr = FakeQueryer()
+        self.lock = threading.Lock()
+        self.reqs = []
+
+    def search(self, req, idxnm, emb_mdl=None):
+        with self.lock:
+            self.reqs.append(req)
+        q = req["question"]
+        ids = ["shared", q + "-1", q + "-2"]
+        field = {id: {"content_ltks": id, "content_with_weight": id, "doc_id": "doc", "docnm_kwd": "doc.pdf",
+                      "kb_id": "kb"} for id in ids}
+        return self.SearchResult(total=len(ids), ids=ids, query_vector=req["query_vector"], field=field)
+
+    def rerank(self, sres, query, tkweight=0.3, vtweight=0.7, cfield="content_ltks"):
+        sim = np.array([0.5, 0.9, 0.3])
+        return sim, sim, sim
+
+
+def test_variants_are_embedded_in_one_batch_and_fused():
+    dealer, embd = FakeDealer(), FakeEmbedding()
+    ranks = dealer.retrieval(["question", "rewrite"], embd, "tenant", ["kb"], 1, 10, similarity_threshold=0.)
+    assert embd.batches == [["question", "rewrite"]]
+    assert sorted([(r["question"], list(r["query_vector"])) for r in dealer.reqs]) == \
+        [("question", [0., 1.]), ("rewrite", [1., 1.])]
+    ids = [c["chunk_id"] for c in ranks["chunks"]]
+    # the chunk both variants retrieve ranks first
+    assert ids[0] == "shared"
+    assert sorted(ids) == sorted(["shared", "question-1", "question-2", "rewrite-1", "rewrite-2"])
@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from rag.llm.rpc_server import GenerationEngine
+
+EOS = 259
+
+
+class ByteTokenizer(object):
+    """Bytes as tokens, enough for the engine on a tiny random model."""
+    eos_token_id = EOS
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        return "".join(["<{}>{}".format(m["role"], m["content"]) for m in messages]) + "<assistant>"
+
+    def __call__(self, text):
+        return {"input_ids": list(text.encode("utf-8"))}
+
+    def decode(self, ids, skip_special_tokens=True):
+        # one character per byte, so that a longer answer always extends the text of a shorter one
+        return bytes([i for i in ids if i < 256]).decode("latin-1")
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=260, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512,
+                                      eos_token_id=EOS)
+    model = transformers.LlamaForCausalLM(config)
+    model.eval()
+    model.generation_config.eos_token_id = EOS
+    return model
+
+
+def greedy(model, ids, max_new_tokens):
+    """What the model answers to a prompt on its own, without a batch."""
+    ids, out = list(ids), []
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            t = int(torch.argmax(model(input_ids=torch.tensor([ids])).logits[0, -1]))
+            out.append(t)
+            ids.append(t)
+            if t == EOS:
+                break
+    return out
+
+
+def collect(seq, timeout=60):
+    events, st = [], time.time()
+    while True:
+        ev = seq.out.get(timeout=max(0.1, timeout - (time.time() - st)))
+        events.append(ev)
+        if "delta" not in ev:
+            return events
+
+
+def test_batched_decoding_matches_single_sequences(model):
+    tokenizer = ByteTokenizer()
+    engine = GenerationEngine(model, tokenizer, max_batch=4)
+    questions = ["hi", "a much longer question than the first one", "medium question", "x" * 80, "?"]
+    max_tokens = [12, 5, 20, 8, 16]
+    seqs = []
+    for i, (q, n) in enumerate(zip(questions, max_tokens)):
+        seqs.append(engine.submit([{"role": "user", "content": q}], {"temperature": 0, "max_tokens": n}))
+        if i == 1:
+            # the others join a batch which is already decoding
+            time.sleep(0.05)
+
+    for seq, n in zip(seqs, max_tokens):
+        events = collect(seq)
+        assert events[-1].get("done"), events[-1]
+        assert seq.tokens == greedy(model, seq.prompt_ids, n)
+        assert "".join([e["delta"] for e in events if "delta" in e]) == tokenizer.decode(seq.tokens)
+        assert events[-1]["tokens"] == len(seq.tokens)
+    assert not engine.running or all([s.finished for s in engine.running])
+
+
+def test_cancelled_sequence_leaves_the_batch(model):
+    engine = GenerationEngine(model, ByteTokenizer(), max_batch=4)
+    long = engine.submit([{"role": "user", "content": "cancel me"}], {"temperature": 0, "max_tokens": 400})
+    other = engine.submit([{"role": "user", "content": "keep me"}], {"temperature": 0, "max_tokens": 30})
+    long.cancelled = True
+    events = collect(other)
+    assert events[-1].get("done")
+    assert other.tokens == greedy(model, other.prompt_ids, 30)
+    assert len(long.tokens) < 400
+
+
+def test_queue_backpressure(model):
+    engine = GenerationEngine(model, ByteTokenizer(), max_batch=1, max_queue=1, queue_timeout=0.01)
+    seqs, refused = [], 0
+    for _ in range(20):
+        try:
+            seqs.append(engine.submit([{"role": "user", "content": "busy"}], {"temperature": 0, "max_tokens": 50}))
+        except Exception as e:
+            assert str(e).startswith("Server busy")
+            refused += 1
+    assert refused
+    for seq in seqs:
+        assert collect(seq)[-1].get("done")
@@ -16,6 +16,7 @@
 
 import os
 import re
+import numpy as np
 import tiktoken
 
 
@@ -80,6 +81,27 @@ def num_tokens_from_string(string: str) -> int:
     return num_tokens
 
 
+def encode_unique(mdl, texts, batch_size=32, progress=None):
+    """
+    Embeds every distinct text once, in batches of `batch_size`, and scatters the vectors back.
+    Returns the vectors aligned with `texts` and the token count of what was actually sent.
+    """
+    uniq, idx = {}, []
+    for t in texts:
+        idx.append(uniq.setdefault(t, len(uniq)))
+    uniq = list(uniq.keys())
+    vects, tk_count = [], 0
+    for i in range(0, len(uniq), batch_size):
+        vts, c = mdl.encode(uniq[i: i + batch_size])
+        vects.extend(vts)
+        tk_count += c
+        if progress:
+            progress(min(1., (i + batch_size) / len(uniq)))
+    if not texts:
+        return np.array([]), tk_count
+    return np.array(vects)[idx], tk_count
+
+
 def truncate(string: str, max_len: int) -> int:
     """Returns truncated text if the length of text exceed max_len."""
     return encoder.decode(encoder.encode(string)[:max_len])
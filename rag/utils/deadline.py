@@ -0,0 +1,57 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+# Runs the optional stages which are given up on, rather than waited for, once the deadline is near.
+DEADLINE_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("DEADLINE_WORKERS", 32)))
+
+
+class Deadline(object):
+    """
+    Time budget of a request, handed down to the stages it goes through. Optional stages are skipped
+    when too little time is left, and the reasons are kept in `degraded`.
+    """
+
+    def __init__(self, seconds=None):
+        self.at = time.time() + seconds if seconds else None
+        self.degraded = []
+
+    def remaining(self):
+        if self.at is None:
+            return float("inf")
+        return max(0., self.at - time.time())
+
+    def allows(self, seconds):
+        return self.remaining() >= seconds
+
+    def degrade(self, reason):
+        logging.warning("Degraded: " + reason)
+        self.degraded.append(reason)
+
+    def call(self, fn, *args, reserve=0., **kwargs):
+        """
+        Returns fn(*args, **kwargs) if it finishes `reserve` seconds before the deadline, else raises TimeoutError.
+        The call itself is not interrupted, its result is just not waited for.
+        """
+        if self.at is None:
+            return fn(*args, **kwargs)
+        try:
+            return DEADLINE_POOL.submit(fn, *args, **kwargs).result(timeout=max(0., self.remaining() - reserve))
+        except FutureTimeout:
+            raise TimeoutError("{} is out of time".format(getattr(fn, "__name__", "call")))
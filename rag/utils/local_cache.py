@@ -0,0 +1,164 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import hashlib
+import os
+import threading
+import time
+
+from api.utils.file_utils import get_project_base_directory
+from rag.settings import minio_logger
+from rag.utils import singleton
+from rag.utils.minio_conn import MINIO
+
+
+@singleton
+class LocalObjectCache(object):
+    """
+    Content addressed disk cache in front of MinIO, shared by the processes of one host.
+    `index/` maps bucket/name to the sha256 and the MinIO etag of the object, `blobs/` holds the objects.
+    A hit is only served while the object in MinIO still has that etag, names are reused by re-uploads.
+    The least recently used blobs are evicted once the cache grows over its size cap.
+    """
+
+    def __init__(self):
+        self.dir = os.environ.get("OBJECT_CACHE_DIR",
+                                  os.path.join(get_project_base_directory(), "cache", "objects"))
+        self.capacity = int(os.environ.get("OBJECT_CACHE_SIZE_MB", 2048)) * 1024 * 1024
+        self.ttl = int(os.environ.get("OBJECT_CACHE_TTL", 24 * 3600))
+        self.lock = threading.Lock()
+        self.size = None
+        try:
+            os.makedirs(os.path.join(self.dir, "index"), exist_ok=True)
+            os.makedirs(os.path.join(self.dir, "blobs"), exist_ok=True)
+        except Exception as e:
+            minio_logger.error("Fail to create object cache %s: " % self.dir + str(e))
+            self.capacity = 0
+
+    def __index_path(self, bucket, fnm):
+        return os.path.join(self.dir, "index", hashlib.md5(f"{bucket}/{fnm}".encode("utf-8")).hexdigest())
+
+    def __blob_path(self, digest):
+        return os.path.join(self.dir, "blobs", digest)
+
+    def __write(self, path, binary):
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as f:
+            f.write(binary)
+        os.replace(tmp, path)
+
+    def __entry(self, bucket, fnm):
+        """Returns the digest of the cached object if it is still the one in MinIO, else None."""
+        idx = self.__index_path(bucket, fnm)
+        if time.time() - os.path.getmtime(idx) > self.ttl:
+            return
+        with open(idx, "r") as f:
+            entry = f.read().split()
+        if len(entry) != 2 or entry[1] != MINIO.etag(bucket, fnm):
+            return
+        return entry[0]
+
+    def lookup(self, bucket, fnm):
+        """Returns the cached object, or None."""
+        if not self.capacity:
+            return
+        try:
+            digest = self.__entry(bucket, fnm)
+            if not digest:
+                return
+            path = self.__blob_path(digest)
+            with open(path, "rb") as f:
+                binary = f.read()
+            os.utime(path)
+            return binary
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            minio_logger.error(f"Fail read cache {bucket}/{fnm}: " + str(e))
+
+    def cacheable(self, size, etag):
+        return bool(self.capacity and size and etag and size <= self.capacity // 4)
+
+    def store(self, bucket, fnm, binary, etag):
+        if not binary or not self.cacheable(len(binary), etag):
+            return
+        try:
+            digest = hashlib.sha256(binary).hexdigest()
+            path = self.__blob_path(digest)
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                self.__write(path, binary)
+                self.__evict(len(binary))
+            self.__write(self.__index_path(bucket, fnm), "{} {}".format(digest, etag).encode("utf-8"))
+        except Exception as e:
+            minio_logger.error(f"Fail write cache {bucket}/{fnm}: " + str(e))
+
+    def __evict(self, added):
+        with self.lock:
+            if self.size is not None:
+                self.size += added
+                if self.size <= self.capacity:
+                    return
+            blobs = []
+            for e in os.scandir(os.path.join(self.dir, "blobs")):
+                try:
+                    st = e.stat()
+                    blobs.append((st.st_mtime, st.st_size, e.path))
+                except FileNotFoundError:
+                    pass
+            self.size = sum([b[1] for b in blobs])
+            blobs = sorted(blobs)
+            # evict down to 90% so that every put does not trigger a scan
+            while blobs and self.size > self.capacity * 0.9:
+                _, sz, path = blobs.pop(0)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.size -= sz
+
+    def contains(self, bucket, fnm):
+        if not self.capacity:
+            return False
+        try:
+            return self.__entry(bucket, fnm) is not None
+        except Exception as e:
+            return False
+
+    def fetch(self, bucket, fnm):
+        # the etag is read first, an object replaced in between is then just fetched again next time
+        etag = MINIO.etag(bucket, fnm)
+        binary = MINIO.get(bucket, fnm)
+        self.store(bucket, fnm, binary, etag)
+        return binary
+
+    def get(self, bucket, fnm):
+        binary = self.lookup(bucket, fnm)
+        if binary is not None:
+            return binary
+        return self.fetch(bucket, fnm)
+
+    def prefetch(self, bucket, fnm):
+        """Downloads the object ahead of its use, unless it is cached already or would not be."""
+        if not self.capacity or self.contains(bucket, fnm):
+            return
+        st = MINIO.stat(bucket, fnm)
+        if not st or not self.cacheable(st.size, st.etag):
+            return
+        self.store(bucket, fnm, MINIO.get(bucket, fnm), st.etag)
+
+
+LOCAL_CACHE = LocalObjectCache()
@@ -0,0 +1,67 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe, size bounded in-process cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, capacity=4096, ttl=600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            v = self.data.get(key)
+            if v is None or (self.ttl and v[1] < time.time()):
+                if v is not None:
+                    del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return v[0]
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl if ttl else float("inf"))
+            self.data.move_to_end(key)
+            while len(self.data) > self.capacity:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            v = self.data.pop(key, None)
+        return v[0] if v else None
+
+    def clear(self, match=None):
+        """Drops every entry, or those whose key satisfies `match`."""
+        with self.lock:
+            if not match:
+                self.data.clear()
+                return
+            for k in [k for k in self.data.keys() if match(k)]:
+                del self.data[k]
+
+    def __len__(self):
+        return len(self.data)
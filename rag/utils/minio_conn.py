@@ -1,6 +1,9 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+import urllib3
 from minio import Minio
+from minio.error import S3Error
 from io import BytesIO
 from rag import settings
 from rag.settings import minio_logger
@@ -11,6 +14,7 @@ from rag.utils import singleton
 class RAGFlowMinio(object):
     def __init__(self):
         self.conn = None
+        self.buckets = set()
         self.__open__()
 
     def __open__(self):
@@ -21,10 +25,19 @@ class RAGFlowMinio(object):
             pass
 
         try:
+            pool_size = int(os.environ.get("MINIO_POOL_SIZE", 32))
+            http_client = urllib3.PoolManager(
+                num_pools=4,
+                maxsize=pool_size,
+                timeout=urllib3.Timeout(connect=5, read=120),
+                retries=urllib3.Retry(total=3, backoff_factor=0.2,
+                                      status_forcelist=[500, 502, 503, 504])
+            )
             self.conn = Minio(settings.MINIO["host"],
                               access_key=settings.MINIO["user"],
                               secret_key=settings.MINIO["password"],
-                              secure=False
+                              secure=False,
+                              http_client=http_client
                               )
         except Exception as e:
             minio_logger.error(
@@ -44,12 +57,30 @@ class RAGFlowMinio(object):
                                  )
         return r
 
+    def __ensure_bucket(self, bucket):
+        if bucket in self.buckets:
+            return
+        if not self.conn.bucket_exists(bucket):
+            try:
+                self.conn.make_bucket(bucket)
+            except S3Error as e:
+                if e.code not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                    raise
+        self.buckets.add(bucket)
+
+    def __on_error(self, e):
+        # S3 errors are answers from a healthy server, only connection problems need a new client.
+        if isinstance(e, S3Error):
+            if e.code == "NoSuchBucket":
+                self.buckets.clear()
+            return
+        self.__open__()
+        time.sleep(1)
+
     def put(self, bucket, fnm, binary):
         for _ in range(3):
             try:
-                if not self.conn.bucket_exists(bucket):
-                    self.conn.make_bucket(bucket)
-
+                self.__ensure_bucket(bucket)
                 r = self.conn.put_object(bucket, fnm,
                                          BytesIO(binary),
                                          len(binary)
@@ -57,8 +88,33 @@ class RAGFlowMinio(object):
                 return r
             except Exception as e:
                 minio_logger.error(f"Fail put {bucket}/{fnm}: " + str(e))
-                self.__open__()
-                time.sleep(1)
+                self.__on_error(e)
+
+    def put_stream(self, bucket, fnm, stream, length=-1, part_size=16 * 1024 * 1024):
+        """Uploads from a file-like object, in multipart chunks of `part_size` if the length is unknown."""
+        try:
+            self.__ensure_bucket(bucket)
+            return self.conn.put_object(bucket, fnm, stream, length, part_size=part_size)
+        except Exception as e:
+            minio_logger.error(f"Fail put {bucket}/{fnm}: " + str(e))
+            self.__on_error(e)
+
+    def put_many(self, bucket, objs, max_workers=8):
+        """
+        Uploads [(fnm, binary), ...] to one bucket concurrently.
+        Returns the names that failed.
+        """
+        if not objs:
+            return []
+        try:
+            self.__ensure_bucket(bucket)
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(objs))) as exe:
+                res = list(exe.map(lambda o: self.put(bucket, o[0], o[1]), objs))
+            return [o[0] for o, r in zip(objs, res) if r is None]
+        except Exception as e:
+            minio_logger.error(f"Fail put {len(objs)} objects to {bucket}: " + str(e))
+            self.__on_error(e)
+        return [o[0] for o in objs]
 
     def rm(self, bucket, fnm):
         try:
@@ -66,17 +122,36 @@ class RAGFlowMinio(object):
         except Exception as e:
             minio_logger.error(f"Fail rm {bucket}/{fnm}: " + str(e))
 
-    def get(self, bucket, fnm):
+    def get(self, bucket, fnm, offset=0, length=0):
         for _ in range(1):
+            r = None
             try:
-                r = self.conn.get_object(bucket, fnm)
+                r = self.conn.get_object(bucket, fnm, offset=offset, length=length)
                 return r.read()
             except Exception as e:
                 minio_logger.error(f"fail get {bucket}/{fnm}: " + str(e))
-                self.__open__()
-                time.sleep(1)
+                self.__on_error(e)
+            finally:
+                if r is not None:
+                    r.close()
+                    r.release_conn()
         return
 
+    def get_stream(self, bucket, fnm, offset=0, length=0, chunk_size=1024 * 1024):
+        """Yields the object (or the byte range of it) chunk by chunk instead of reading it all into memory."""
+        r = None
+        try:
+            r = self.conn.get_object(bucket, fnm, offset=offset, length=length)
+            for chunk in r.stream(chunk_size):
+                yield chunk
+        except Exception as e:
+            minio_logger.error(f"fail get {bucket}/{fnm}: " + str(e))
+            self.__on_error(e)
+        finally:
+            if r is not None:
+                r.close()
+                r.release_conn()
+
     def obj_exist(self, bucket, fnm):
         try:
             if self.conn.stat_object(bucket, fnm):return True
@@ -86,14 +161,31 @@ class RAGFlowMinio(object):
         return False
 
 
+    def last_modified(self, bucket, fnm):
+        try:
+            return self.conn.stat_object(bucket, fnm).last_modified.timestamp()
+        except Exception as e:
+            minio_logger.error(f"Fail stat {bucket}/{fnm}: " + str(e))
+        return None
+
+    def stat(self, bucket, fnm):
+        try:
+            return self.conn.stat_object(bucket, fnm)
+        except Exception as e:
+            minio_logger.error(f"Fail stat {bucket}/{fnm}: " + str(e))
+        return None
+
+    def etag(self, bucket, fnm):
+        st = self.stat(bucket, fnm)
+        return st.etag if st else None
+
     def get_presigned_url(self, bucket, fnm, expires):
         for _ in range(10):
             try:
                 return self.conn.get_presigned_url("GET", bucket, fnm, expires)
             except Exception as e:
                 minio_logger.error(f"fail get {bucket}/{fnm}: " + str(e))
-                self.__open__()
-                time.sleep(1)
+                self.__on_error(e)
         return
 
 
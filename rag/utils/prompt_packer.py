@@ -0,0 +1,110 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Fits the system prompt, the knowledge and the history of a chat into the token budget of a model.
+
+Policies, per dialog with prompt_config["fit_policy"] or for all with PROMPT_FIT_POLICY:
+    legacy: over budget, the history is dropped but for the last message, then the longer of
+            the system prompt and the last message is truncated.
+    pack:   knowledge chunks are kept whole in rank order as long as they fit, and so is the
+            most recent history. Truncation only happens when the system prompt and the last
+            message alone are over budget.
+"""
+import hashlib
+import os
+
+from rag.utils import num_tokens_from_string, encoder
+from rag.utils.lru_cache import LRUCache
+
+PROMPT_FIT_POLICY = os.environ.get("PROMPT_FIT_POLICY", "legacy")
+
+# The same messages and chunks are counted turn after turn, keyed by digest to keep the cache small.
+TOKEN_COUNTS = LRUCache(65536, ttl=3600)
+
+
+def count_tokens(txt, cache=True):
+    """Texts which are different every time, such as a system prompt with the knowledge in it, pass cache=False."""
+    if not cache:
+        return num_tokens_from_string(txt)
+    key = hashlib.md5(txt.encode("utf-8")).hexdigest()
+    n = TOKEN_COUNTS.get(key)
+    if n is None:
+        n = num_tokens_from_string(txt)
+        TOKEN_COUNTS.put(key, n)
+    return n
+
+
+def pack_knowledge(knowledges, max_length):
+    """The leading chunks whose total fits in `max_length` tokens."""
+    total = 0
+    for i, ck in enumerate(knowledges):
+        total += count_tokens(ck) + 1
+        if total > max_length:
+            return knowledges[:i]
+    return knowledges
+
+
+def message_fit_in(msg, max_length=4000, policy=None):
+    policy = policy or PROMPT_FIT_POLICY
+    # the system message holds the knowledge of this turn, it is only counted once per call
+    system_counts = {}
+
+    def tokens(m):
+        if m["role"] != "system":
+            return count_tokens(m["content"])
+        if m["content"] not in system_counts:
+            system_counts[m["content"]] = count_tokens(m["content"], cache=False)
+        return system_counts[m["content"]]
+
+    def count():
+        nonlocal msg
+        return sum([tokens(m) for m in msg])
+
+    c = count()
+    if c < max_length:
+        return c, msg
+
+    msg_ = [m for m in msg[:-1] if m["role"] == "system"]
+    if policy == "pack":
+        # the most recent messages which fit along the system prompt and the last message
+        total = sum([tokens(m) for m in msg_ + msg[-1:]])
+        history = []
+        for m in msg[-2::-1]:
+            if m["role"] == "system":
+                continue
+            total += tokens(m)
+            if total >= max_length:
+                break
+            history.insert(0, m)
+        msg_.extend(history)
+    msg_.append(msg[-1])
+    msg = msg_
+    c = count()
+    if c < max_length:
+        return c, msg
+
+    ll = tokens(msg_[0])
+    l = tokens(msg_[-1])
+    if ll / (ll + l) > 0.8:
+        m = msg_[0]["content"]
+        m = encoder.decode(encoder.encode(m)[:max_length - l])
+        msg[0]["content"] = m
+        return count(), msg
+
+    m = msg_[1]["content"]
+    m = encoder.decode(encoder.encode(m)[:max_length - l])
+    msg[1]["content"] = m
+    return count(), msg
@@ -0,0 +1,103 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+
+from rag.utils import singleton
+from rag.utils.lru_cache import LRUCache
+from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.singleflight import SingleFlight
+
+
+def normalize(obj):
+    if isinstance(obj, str):
+        return re.sub(r"\s+", " ", obj).strip()
+    if isinstance(obj, dict):
+        return {k: normalize(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [normalize(v) for v in obj]
+    return obj
+
+
+@singleton
+class ResponseCache(object):
+    """
+    Answers of the LLM calls whose answer only depends on their prompt, such as keyword extraction or
+    classification. Entries are scoped by tenant, model, call name and prompt template version,
+    kept in process ("local"), in Redis ("redis") to be shared by every server, or not at all ("off").
+    """
+
+    def __init__(self):
+        self.backend = os.environ.get("LLM_RESPONSE_CACHE", "local")
+        self.ttl = int(os.environ.get("LLM_RESPONSE_CACHE_TTL", 3600))
+        self.local = LRUCache(int(os.environ.get("LLM_RESPONSE_CACHE_SIZE", 4096)), self.ttl)
+        self.lock = threading.Lock()
+        self.metrics = defaultdict(lambda: {"hits": 0, "misses": 0, "shared": 0})
+        # concurrent misses of one key make one call, whose answer they share
+        self.flights = SingleFlight()
+
+    def key(self, tenant_id, model, name, version, inputs):
+        digest = hashlib.md5(json.dumps(normalize(inputs), ensure_ascii=False, sort_keys=True).encode("utf-8"))
+        return "llm_response:{}:{}:{}:{}:{}".format(tenant_id, model, name, version, digest.hexdigest())
+
+    def get(self, key):
+        if self.backend == "redis":
+            v = REDIS_CONN.get(key)
+            return json.loads(v) if v else None
+        return self.local.get(key)
+
+    def put(self, key, value, ttl=None):
+        if self.backend == "redis":
+            REDIS_CONN.set(key, json.dumps(value, ensure_ascii=False), ttl or self.ttl)
+            return
+        self.local.put(key, value, ttl)
+
+    def cached(self, tenant_id, model, name, version, inputs, fn, ttl=None):
+        """
+        Returns the cached answer of `fn`, calling it on a miss. Errors are not cached.
+        Misses of the same key while `fn` is running wait for it, and are counted as "shared".
+        """
+        if self.backend == "off":
+            return fn()
+        key = self.key(tenant_id, model, name, version, inputs)
+        ans = self.get(key)
+        with self.lock:
+            self.metrics[name]["hits" if ans is not None else "misses"] += 1
+        if ans is not None:
+            return ans
+
+        def call():
+            ans = fn()
+            if ans and not (isinstance(ans, str) and ans.find("**ERROR**") >= 0):
+                self.put(key, ans, ttl)
+            return ans
+
+        ans, shared = self.flights.do(key, call)
+        if shared:
+            with self.lock:
+                self.metrics[name]["shared"] += 1
+        return ans
+
+    def stats(self):
+        with self.lock:
+            return {"backend": self.backend, "calls": {k: dict(v) for k, v in self.metrics.items()}}
+
+
+RESPONSE_CACHE = ResponseCache()
@@ -0,0 +1,47 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import copy
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight(object):
+    """Calls made with the same key while one is in flight wait for it and share its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Returns the result of `fn` and whether it came from the call of another thread."""
+        with self.lock:
+            fut = self.calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self.calls[key] = Future()
+        if not leader:
+            return copy.deepcopy(fut.result()), True
+
+        try:
+            res = fn(*args, **kwargs)
+            fut.set_result(res)
+            return res, False
+        except BaseException as e:
+            fut.set_exception(e)
+            raise e
+        finally:
+            with self.lock:
+                del self.calls[key]
@@ -0,0 +1,172 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from rag.utils import singleton
+from rag.utils.redis_conn import REDIS_CONN
+
+# Concurrency limits of a tenant, 0 means unlimited. All limits are off unless set, in a
+# single tenant deployment they would cap the whole service.
+SLOT_LIMITS = {
+    "chat": int(os.environ.get("TENANT_MAX_CHATS", 0)),
+    "parse": int(os.environ.get("TENANT_MAX_PARSE_TASKS", 0)),
+}
+# A slot whose holder died is freed after its lease, in seconds.
+SLOT_LEASES = {
+    "chat": int(os.environ.get("TENANT_CHAT_LEASE", 600)),
+    "parse": int(os.environ.get("TENANT_PARSE_LEASE", 4 * 3600)),
+}
+# Rate limits of a tenant as (amount, window in seconds), 0 means unlimited.
+RATE_LIMITS = {
+    "retrieval": (int(os.environ.get("TENANT_RETRIEVAL_QPS", 0)), 1),
+    "embedding": (int(os.environ.get("TENANT_EMBEDDING_TPM", 0)), 60),
+}
+# How long a request queues for a slot or for its rate before it is turned down.
+QUEUE_TIMEOUT = float(os.environ.get("TENANT_LIMIT_WAIT", 60))
+
+SLOT_ACQUIRE = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+SLOT_RELEASE = """
+return redis.call('ZREM', KEYS[1], ARGV[1])
+"""
+# Returns -1 if taken, else the milliseconds until the window restarts.
+RATE_TAKE = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used >= tonumber(ARGV[1]) then
+    return math.max(redis.call('PTTL', KEYS[1]), 1)
+end
+redis.call('INCRBY', KEYS[1], ARGV[2])
+if redis.call('PTTL', KEYS[1]) < 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+end
+return -1
+"""
+
+
+@singleton
+class TenantLimiter(object):
+    """
+    Keeps one tenant from using up the chat servers, ES, the embedding models or the task executors.
+    Slots bound what a tenant runs concurrently, rates bound what it uses per window.
+    Both wait for their turn up to `QUEUE_TIMEOUT` and then raise TimeoutError.
+    Counters are kept in Redis to be shared by every process, and in process while Redis is unavailable.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.rates = {}
+
+    def _acquire(self, key, limit, lease, holder):
+        now = time.time()
+        ok = REDIS_CONN.eval(SLOT_ACQUIRE, [key], [now, limit, now + lease, holder, lease])
+        if ok is not None:
+            return bool(ok)
+        with self.lock:
+            holders = {h: t for h, t in self.slots.get(key, {}).items() if t > now}
+            self.slots[key] = holders
+            if len(holders) >= limit:
+                return False
+            holders[holder] = now + lease
+            return True
+
+    def acquire(self, kind, tenant_id, timeout=None):
+        """Returns the id of the slot once one of the tenant is free."""
+        holder = uuid.uuid1().hex
+        limit = SLOT_LIMITS.get(kind, 0)
+        if not limit:
+            return holder
+        key = "tenant_slots:{}:{}".format(kind, tenant_id)
+        until = time.time() + (QUEUE_TIMEOUT if timeout is None else timeout)
+        wait = 0.05
+        while not self._acquire(key, limit, SLOT_LEASES.get(kind, 600), holder):
+            if time.time() + wait > until:
+                logging.warning("Tenant {} is out of {} slots.".format(tenant_id, kind))
+                raise TimeoutError("Too many concurrent {} requests, please retry later.".format(kind))
+            time.sleep(wait)
+            wait = min(wait * 2, 1.)
+        return holder
+
+    def release(self, kind, tenant_id, holder):
+        if not SLOT_LIMITS.get(kind, 0):
+            return
+        key = "tenant_slots:{}:{}".format(kind, tenant_id)
+        REDIS_CONN.eval(SLOT_RELEASE, [key], [holder])
+        with self.lock:
+            self.slots.get(key, {}).pop(holder, None)
+
+    @contextmanager
+    def slot(self, kind, tenant_id, timeout=None):
+        holder = self.acquire(kind, tenant_id, timeout)
+        try:
+            yield holder
+        finally:
+            self.release(kind, tenant_id, holder)
+
+    def _take(self, key, limit, window, amount):
+        """Returns 0 if taken, else the seconds to wait."""
+        ms = REDIS_CONN.eval(RATE_TAKE, [key], [limit, amount, int(window * 1000)])
+        if ms is not None:
+            return 0 if ms < 0 else ms / 1000.
+        now = time.time()
+        with self.lock:
+            used, reset = self.rates.get(key, (0, now + window))
+            if reset <= now:
+                used, reset = 0, now + window
+            if used >= limit:
+                return reset - now
+            self.rates[key] = (used + amount, reset)
+            return 0
+
+    def throttle(self, kind, tenant_id, amount=1, timeout=None):
+        """
+        Waits until the tenant has not used up the rate of the window yet, then counts `amount` in.
+        With an `amount` unknown beforehand, pass 0 and `charge` it afterwards.
+        """
+        limit, window = RATE_LIMITS.get(kind, (0, 1))
+        if not limit:
+            return
+        key = "tenant_rate:{}:{}".format(kind, tenant_id)
+        until = time.time() + (QUEUE_TIMEOUT if timeout is None else timeout)
+        while True:
+            wait = self._take(key, limit, window, amount)
+            if not wait:
+                return
+            if time.time() + wait > until:
+                logging.warning("Tenant {} is out of {} rate.".format(tenant_id, kind))
+                raise TimeoutError("Too many {} requests, please retry later.".format(kind))
+            time.sleep(wait)
+
+    def charge(self, kind, tenant_id, amount):
+        limit, window = RATE_LIMITS.get(kind, (0, 1))
+        if not limit or not amount:
+            return
+        self._take("tenant_rate:{}:{}".format(kind, tenant_id), 1 << 62, window, amount)
+
+
+TENANT_LIMITER = TenantLimiter()
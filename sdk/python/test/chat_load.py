@@ -0,0 +1,140 @@
+"""
+Load test of the chat streams against a fake LLM, so that what is measured is the server and not a provider.
+
+1. Start the fake OpenAI compatible LLM, which streams `--tokens` tokens after `--ttft` seconds:
+
+    python sdk/python/test/chat_load.py fake-llm --port 9999 --ttft 1 --tokens 200 --tps 50
+
+2. Add it in the web UI as an Xinference model with base url http://<host>:9999/v1, make it the
+   chat model of a dialog with knowledge bases, and create an API key for the dialog.
+
+3. Run concurrent users against the API:
+
+    python sdk/python/test/chat_load.py run --host http://127.0.0.1:9380 --api-key <key> --users 200
+"""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_llm(args):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *_):
+            pass
+
+        def do_POST(self):
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            time.sleep(args.ttft)
+            tokens = ["token%d " % i for i in range(args.tokens)]
+            if not req.get("stream"):
+                body = json.dumps({"id": "fake", "object": "chat.completion", "created": int(time.time()),
+                                   "model": req.get("model", "fake"),
+                                   "choices": [{"index": 0, "finish_reason": "stop",
+                                                "message": {"role": "assistant", "content": "".join(tokens)}}],
+                                   "usage": {"prompt_tokens": 0, "completion_tokens": args.tokens,
+                                             "total_tokens": args.tokens}}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def send(data):
+                data = ("data: " + data + "\n\n").encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            for i, tk in enumerate(tokens):
+                send(json.dumps({"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                                 "model": req.get("model", "fake"),
+                                 "choices": [{"index": 0, "delta": {"content": tk},
+                                              "finish_reason": "stop" if i == len(tokens) - 1 else None}]}))
+                time.sleep(1. / args.tps)
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+    print("Fake LLM on port {}".format(args.port))
+    ThreadingHTTPServer(("0.0.0.0", args.port), Handler).serve_forever()
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(args):
+    import requests
+
+    headers = {"Authorization": "Bearer " + args.api_key}
+    lock = threading.Lock()
+    stats = {"ttft": [], "total": [], "errors": 0}
+
+    def user(i):
+        conv = requests.get(args.host + "/v1/api/new_conversation", params={"user_id": "load%d" % i},
+                            headers=headers, json={}).json()["data"]
+        for _ in range(args.requests):
+            st = time.time()
+            ttft = None
+            try:
+                res = requests.post(args.host + "/v1/api/completion", headers=headers, stream=True, timeout=600,
+                                    json={"conversation_id": conv["id"], "stream": True, "delta": args.delta,
+                                          "messages": [{"role": "user", "content": args.question}]})
+                for line in res.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    ev = json.loads(line[5:])
+                    if ev["retcode"] != 0:
+                        raise Exception(ev["retmsg"])
+                    if ttft is None and isinstance(ev["data"], dict) and \
+                            (ev["data"].get("answer") or ev["data"].get("delta")):
+                        ttft = time.time() - st
+                with lock:
+                    stats["ttft"].append(ttft if ttft is not None else time.time() - st)
+                    stats["total"].append(time.time() - st)
+            except Exception as e:
+                print("ERROR:", str(e))
+                with lock:
+                    stats["errors"] += 1
+
+    st = time.time()
+    with ThreadPoolExecutor(max_workers=args.users) as exe:
+        list(exe.map(user, range(args.users)))
+    elapsed = time.time() - st
+
+    print("{} users x {} requests in {:.1f}s, {} errors".format(args.users, args.requests, elapsed, stats["errors"]))
+    for k in ["ttft", "total"]:
+        print("{:>6}: p50 {:.2f}s  p90 {:.2f}s  p99 {:.2f}s  max {:.2f}s".format(
+            k, percentile(stats[k], .5), percentile(stats[k], .9), percentile(stats[k], .99),
+            max(stats[k]) if stats[k] else float("nan")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("fake-llm")
+    p.add_argument("--port", type=int, default=9999)
+    p.add_argument("--ttft", type=float, default=1., help="Seconds before the first token")
+    p.add_argument("--tokens", type=int, default=200, help="Tokens of an answer")
+    p.add_argument("--tps", type=float, default=50., help="Tokens per second of an answer")
+    p = sub.add_parser("run")
+    p.add_argument("--host", type=str, default="http://127.0.0.1:9380")
+    p.add_argument("--api-key", type=str, required=True)
+    p.add_argument("--users", type=int, default=50, help="Concurrent users")
+    p.add_argument("--requests", type=int, default=5, help="Questions of a user, one after another")
+    p.add_argument("--question", type=str, default="What is RAGFlow?")
+    p.add_argument("--delta", action="store_true", help="Ask for delta streaming")
+    args = parser.parse_args()
+    fake_llm(args) if args.cmd == "fake-llm" else run(args)